@@ -0,0 +1,260 @@
+# Benchmarks for the survey functions in functions.py
+# builds a synthetic CMIP6/canari tree and times the get_* functions
+# and the full fill_dataframe survey on it
+#
+# e.g. python benchmark.py --root /tmp/synthetic --models 12 --members 10 --latency 0.005
+
+# Local imports
+import os
+import glob
+import time
+import json
+import argparse
+import tracemalloc
+import contextlib
+import io
+import builtins
+
+# Third-party imports
+import pandas as pd
+import netCDF4
+
+# Import dictionaries and functions
+import dictionaries as dic
+import functions as fnc
+
+# The time chunks of the files for each table_id
+# as (number of years per file, date format of the start, date format of the end)
+file_chunks = { "Amon": (165, "{year}01", "{year}12"), "day": (10, "{year}0101", "{year}1231"), "6hr": (10, "{year}01010000", "{year}12311800") }
+
+# Define a function to get the time ranges of the files for a table_id
+# between the start and end years (inclusive)
+# e.g. ["185001-201412"] for Amon
+def get_time_ranges(table_id, start_year, end_year):
+    years_per_file, start_format, end_format = file_chunks[table_id]
+    ranges = []
+    for year in range(start_year, end_year + 1, years_per_file):
+        last_year = min(year + years_per_file - 1, end_year)
+        ranges.append(start_format.format(year=year) + "-" + end_format.format(year=last_year))
+    return ranges
+
+# Define a function to create an empty (or one byte) file
+# creating the directories above it as needed
+def touch_file(path, empty=False):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        if not empty:
+            f.write(b"\0")
+
+# Define a function to build a synthetic tree with the badc and canari layouts
+# under the root directory
+# badc: <root>/badc/cmip6/data/CMIP6/CMIP/<inst>/<model>/historical/<member>/Amon/<var>/gn/files/dYYYYMMDD/
+# and   <root>/badc/cmip6/data/CMIP6/DCPP/<inst>/<model>/dcppA-hindcast/s<year>-<member>/Amon/<var>/gn/files/dYYYYMMDD/
+# canari: <root>/gws/nopw/j04/canari/users/benhutch/<experiment>/data/<var>/<model>/<file>.nc
+# every empty_every-th file is created empty
+# returns the list of base paths, in the same order as dic.base_paths
+def make_synthetic_tree(root, n_models=4, n_members=3, init_years=range(1960, 1965), table_ids=dic.table_ids, variables=dic.variables, empty_every=50):
+    badc_dir = os.path.join(root, "badc/cmip6/data/CMIP6")
+    canari_dir = os.path.join(root, "gws/nopw/j04/canari/users/benhutch")
+
+    # use the real model names first
+    models = list(dic.models[:n_models]) + ["MODEL-" + str(i) for i in range(len(dic.models), n_models)]
+    members = ["r" + str(i + 1) + "i1p1f1" for i in range(n_members)]
+
+    n_files = 0
+    for model in models:
+        institution = "INST-" + model
+        for table_id in table_ids:
+            for variable in variables:
+                # historical data
+                for member in members:
+                    for time_range in get_time_ranges(table_id, 1850, 2014):
+                        filename = "_".join([variable, table_id, model, "historical", member, "gn", time_range]) + ".nc"
+                        empty = n_files % empty_every == empty_every - 1
+                        touch_file(os.path.join(badc_dir, "CMIP", institution, model, "historical", member, table_id, variable, "gn", "files", "d20190914", filename), empty)
+                        touch_file(os.path.join(canari_dir, "historical", "data", variable, model, filename), empty)
+                        n_files += 1
+
+                # dcppA-hindcast data, ten years from November of the init year
+                for year in init_years:
+                    for member in members:
+                        dcpp_member = "s" + str(year) + "-" + member
+                        for time_range in get_time_ranges(table_id, year + 1, year + 10):
+                            filename = "_".join([variable, table_id, model, "dcppA-hindcast", dcpp_member, "gn", time_range]) + ".nc"
+                            empty = n_files % empty_every == empty_every - 1
+                            touch_file(os.path.join(badc_dir, "DCPP", institution, model, "dcppA-hindcast", dcpp_member, table_id, variable, "gn", "files", "d20190914", filename), empty)
+                            touch_file(os.path.join(canari_dir, "dcppA-hindcast", "data", variable, model, filename), empty)
+                            n_files += 1
+
+    print("Created", n_files, "files for", len(models), "models under", root)
+
+    return [canari_dir, os.path.join(badc_dir, "CMIP"), os.path.join(badc_dir, "DCPP")], models
+
+# A directory entry which counts the calls to stat
+# as os.DirEntry cannot be wrapped directly
+class CountingDirEntry:
+    def __init__(self, entry, counts):
+        self.entry = entry
+        self.counts = counts
+        self.name = entry.name
+        self.path = entry.path
+
+    def is_dir(self, follow_symlinks=True):
+        return self.entry.is_dir(follow_symlinks=follow_symlinks)
+
+    def is_file(self, follow_symlinks=True):
+        return self.entry.is_file(follow_symlinks=follow_symlinks)
+
+    def stat(self, follow_symlinks=True):
+        self.counts["stat"] += 1
+        return self.entry.stat(follow_symlinks=follow_symlinks)
+
+# Define a context manager which counts the filesystem calls
+# (scandir, listdir, stat, glob and open) made inside it
+# open counts the files opened by python and by the NetCDF library
+# (but not those opened by the process pools, which are in other processes)
+# latency adds a delay (in seconds) to every listing, to simulate network mounts
+# stalls maps path prefixes to a delay for the listings below them
+# e.g. {path: 3600} to simulate a hung directory
+@contextlib.contextmanager
+def count_filesystem_calls(latency=0.0, stalls=None):
+    counts = { "scandir": 0, "listdir": 0, "stat": 0, "glob": 0, "open": 0 }
+    originals = { "scandir": os.scandir, "listdir": os.listdir, "stat": os.stat, "glob": glob.glob, "open": builtins.open, "Dataset": netCDF4.Dataset }
+
+    # the delay of a listing, the longest stall which matches the path
+    def delay(path):
+        stall = [seconds for prefix, seconds in (stalls or {}).items() if str(path).startswith(prefix)]
+        return max(stall) if stall else latency
+
+    @contextlib.contextmanager
+    def scandir(path="."):
+        counts["scandir"] += 1
+        if delay(path):
+            time.sleep(delay(path))
+        with originals["scandir"](path) as it:
+            yield (CountingDirEntry(entry, counts) for entry in it)
+
+    def listdir(path="."):
+        counts["listdir"] += 1
+        if delay(path):
+            time.sleep(delay(path))
+        return originals["listdir"](path)
+
+    def stat(path, *args, **kwargs):
+        counts["stat"] += 1
+        return originals["stat"](path, *args, **kwargs)
+
+    def glob_glob(pathname, *args, **kwargs):
+        counts["glob"] += 1
+        if latency:
+            time.sleep(latency)
+        return originals["glob"](pathname, *args, **kwargs)
+
+    def open_file(file, *args, **kwargs):
+        counts["open"] += 1
+        return originals["open"](file, *args, **kwargs)
+
+    def open_dataset(filename, *args, **kwargs):
+        counts["open"] += 1
+        return originals["Dataset"](filename, *args, **kwargs)
+
+    os.scandir, os.listdir, os.stat, glob.glob = scandir, listdir, stat, glob_glob
+    builtins.open, netCDF4.Dataset = open_file, open_dataset
+    try:
+        yield counts
+    finally:
+        os.scandir, os.listdir, os.stat, glob.glob = originals["scandir"], originals["listdir"], originals["stat"], originals["glob"]
+        builtins.open, netCDF4.Dataset = originals["open"], originals["Dataset"]
+
+# Define a function to time one call
+# returns a dictionary with the wall time, the filesystem calls
+# and the peak memory (from tracemalloc) of the call
+def measure(name, function, latency=0.0, stalls=None):
+    tracemalloc.start()
+    with count_filesystem_calls(latency=latency, stalls=stalls) as counts:
+        # the functions print a lot, which is not part of the benchmark
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            function()
+            wall_time = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result = { "name": name, "wall_time_s": wall_time, "peak_memory_mb": peak / 1e6 }
+    result.update(counts)
+    result["filesystem_calls"] = sum(counts.values())
+    return result
+
+# Define a function to run the benchmarks on a synthetic tree
+# times each get_* function for one row of each base path
+# and the full survey with the serial, thread and asyncio listings
+# and a survey of only the member counts
+# stall (in seconds) adds a survey with the first model's canari directories stalled
+# listed with timeouts of timeout seconds (and no retries)
+# returns a dataframe with a row per benchmark
+def run_benchmarks(base_paths, models, table_ids=dic.table_ids, variables=dic.variables, experiments=dic.experiments, max_workers=16, latency=0.0, stall=None, timeout=1.0):
+    results = []
+
+    # the get_* functions for the first model, variable and table_id
+    model, variable, table_id = models[0], variables[0], table_ids[0]
+    for base_path, experiment in zip(base_paths, ["historical", "historical", "dcppA-hindcast"]):
+        data_source = fnc.get_datasource(base_path)
+        row_functions = {
+            "get_institution": lambda: fnc.get_institution(model, base_path, variable),
+            "get_runs": lambda: fnc.get_runs(model, base_path, experiment, variable),
+            "get_inits": lambda: fnc.get_inits(model, base_path, experiment, variable),
+            "get_physics": lambda: fnc.get_physics(model, base_path, experiment, variable),
+            "get_forcing": lambda: fnc.get_forcing(model, base_path, experiment, variable),
+            "get_total_ensemble_members": lambda: fnc.get_total_ensemble_members(model, base_path, experiment, variable),
+            "get_table_id": lambda: fnc.get_table_id(model, base_path, experiment, table_id, variable),
+            "get_variable": lambda: fnc.get_variable(model, base_path, experiment, table_id, variable),
+            "get_files": lambda: fnc.get_files(model, base_path, experiment, table_id, variable),
+            "get_years": lambda: fnc.get_years(model, base_path, experiment, table_id, variable),
+            "get_empty_files": lambda: fnc.get_empty_files(model, base_path, experiment, table_id, variable),
+            "evaluate_row": lambda: fnc.evaluate_row(base_path, table_id, experiment, model, variable, dic.columns),
+        }
+        for name, function in row_functions.items():
+            results.append(dict(measure(name, function, latency=latency), base_path=data_source))
+
+    # the full survey
+    survey = lambda **kwargs: fnc.fill_dataframe(base_paths, models, variables, dic.columns, experiments, table_ids, **kwargs)
+    results.append(dict(measure("fill_dataframe", survey, latency=latency), base_path="all"))
+    results.append(dict(measure("fill_dataframe max_workers=" + str(max_workers), lambda: survey(max_workers=max_workers), latency=latency), base_path="all"))
+    results.append(dict(measure("fill_dataframe use_asyncio", lambda: survey(max_workers=max_workers, use_asyncio=True), latency=latency), base_path="all"))
+
+    # only the member counts, which do not need the files
+    member_columns = ["data_source", "model", "runs", "inits", "physics", "forcing", "total ensemble members"]
+    members_survey = lambda: fnc.fill_dataframe(base_paths, models, variables, member_columns, experiments, table_ids, max_workers=max_workers)
+    results.append(dict(measure("fill_dataframe member columns", members_survey, latency=latency), base_path="all"))
+
+    # a stalled mount, which the timeouts keep from hanging the survey
+    if stall:
+        stalls = {os.path.join(base_paths[0], experiment, "data", variable, models[0]): stall for experiment in experiments for variable in variables}
+        stalled_survey = lambda: survey(max_workers=max_workers, timeouts={"timeout": timeout, "retries": 0})
+        results.append(dict(measure("fill_dataframe stalled timeout=" + str(timeout), stalled_survey, latency=latency, stalls=stalls), base_path="all"))
+
+    return pd.DataFrame(results, columns=["name", "base_path", "wall_time_s", "filesystem_calls", "scandir", "listdir", "stat", "glob", "open", "peak_memory_mb"])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the survey functions on a synthetic CMIP6/canari tree")
+    parser.add_argument("--root", required=True, help="directory to build the synthetic tree in")
+    parser.add_argument("--models", type=int, default=4, help="number of models")
+    parser.add_argument("--members", type=int, default=3, help="number of members per model")
+    parser.add_argument("--init-years", type=int, default=5, help="number of dcppA-hindcast init years from 1960")
+    parser.add_argument("--table-ids", nargs="+", default=dic.table_ids, help="table_ids to create")
+    parser.add_argument("--max-workers", type=int, default=16, help="listings at once for the parallel surveys")
+    parser.add_argument("--latency", type=float, default=0.0, help="delay in seconds added to every listing")
+    parser.add_argument("--stall", type=float, help="delay in seconds of the first model's canari listings, for a survey with timeouts")
+    parser.add_argument("--timeout", type=float, default=1.0, help="timeout in seconds of the listings in the stalled survey")
+    parser.add_argument("--json", help="file to write the results to as JSON")
+    args = parser.parse_args()
+
+    base_paths, models = make_synthetic_tree(args.root, n_models=args.models, n_members=args.members, init_years=range(1960, 1960 + args.init_years), table_ids=args.table_ids)
+    results = run_benchmarks(base_paths, models, table_ids=args.table_ids, max_workers=args.max_workers, latency=args.latency, stall=args.stall, timeout=args.timeout)
+
+    with pd.option_context("display.width", 200, "display.max_columns", None):
+        print(results)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results.to_dict(orient="records"), f, indent=2)
@@ -5,11 +5,28 @@ import os
 import sys
 import glob
 import re
+import fnmatch
+import json
+import struct
+import hashlib
+import sqlite3
+import threading
+import concurrent.futures
+import multiprocessing
+import asyncio
+import time
+import datetime
+import functools
+import contextlib
+import itertools
 
 # Third-party imports
 import numpy as np
 import pandas as pd
 import xarray as xr
+import zarr
+import netCDF4
+import cftime
 import matplotlib.pyplot as plt
 import cartopy.crs as ccrs
 
@@ -18,33 +35,796 @@ import cartopy.crs as ccrs
 # # data on JASMIN path
 # /badc/cmip6/data/CMIP6/CMIP/NCC/NorCPM1/historical/r1i1p1f1/Amon/psl/gn/files/d20190914
 
+# The kinds of filesystem calls which are counted when profiling
+# the directory listings (scandir), the stats of the directories and files
+# and the NetCDF files opened (for the headers, the checks and load_ensemble)
+# the files read by the process pools (see map_files_cached) are counted as
+# they are sent to the pool, as the calls in the other processes are not seen here
+filesystem_calls = [ "scandir", "stat", "open" ]
+
+# The state of the (opt-in) profiler
+# counts holds the number of filesystem calls of each kind so far
+# records holds the totals for each (scope, name, base_path)
+profile_state = { "active": False, "counts": {}, "records": {} }
+profile_lock = threading.Lock()
+
+# Define a function to start profiling
+# clearing anything which was recorded before
+def start_profile():
+    with profile_lock:
+        profile_state["counts"] = {call: 0 for call in filesystem_calls}
+        profile_state["records"] = {}
+        profile_state["active"] = True
+
+# Define a function to stop profiling
+# returns the profile as a dataframe with a row for each
+# (scope, name, base_path) and the number of calls, the total wall time
+# and the number of filesystem calls of each kind
+# e.g. profile.to_json(orient="records") to save it
+def stop_profile():
+    with profile_lock:
+        profile_state["active"] = False
+        records = [dict(scope=scope, name=name, base_path=base_path, **totals) for (scope, name, base_path), totals in profile_state["records"].items()]
+
+    columns = ["scope", "name", "base_path", "calls", "wall_time_s"] + filesystem_calls
+    return pd.DataFrame(records, columns=columns)
+
+# Define a function to count a filesystem call when profiling
+def count_filesystem_call(call, n=1):
+    if profile_state["active"]:
+        with profile_lock:
+            profile_state["counts"][call] += n
+
+# Define a context manager which records the wall time
+# and the filesystem calls made inside it when profiling
+# scope is e.g. "function", "column" or "base_path"
+# the calls inside nested scopes are included in the outer scope
+@contextlib.contextmanager
+def profile_scope(scope, name, base_path=None):
+    if not profile_state["active"]:
+        yield
+        return
+
+    with profile_lock:
+        counts_before = dict(profile_state["counts"])
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        wall_time = time.perf_counter() - start
+        with profile_lock:
+            totals = profile_state["records"].setdefault((scope, name, base_path), dict(calls=0, wall_time_s=0.0, **{call: 0 for call in filesystem_calls}))
+            totals["calls"] += 1
+            totals["wall_time_s"] += wall_time
+            for call in filesystem_calls:
+                totals[call] += profile_state["counts"][call] - counts_before[call]
+
+# Define a decorator which records the wall time of a function when profiling
+def profiled(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not profile_state["active"]:
+            return function(*args, **kwargs)
+        with profile_scope("function", function.__name__):
+            return function(*args, **kwargs)
+    return wrapper
+
+# The levels of the badc DRS below the base path, as (key, pattern) pairs
+# a key of None is a fixed directory which is not stored in the index
+# e.g. /badc/cmip6/data/CMIP6/CMIP/NCC/NorCPM1/historical/r1i1p1f1/Amon/psl/gn/files/d20190914
+badc_levels = [ ("institution", "*"), ("source", "*"), ("experiment", "*"), ("member", "*r*i*p*f*"), ("table_id", "*"), ("variable", "*"), ("grid", "g?"), (None, "files"), ("version", "d*") ]
+
+# The levels of the canari GWS layout below the base path
+# e.g. /gws/nopw/j04/canari/users/benhutch/historical/data/psl/BCC-CSM2-MR
+# the member, table_id and grid are then taken from the filenames
+canari_levels = [ ("experiment", "*"), (None, "data"), ("variable", "*"), ("source", "*") ]
+
+# Lock for the catalog, which is shared by the listing threads
+catalog_lock = threading.Lock()
+
+# Define a function to open the on-disk catalog
+# the catalog is a SQLite database which holds the directory listings
+# with each directory's mtime and entry count, and the survey rows
+def open_catalog(catalog_path):
+    catalog = sqlite3.connect(catalog_path, check_same_thread=False)
+    catalog.execute("CREATE TABLE IF NOT EXISTS directories (path TEXT PRIMARY KEY, mtime_ns INTEGER, n_entries INTEGER, stat_files INTEGER, entries TEXT)")
+    return catalog
+
+# The default timeouts of the listings (and of the stats and reads of the files)
+# see call_with_retries, timeout is the seconds to wait for one listing, retries the number of times
+# to try again after a timeout (or an error), waiting backoff seconds
+# and then twice as long each time
+# e.g. timeouts={"timeout": 30} for the GWS, where a stalled mount can hang a listing
+default_timeouts = { "timeout": 30, "retries": 2, "backoff": 1.0 }
+
+# The health of the mounts, from the listings of the current survey
+# (and the stats and reads of the files, with timeouts, see map_files_cached)
+# (cleared at the start of fill_dataframe, stream_survey and run_survey_shard)
+# for each mount: the listings, their total and longest time, the retries,
+# the timeouts, the errors and the directories (or files) which are unreachable
+mount_health = {}
+mount_health_lock = threading.Lock()
+
+# The directories which could not be listed (after all of the retries)
+# and the files which could not be stat'd or read
+# path -> reason, a path is removed once it is reached again
+unreachable_directories = {}
+
+# Define a function to get the mount of a path
+# the longest of the prefixes which matches the path (e.g. the keys of mount_limits)
+# or else its first two directories, e.g. /gws/nopw or /badc/cmip6
+def get_mount(path, prefixes=None):
+    matches = [prefix for prefix in (prefixes or []) if path.startswith(prefix)]
+    if len(matches) > 0:
+        return max(matches, key=len)
+
+    return "/" + "/".join(path.strip("/").split("/")[:2])
+
+# Define a function to record a listing (or a failed one) in the health of its mount
+def record_mount_health(mount, wall_time=0.0, retries=0, timeouts=0, errors=0, unreachable=0):
+    with mount_health_lock:
+        health = mount_health.setdefault(mount, dict(listings=0, time_s=0.0, max_time_s=0.0, retries=0, timeouts=0, errors=0, unreachable=0))
+        health["listings"] += 1
+        health["time_s"] += wall_time
+        health["max_time_s"] = max(health["max_time_s"], wall_time)
+        health["retries"] += retries
+        health["timeouts"] += timeouts
+        health["errors"] += errors
+        health["unreachable"] += unreachable
+
+# Define a function to get the health of the mounts
+# returns a dataframe with a row per mount
+# and the mean time of a listing
+def get_mount_health():
+    with mount_health_lock:
+        records = [dict(mount=mount, **health) for mount, health in mount_health.items()]
+
+    columns = ["mount", "listings", "time_s", "max_time_s", "retries", "timeouts", "errors", "unreachable"]
+    health = pd.DataFrame(records, columns=columns)
+    health["mean_time_s"] = health["time_s"] / health["listings"].where(health["listings"] > 0)
+    return health
+
+# Define a function to add up the health of the mounts from several surveys
+# e.g. the mount_health tables of the shards of a survey
+# returns a dataframe with a row per mount, as get_mount_health
+def merge_mount_health(frames):
+    health = pd.concat(frames, ignore_index=True) if len(frames) > 0 else get_mount_health().iloc[0:0]
+    health = health.groupby("mount", sort=False, as_index=False).agg(listings=("listings", "sum"), time_s=("time_s", "sum"), max_time_s=("max_time_s", "max"), retries=("retries", "sum"), timeouts=("timeouts", "sum"), errors=("errors", "sum"), unreachable=("unreachable", "sum"))
+    health["mean_time_s"] = health["time_s"] / health["listings"].where(health["listings"] > 0)
+    return health
+
+# Define a function to clear the health of the mounts
+# and the unreachable directories
+def reset_mount_health():
+    with mount_health_lock:
+        mount_health.clear()
+        unreachable_directories.clear()
+
+# Define a function to get the mount_limits for the slow mounts from their health
+# so the next survey lists fewer of their directories at once
+# a mount with timeouts (or unreachable directories) gets an eighth of max_workers
+# and a mount with a mean listing time over slow_time_s a quarter
+# e.g. fill_dataframe(..., use_asyncio=True, mount_limits=get_throttled_mount_limits(get_mount_health()))
+def get_throttled_mount_limits(health, max_workers=32, slow_time_s=1.0):
+    mount_limits = {}
+    for record in health.to_dict(orient="records"):
+        if record["timeouts"] > 0 or record["unreachable"] > 0:
+            mount_limits[record["mount"]] = max(1, max_workers // 8)
+        elif record["mean_time_s"] > slow_time_s:
+            mount_limits[record["mount"]] = max(1, max_workers // 4)
+    return mount_limits
+
+# Define a function to save the health of the mounts to the catalog
+def save_mount_health(catalog):
+    get_mount_health().to_sql("mount_health", catalog, if_exists="replace", index=False)
+    catalog.commit()
+
+# Define a function to get the unreachable directories under a base path
+def get_unreachable_directories(base_path):
+    with mount_health_lock:
+        return sorted(path for path in unreachable_directories if path == base_path or path.startswith(base_path.rstrip("/") + "/"))
+
+# Define a function to call a function in its own thread and wait at most timeout seconds
+# raises a TimeoutError if it has not finished, the thread is left behind
+# (a hung filesystem call cannot be stopped) and does not stop python exiting
+def call_with_timeout(function, timeout, *args):
+    result = {}
+
+    def target():
+        try:
+            result["value"] = function(*args)
+        except BaseException as e:
+            result["error"] = e
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        raise TimeoutError("Timed out after " + str(timeout) + " s")
+    if "error" in result:
+        raise result["error"]
+    return result["value"]
+
+# Define a function to call function(path, *args) with timeouts (see default_timeouts)
+# each try is given at most timeout seconds, and if all of the tries time out (or fail)
+# the path is recorded as unreachable, rather than the survey hanging
+# the call is recorded in the health of its mount (see get_mount)
+# returns (True, the result) or (False, the reason the path is unreachable)
+def call_with_retries(function, path, timeouts, mount_limits=None, *args):
+    mount = get_mount(path, mount_limits)
+    start = time.perf_counter()
+    timeouts = dict(default_timeouts, **timeouts)
+    n_timeouts = 0
+    n_errors = 0
+    for attempt in range(timeouts["retries"] + 1):
+        if attempt > 0:
+            time.sleep(timeouts["backoff"] * 2 ** (attempt - 1))
+        try:
+            result = call_with_timeout(function, timeouts["timeout"], path, *args)
+        except TimeoutError:
+            n_timeouts += 1
+            reason = "timeout"
+            continue
+        except OSError as e:
+            n_errors += 1
+            reason = type(e).__name__ + ": " + str(e)
+            continue
+
+        record_mount_health(mount, time.perf_counter() - start, retries=attempt, timeouts=n_timeouts, errors=n_errors)
+        with mount_health_lock:
+            unreachable_directories.pop(path, None)
+        return True, result
+
+    record_unreachable(path, reason, mount, time.perf_counter() - start, retries=timeouts["retries"], timeouts=n_timeouts, errors=n_errors)
+    return False, reason
+
+# Define a function to record a path as unreachable, in the health of its mount
+def record_unreachable(path, reason, mount, wall_time=0.0, retries=0, timeouts=0, errors=0):
+    print("Unreachable: ", path, reason)
+    record_mount_health(mount, wall_time, retries=retries, timeouts=timeouts, errors=errors, unreachable=1)
+    with mount_health_lock:
+        unreachable_directories[path] = reason
+
+# Define a function to list a single directory
+# with timeouts (see call_with_retries) an unreachable directory has an empty listing
+# the listing is recorded in the health of its mount (see get_mount)
+def list_directory(path, stat_files=False, catalog=None, timeouts=None, mount_limits=None):
+    if timeouts is None:
+        start = time.perf_counter()
+        entries = scan_directory(path, stat_files, catalog)
+        record_mount_health(get_mount(path, mount_limits), time.perf_counter() - start)
+        return entries
+
+    reached, entries = call_with_retries(scan_directory, path, timeouts, mount_limits, stat_files, catalog)
+    return entries if reached else []
+
+# Define a function to list a single directory using os.scandir
+# returns a list of (name, is_dir, size) tuples
+# the size is only filled in (one stat per file) if stat_files is True
+# if a catalog is given, the directory is only re-listed if its mtime has changed
+# a file written in place does not change the mtime of its directory
+# so with stat_files the files of an unchanged directory are still stat'd for their sizes
+def scan_directory(path, stat_files=False, catalog=None):
+    if catalog is not None:
+        # one stat for the directory instead of a full listing
+        try:
+            count_filesystem_call("stat")
+            mtime_ns = os.stat(path).st_mtime_ns
+        except OSError:
+            return []
+
+        with catalog_lock:
+            row = catalog.execute("SELECT mtime_ns, stat_files, entries FROM directories WHERE path = ?", (path,)).fetchone()
+        if row is not None and row[0] == mtime_ns and (row[1] or not stat_files):
+            entries = [tuple(entry) for entry in json.loads(row[2])]
+            if not stat_files:
+                return entries
+
+            restated = []
+            for name, is_dir, size in entries:
+                if not is_dir:
+                    try:
+                        count_filesystem_call("stat")
+                        size = os.stat(os.path.join(path, name)).st_size
+                    except OSError:
+                        continue
+                restated.append((name, is_dir, size))
+
+            # store the new sizes if any have changed
+            if restated != entries:
+                with catalog_lock:
+                    catalog.execute("INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?, ?)", (path, mtime_ns, len(restated), 1, json.dumps(restated)))
+            return restated
+
+    entries = []
+    try:
+        count_filesystem_call("scandir")
+        with os.scandir(path) as it:
+            for entry in it:
+                # skip hidden files, as glob does
+                if entry.name.startswith("."):
+                    continue
+                try:
+                    # is_dir follows symlinks, as glob does
+                    is_dir = entry.is_dir()
+                    size = None
+                    if stat_files and not is_dir:
+                        count_filesystem_call("stat")
+                        size = entry.stat().st_size
+                except OSError:
+                    # e.g. broken symlinks
+                    continue
+                entries.append((entry.name, is_dir, size))
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        return []
+
+    # store the listing in the catalog for the next run
+    if catalog is not None:
+        with catalog_lock:
+            catalog.execute("INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?, ?)", (path, mtime_ns, len(entries), int(stat_files), json.dumps(entries)))
+
+    return entries
+
+# Define a function to list several directories
+# returns a list of listings in the same order as the paths
+# if max_workers is more than one the directories are listed at once
+# by a pool of threads, as the listings wait on the filesystem
+# if use_asyncio is True the listings are run by the asyncio engine
+# with max_workers (default 32) at once and mount_limits for each mount
+# timeouts are passed on to list_directory
+def list_directories(paths, stat_files=False, catalog=None, max_workers=None, use_asyncio=False, mount_limits=None, timeouts=None):
+    if use_asyncio:
+        return run_async(list_directories_async(paths, stat_files=stat_files, catalog=catalog, max_concurrency=max_workers, mount_limits=mount_limits, timeouts=timeouts))
+
+    if max_workers is None or max_workers <= 1 or len(paths) <= 1:
+        return [list_directory(path, stat_files, catalog, timeouts, mount_limits) for path in paths]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(lambda path: list_directory(path, stat_files, catalog, timeouts, mount_limits), paths))
+
+# Define a function to run a coroutine to completion
+# in a notebook there is already a running event loop
+# so the coroutine is run in its own thread
+def run_async(coroutine):
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+        return pool.submit(asyncio.run, coroutine).result()
+
+# Define a function to set up the limits for the asyncio engine
+# returns a function which lists a directory in a thread
+# once both the overall and the mount's limit allow it
+# mount_limits maps path prefixes to the number of listings at once
+# e.g. {"/gws/nopw/j04/canari": 8, "/badc/cmip6": 32}
+def make_async_lister(max_concurrency=None, mount_limits=None, catalog=None, timeouts=None):
+    if max_concurrency is None or max_concurrency < 1:
+        max_concurrency = 32
+
+    # the listings block, so they run in a pool of threads
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency)
+    semaphore = asyncio.Semaphore(max_concurrency)
+    mount_semaphores = {prefix: asyncio.Semaphore(limit) for prefix, limit in (mount_limits or {}).items()}
+
+    async def list_directory_async(path, stat_files=False):
+        # the longest mount prefix which matches the path
+        mount_semaphore = mount_semaphores.get(get_mount(path, mount_semaphores))
+
+        async with semaphore:
+            loop = asyncio.get_running_loop()
+            if mount_semaphore is None:
+                return await loop.run_in_executor(pool, list_directory, path, stat_files, catalog, timeouts, mount_limits)
+            async with mount_semaphore:
+                return await loop.run_in_executor(pool, list_directory, path, stat_files, catalog, timeouts, mount_limits)
+
+    return list_directory_async, pool
+
+# Define a function to list several directories with asyncio
+# the listings overlap, up to max_concurrency at once
+# returns a list of listings in the same order as the paths
+async def list_directories_async(paths, stat_files=False, catalog=None, max_concurrency=None, mount_limits=None, timeouts=None):
+    list_directory_async, pool = make_async_lister(max_concurrency, mount_limits, catalog, timeouts)
+    try:
+        return await asyncio.gather(*[list_directory_async(path, stat_files) for path in paths])
+    finally:
+        pool.shutdown(wait=False)
+
+# Define a function to pick out the subdirectories which match a level
+# from the listing of a directory
+# returns a list of (path, keys) tuples
+def select_subdirectories(path, keys, entries, key, pattern, allowed):
+    selected = []
+    for name, is_dir, size in entries:
+        if not is_dir or not fnmatch.fnmatchcase(name, pattern):
+            continue
+        if allowed is not None and name not in allowed:
+            continue
+        # fixed directories such as files/ are not part of the keys
+        next_keys = keys if key is None else keys + (name,)
+        selected.append((os.path.join(path, name), next_keys))
+    return selected
+
+# Define a function to walk down a list of directory levels
+# listing every directory at one level before moving to the next
+# filters maps the level keys to lists of allowed names (or None for all)
+# returns a list of (path, keys) tuples for each level
+# if use_asyncio is True the walk is run by walk_levels_async instead
+def walk_levels(base_path, levels, filters, max_level=None, catalog=None, max_workers=None, use_asyncio=False, mount_limits=None, timeouts=None):
+    if use_asyncio:
+        return run_async(walk_levels_async(base_path, levels, filters, max_level=max_level, catalog=catalog, max_concurrency=max_workers, mount_limits=mount_limits, timeouts=timeouts))
+
+    frontier = [(base_path, ())]
+    walked = []
+    for key, pattern in levels:
+        # list all the directories at this level at once
+        listings = list_directories([path for path, keys in frontier], catalog=catalog, max_workers=max_workers, mount_limits=mount_limits, timeouts=timeouts)
+
+        allowed = filters.get(key)
+        next_frontier = []
+        for (path, keys), entries in zip(frontier, listings):
+            next_frontier.extend(select_subdirectories(path, keys, entries, key, pattern, allowed))
+
+        frontier = next_frontier
+        walked.append(frontier)
+
+        # stop once the deepest level needed has been listed
+        if max_level is not None and key == max_level:
+            break
+
+    return walked
+
+# Define a function to walk down a list of directory levels with asyncio
+# each directory is listed as soon as its parent has been listed
+# so slow directories do not hold up the rest of the level
+# returns the same list of (path, keys) tuples for each level as walk_levels
+async def walk_levels_async(base_path, levels, filters, max_level=None, catalog=None, max_concurrency=None, mount_limits=None, timeouts=None):
+    # the levels which are walked
+    depth = len(levels)
+    if max_level is not None and max_level in [key for key, pattern in levels]:
+        depth = [key for key, pattern in levels].index(max_level) + 1
+
+    list_directory_async, pool = make_async_lister(max_concurrency, mount_limits, catalog, timeouts)
+
+    # walk below a directory
+    # returns the (path, keys) tuples found for each of the levels below it
+    async def walk(path, keys, level):
+        key, pattern = levels[level]
+        entries = await list_directory_async(path)
+        children = select_subdirectories(path, keys, entries, key, pattern, filters.get(key))
+
+        found = [children] + [[] for i in range(level + 1, depth)]
+        if level + 1 < depth:
+            # the children are walked at once and merged back in order
+            below = await asyncio.gather(*[walk(child_path, child_keys, level + 1) for child_path, child_keys in children])
+            for child_found in below:
+                for i, frontier in enumerate(child_found):
+                    found[i + 1].extend(frontier)
+        return found
+
+    try:
+        return await walk(base_path, (), 0)
+    finally:
+        pool.shutdown(wait=False)
+
+# Define a function to add a node to the DRS index
+# creating the intermediate levels as needed
+def insert_index_node(index, keys):
+    node = index
+    for key in keys:
+        node = node.setdefault(key, {})
+    return node
+
+# Compiled pattern for the member labels
+# e.g. r1i1p1f1, or s1960-r1i1p1f1 for dcppA-hindcast
+member_regex = re.compile(r"^(?:s(?P<init_year>\d{4})-)?r(?P<realization>\d+)i(?P<initialization>\d+)p(?P<physics>\d+)f(?P<forcing>\d+)$")
+
+# Compiled pattern for the CMIP6 filenames
+# variable_table_source_experiment_member_grid_time.nc
+# e.g. psl_Amon_BCC-CSM2-MR_historical_r1i1p1f1_gn_185001-201412.nc
+# the time range is missing for fixed fields (fx)
+filename_regex = re.compile(r"^(?P<variable>[^_]+)_(?P<table_id>[^_]+)_(?P<source>[^_]+)_(?P<experiment>[^_]+)_(?P<member>[^_]+)_(?P<grid>[^_.]+)(?:_(?P<start>\d+)-(?P<end>\d+)(?:-clim)?)?\.nc$")
+
+# The integer parts of the member labels
+member_parts = [ "init_year", "realization", "initialization", "physics", "forcing" ]
+
+# Define a function to split a canari filename into its DRS components
+# e.g. psl_Amon_BCC-CSM2-MR_historical_r1i1p1f1_gn_185001-201412.nc
+# returns None if the filename does not follow the convention
+def split_canari_filename(filename):
+    match = filename_regex.match(filename)
+    if match is None or not fnmatch.fnmatchcase(match.group("member"), "*r*i*p*f*"):
+        return None
+
+    return match.groupdict()
+
+# Define a function to parse a list of member labels at once
+# returns a dataframe with a row per label and integer columns
+# init_year (for dcppA-hindcast), realization, initialization, physics and forcing
+# labels which do not follow the convention have missing values
+# members which have already been parsed are returned as they are
+def parse_members(members):
+    if isinstance(members, pd.DataFrame):
+        return members
+
+    matches = [member_regex.match(member) if isinstance(member, str) else None for member in members]
+
+    # build each column in one go, as the dataframe operations are slow for short lists
+    parsed = { "member": pd.Series(list(members), dtype=object) }
+    for part in member_parts:
+        values = [match.group(part) if match is not None else None for match in matches]
+        parsed[part] = pd.array([int(value) if value is not None else None for value in values], dtype="Int64")
+
+    return pd.DataFrame(parsed)
+
+# Define a function to convert the dates in the filenames to timestamps
+# the dates can be YYYY, YYYYMM, YYYYMMDD, YYYYMMDDhh or YYYYMMDDhhmm
+# e.g. 185001 is 1850-01-01T00:00
+# numpy datetimes are used as pandas nanoseconds only cover 1677-2262
+# dates which are not in the standard calendar (e.g. 18500230 in a 360_day calendar)
+# or cannot be parsed are NaT
+def parse_filename_dates(dates):
+    iso = []
+    for date in dates:
+        if not isinstance(date, str) or len(date) < 4:
+            iso.append("NaT")
+            continue
+        iso.append(date[0:4] + "-" + (date[4:6] or "01") + "-" + (date[6:8] or "01") + "T" + (date[8:10] or "00") + ":" + (date[10:12] or "00"))
+
+    try:
+        return np.array(iso, dtype="datetime64[m]")
+    except ValueError:
+        # one date at a time, to find the ones which cannot be parsed
+        parsed = np.full(len(iso), np.datetime64("NaT"), dtype="datetime64[m]")
+        for i, date in enumerate(iso):
+            try:
+                parsed[i] = np.datetime64(date, "m")
+            except ValueError:
+                pass
+        return parsed
+
+# Define a function to parse a list of filenames at once
+# returns a dataframe with a row per filename with the DRS components,
+# the integer parts of the member label, and the start and end
+# as timestamps and years
+# filenames which do not follow the convention have missing values
+def parse_filenames(filenames):
+    matches = [filename_regex.match(filename) for filename in filenames]
+
+    parsed = { "filename": pd.Series(list(filenames), dtype=object) }
+    for part in ["variable", "table_id", "source", "experiment", "member", "grid"]:
+        parsed[part] = pd.Series([match.group(part) if match is not None else None for match in matches], dtype=object)
+
+    # the integer parts of the member labels
+    members = parse_members(parsed["member"])
+    for part in member_parts:
+        parsed[part] = members[part].array
+
+    # the time range
+    for bound in ["start", "end"]:
+        dates = [match.group(bound) if match is not None else None for match in matches]
+        parsed[bound] = parse_filename_dates(dates)
+        parsed[bound + "_year"] = pd.array([int(date[:4]) if date is not None else None for date in dates], dtype="Int64")
+
+    return pd.DataFrame(parsed)
+
+# Define a function to choose the version directories to list
+# from the version directories found for each member and grid
+# version is "latest" for the latest dYYYYMMDD, "all" for every version,
+# a pinned version (e.g. "d20190914") or a dictionary of model -> pinned version
+# if a pinned version is not there the latest is used
+# returns the chosen and the superseded (path, keys) tuples
+def select_versions(leaves, version="latest"):
+    datasets = {}
+    for path, keys in leaves:
+        datasets.setdefault(keys[:-1], []).append((path, keys))
+
+    chosen = []
+    superseded = []
+    for dataset_keys, dataset_leaves in datasets.items():
+        if version == "all":
+            chosen.extend(dataset_leaves)
+            continue
+
+        pinned = version.get(dataset_keys[1]) if isinstance(version, dict) else version
+        names = [keys[-1] for path, keys in dataset_leaves]
+        name = pinned if pinned in names else max(names)
+        for path, keys in dataset_leaves:
+            if keys[-1] == name:
+                chosen.append((path, keys))
+            else:
+                superseded.append((path, keys))
+
+    return chosen, superseded
+
+# Define a function to build the DRS index for a base path
+# walking the directory tree once with os.scandir
+# the index is a nested dictionary
+# institution -> source -> experiment -> member -> table_id -> variable -> grid -> version -> {file: size}
+# the canari files are given the institution "-" and the version "-"
+# only the chosen version of each badc member and grid is listed (see select_versions)
+# the superseded versions are in the index as None
+# the walk is pruned by the models, experiments, table_ids and variables lists
+# max_level stops the walk below the given level (e.g. "member")
+# stat_files fills in the file sizes (one stat per file)
+# scan_options are passed on to list_directories:
+# catalog is an open catalog to reuse the listings of unchanged directories
+# max_workers is the number of directories to list at once
+# use_asyncio and mount_limits run the listings with the asyncio engine
+@profiled
+def build_drs_index(base_path, models=None, experiments=None, table_ids=None, variables=None, max_level=None, stat_files=True, version="latest", **scan_options):
+    filters = {
+        "source": models,
+        "experiment": experiments,
+        "table_id": table_ids,
+        "variable": variables,
+    }
+
+    index = {}
+
+    if "badc/cmip6/data/CMIP6/" in base_path:
+        walked = walk_levels(base_path, badc_levels, filters, max_level=max_level, **scan_options)
+
+        # add every directory which was found to the index
+        # so that e.g. members without the variable are still counted
+        for frontier in walked:
+            for path, keys in frontier:
+                insert_index_node(index, keys)
+
+        # list the files in the chosen version directories
+        if max_level is None and len(walked) == len(badc_levels):
+            leaves, superseded = select_versions(walked[-1], version)
+            for path, keys in superseded:
+                insert_index_node(index, keys[:-1])[keys[-1]] = None
+
+            listings = list_directories([path for path, keys in leaves], stat_files=stat_files, **scan_options)
+            for (path, keys), entries in zip(leaves, listings):
+                files = insert_index_node(index, keys)
+                for name, is_dir, size in entries:
+                    if not is_dir:
+                        files[name] = size
+
+    elif "/gws/nopw/j04/canari/" in base_path:
+        walked = walk_levels(base_path, canari_levels, filters, **scan_options)
+
+        # the model directories which were found
+        # keyed as (experiment, variable, source)
+        leaves = walked[-1] if len(walked) == len(canari_levels) else []
+        for path, (experiment, variable, source) in leaves:
+            insert_index_node(index, ("-", source, experiment))
+
+        # the member, table_id and grid are only known from the filenames
+        if max_level not in ("institution", "source", "experiment"):
+            listings = list_directories([path for path, keys in leaves], stat_files=stat_files, **scan_options)
+            for (path, (experiment, variable, source)), entries in zip(leaves, listings):
+                for name, is_dir, size in entries:
+                    if is_dir:
+                        continue
+                    drs = split_canari_filename(name)
+                    if drs is None:
+                        continue
+                    files = insert_index_node(index, ("-", source, experiment, drs["member"], drs["table_id"], variable, drs["grid"], "-"))
+                    files[name] = size
+    else:
+        print("Base path not recognized")
+        return None
+
+    return index
+
+# Define a function to get the experiment nodes for a given model
+# from the DRS index, across all institutions
+# returns a list of {member: {...}} dictionaries
+def get_index_experiments(index, model, experiment):
+    nodes = []
+    for institution in sorted(index):
+        sources = index[institution]
+        if model in sources and experiment in sources[model]:
+            nodes.append(sources[model][experiment])
+    return nodes
+
+# Define a function to get the list of members for a given model and experiment
+# from the DRS index
+# if table_id and/or variable are given, only the members which have them are returned
+def get_index_members(index, model, experiment, table_id=None, variable=None):
+    members = []
+    for node in get_index_experiments(index, model, experiment):
+        for member in sorted(node):
+            tables = node[member]
+            if table_id is None and variable is None:
+                members.append(member)
+                continue
+
+            # the tables to check for the variable
+            if table_id is None:
+                table_nodes = list(tables.values())
+            elif table_id in tables:
+                table_nodes = [tables[table_id]]
+            else:
+                table_nodes = []
+
+            if any(variable is None or variable in t for t in table_nodes):
+                members.append(member)
+    return members
+
+# Define a function to get the version directories for a given
+# model, experiment, table_id and variable from the DRS index
+# returns a list of (member, grid, version, {file: size}) tuples
+# for the chosen versions, or for the superseded versions if superseded is True
+def get_index_versions(index, model, experiment, table_id, variable, superseded=False):
+    versions = []
+    for node in get_index_experiments(index, model, experiment):
+        for member in sorted(node):
+            grids = node[member].get(table_id, {}).get(variable, {})
+            for grid in sorted(grids):
+                for version in sorted(grids[grid]):
+                    files = grids[grid][version]
+                    if (files is None) == superseded:
+                        versions.append((member, grid, version, files))
+    return versions
+
+# Define a generator over all the files in the DRS index
+# yields (keys, filename, size) where keys is
+# (institution, source, experiment, member, table_id, variable, grid, version)
+# optionally only for the given model, experiment, table_id and variable
+def iterate_index_files(index, model=None, experiment=None, table_id=None, variable=None):
+    # the filter for each of the levels, None for all
+    filters = [None, model, experiment, None, table_id, variable, None, None]
+
+    def walk(node, keys):
+        level = len(keys)
+        if node is None:
+            # a superseded version
+            return
+        if level == len(filters):
+            for filename in sorted(node):
+                yield keys, filename, node[filename]
+            return
+        names = sorted(node) if filters[level] is None else [filters[level]] if filters[level] in node else []
+        for name in names:
+            yield from walk(node[name], keys + (name,))
+
+    yield from walk(index, ())
+
+# Define a function to get the full path of a file in the DRS index
+# e.g. base_path/NCC/NorCPM1/historical/r1i1p1f1/Amon/psl/gn/files/d20190914/<file> for badc
+# or base_path/historical/data/psl/NorCPM1/<file> for canari
+def get_index_file_path(base_path, keys, filename):
+    institution, source, experiment, member, table_id, variable, grid, version = keys
+    if "/gws/nopw/j04/canari/" in base_path:
+        return os.path.join(base_path, experiment, "data", variable, source, filename)
+
+    return os.path.join(base_path, institution, source, experiment, member, table_id, variable, grid, "files", version, filename)
+
+# Define a function to get the full paths of the files in the DRS index
+# optionally only for the given model, experiment, table_id and variable
+def get_index_file_paths(index, base_path, model=None, experiment=None, table_id=None, variable=None):
+    return [get_index_file_path(base_path, keys, filename) for keys, filename, size in iterate_index_files(index, model, experiment, table_id, variable)]
+
 # Function to get the institution name from the path
 # for a given model
 # function takes the model name and the base path
 # and returns the institution name
-def get_institution(model, base_path, variable):
-    # institution name is the 6th element in the path
+@profiled
+def get_institution(model, base_path, variable, index=None):
+    # institution name is the directory above the model
     # which is formed as:
     # base_path + / + institution + / + model
     # e.g. /badc/cmip6/data/CMIP6/CMIP/NCC/NorCPM1
     if "badc/cmip6/data/CMIP6/" in base_path:
-        # form the path
-        path = base_path + "/*/" + model
+        if index is None:
+            index = build_drs_index(base_path, models=[model], max_level="source")
 
-        # find the directory which matches the path
-        dirs = glob.glob(path)
+        # find the institutions which have the model
+        institutions = [institution for institution in sorted(index) if model in index[institution]]
 
-        # if the dirs list is empty
-        # then the variable is not available
-        if len(dirs) == 0:
+        # if the institutions list is empty
+        # then the model is not available
+        if len(institutions) == 0:
             print("Model not available")
             return None
 
-        # split the path to get the institution name
-        institution = dirs[0].split("/")[6]
-
-        # #print the institution name
-        #print("Institution: ", institution)
+        institution = institutions[0]
     elif "/gws/nopw/j04/canari/" in base_path:
         institution = "-"
 
@@ -54,363 +834,169 @@ def get_institution(model, base_path, variable):
 # for a given model
 # function takes the model name and the base path
 # and returns the experiment name
-def check_experiment(model, base_path, experiment="historical"):
-    # use a try/except block to check whether the experiment exists
-    try:
-        # form the path
-        path = base_path + "/*/" + model + "/" + experiment
-
-        # find the directory which matches the path
-        dirs = glob.glob(path)
-
-        # split the path to get the experiment name
-        experiment = dirs[0].split("/")[8]
+@profiled
+def check_experiment(model, base_path, experiment="historical", index=None):
+    if get_datasource(base_path) is None:
+        return None
 
-        # #print the experiment name
-        #print("Experiment: ", experiment)
+    if index is None:
+        index = build_drs_index(base_path, models=[model], experiments=[experiment], max_level="experiment")
 
-        return experiment
-    except:
+    # check whether the experiment exists for the model
+    if len(get_index_experiments(index, model, experiment)) == 0:
         #print("Experiment not found")
         return None
-    
 
-# Define a function to get the number of runs for a given model
-# and experiment
-def get_runs(model, base_path, experiment, variable):
-  
-    # if base path contains /badc/cmip6/data/CMIP6/
-    if "badc/cmip6/data/CMIP6/" in base_path:
-        # form the path
-        path = base_path + "/*/" + model + "/" + experiment + "/*r*i*p*f*"
+    return experiment
 
-        # find the directory which matches the path
-        dirs = glob.glob(path)
-
-        # #print the directory which matches the path
-        #print("Directory: ", dirs)
-
-        # get the final element of the path
-        # which is the r*i*p*f* directory
-        final_dirs = [dirs.split("/")[-1] for dirs in dirs]
-
-        # #print the final directories
-        #print("Final directories: ", final_dirs)
-
-        # extract the number of runs
-        # as the substring between the characters 'r' and 'i'
-        runs = len(set([final_dirs.split("r")[1].split("i")[0] for final_dirs in final_dirs]))
+# Define a function to get the list of member labels used
+# for counting the runs, inits, physics and forcing
+# these can be passed to the get_* functions as members to share them
+# either as they are or parsed by parse_members
+# for badc these are the r*i*p*f* directories for the experiment
+# for canari these are taken from the files for the variable
+@profiled
+def get_member_labels(model, base_path, experiment, variable, index=None):
+    if "badc/cmip6/data/CMIP6/" in base_path:
+        if index is None:
+            index = build_drs_index(base_path, models=[model], experiments=[experiment], max_level="member")
 
-        # #print the number of runs
-        #print("Number of runs: ", runs)
+        members = get_index_members(index, model, experiment)
     elif "/gws/nopw/j04/canari/" in base_path:
-        # form the path
-        path = base_path + "/" + experiment + "/" + "data/" + variable + "/" + model + "/*r*i*p*f*"
-
-        # find the directory which matches the path
-        dirs = glob.glob(path)
+        if index is None:
+            index = build_drs_index(base_path, models=[model], experiments=[experiment], variables=[variable], stat_files=False)
 
-        # Check that the list of directories is not empty
-        if len(dirs) == 0:
-            print("No files available")
-            return None
-
-        # #print the directory which matches the path
-        #print("Directory: ", dirs)
-
-        # get the final element of the path
-        # which is the r*i*p*f* directory
-        final_dirs = [dirs.split("/")[-1] for dirs in dirs]
-
-        # #print the final directories
-        #print("Final directories: ", final_dirs)
-
-        # extract the number of runs
-        # as the substring between the characters 'r' and 'i'
-        # in psl_Amon_BCC-CSM2-MR_historical_r1i1p1f1_gn_185001-201412.nc
-        # first split the final_dirs on the character '_'
-        # then take the 4th element
-        split_final_dirs = [final_dirs.split("_")[4] for final_dirs in final_dirs]
-
-        # extract the number of runs
-        # as the substring between the characters 'r' and 'i'
-        runs = len(set([split_final_dirs.split("r")[1].split("i")[0] for split_final_dirs in split_final_dirs]))
-
-        # #print the number of runs
-        #print("Number of runs: ", runs)
+        members = get_index_members(index, model, experiment, variable=variable)
     else:
         print("Base path not recognized")
         return None
-    
-    return runs
-    
 
-# Define a similar function to get the number of initialisations
-def get_inits(model, base_path, experiment, variable):
-    if "badc/cmip6/data/CMIP6/" in base_path:
-        # form the path
-        path = base_path + "/*/" + model + "/" + experiment + "/*r*i*p*f*"
-
-        # find the directories which match the path
-        dirs = glob.glob(path)
-
-        # Check that the list of directories is not empty
-        if len(dirs) == 0:
-            print("No files available")
-            return None
+    return members
 
-        # get the final element of each directory path
-        final_dirs = [d.split("/")[-1] for d in dirs]
+# Define a function to get the number of runs for a given model
+# and experiment
+@profiled
+def get_runs(model, base_path, experiment, variable, index=None, members=None):
+    if members is None:
+        members = get_member_labels(model, base_path, experiment, variable, index=index)
+    if members is None:
+        return None
 
-        # extract the number of unique initializations
-        # as the substring between the characters 'i' and 'p'
-        inits = len(set([fd.split("i")[1].split("p")[0] for fd in final_dirs]))
-    elif "/gws/nopw/j04/canari/" in base_path:
-        # form the path
-        path = base_path + "/" + experiment + "/" + "data/" + variable + "/" + model + "/*r*i*p*f*"
+    # Check that the list of members is not empty
+    if "/gws/nopw/j04/canari/" in base_path and len(members) == 0:
+        print("No files available")
+        return None
 
-        # find the directories which match the path
-        dirs = glob.glob(path)
+    # count the number of unique realizations (r)
+    runs = parse_members(members)["realization"].nunique()
 
-        # Check that the list of directories is not empty
-        if len(dirs) == 0:
-            print("No files available")
-            return None
+    return runs
 
-        # get the final element of each directory path
-        final_dirs = [d.split("/")[-1] for d in dirs]
 
-        # extract the number of unique initializations
-        # as the substring between the characters 'i' and 'p'
-        # in psl_Amon_BCC-CSM2-MR_historical_r1i1p1f1_gn_185001-201412.nc
-        # first split the final_dirs on the character '_'
-        # then take the 3rd element
-        split_final_dirs = [fd.split("_")[4] for fd in final_dirs]
+# Define a similar function to get the number of initialisations
+@profiled
+def get_inits(model, base_path, experiment, variable, index=None, members=None):
+    if members is None:
+        members = get_member_labels(model, base_path, experiment, variable, index=index)
+    if members is None:
+        return None
 
-        # extract the number of unique initializations
-        # as the substring between the characters 'i' and 'p'
-        inits = len(set([sfd.split("i")[1].split("p")[0] for sfd in split_final_dirs]))
-    else:
-        print("Base path not recognized")
+    # Check that the list of members is not empty
+    if len(members) == 0:
+        print("No files available")
         return None
 
+    # count the number of unique initializations (i)
+    inits = parse_members(members)["initialization"].nunique()
+
     return inits
 
 # Define a function to get the number of physics forcings
-def get_physics(model, base_path, experiment, variable):
-    if "badc/cmip6/data/CMIP6/" in base_path:
-        # form the path
-        path = base_path + "/*/" + model + "/" + experiment + "/*r*i*p*f*"
-
-        # find the directories which match the path
-        dirs = glob.glob(path)
-
-        # Check that the list of directories is not empty
-        if len(dirs) == 0:
-            print("No files available")
-            return None
-
-        # get the final element of each directory path
-        final_dirs = [d.split("/")[-1] for d in dirs]
-
-        # extract the number of unique physics forcings
-        # as the substring between the characters 'p' and 'f'
-        physics = len(set([fd.split("p")[1].split("f")[0] for fd in final_dirs]))
-    elif "/gws/nopw/j04/canari/" in base_path:
-        # form the path
-        path = base_path + "/" + experiment + "/" + "data/" + variable + "/" + model + "/*r*i*p*f*"
-
-        # find the directories which match the path
-        dirs = glob.glob(path)
-
-        # Check that the list of directories is not empty
-        if len(dirs) == 0:
-            print("No files available")
-            return None
-
-        # get the final element of each directory path
-        final_dirs = [d.split("/")[-1] for d in dirs]
-
-        # extract the number of unique physics forcings
-        # as the substring between the characters 'p' and 'f'
-        # in psl_Amon_BCC-CSM2-MR_historical_r1i1p1f1_gn_185001-201412.nc
-        # first split the final_dirs on the character '_'
-        # then take the 5th element
-        split_final_dirs = [fd.split("_")[4] for fd in final_dirs]
+@profiled
+def get_physics(model, base_path, experiment, variable, index=None, members=None):
+    if members is None:
+        members = get_member_labels(model, base_path, experiment, variable, index=index)
+    if members is None:
+        return None
 
-        # extract the number of unique physics forcings
-        # as the substring between the characters 'p' and 'f'
-        physics = len(set([sfd.split("p")[1].split("f")[0] for sfd in split_final_dirs]))
-    else:
-        print("Base path not recognized")
+    # Check that the list of members is not empty
+    if len(members) == 0:
+        print("No files available")
         return None
 
+    # count the number of unique physics (p)
+    physics = parse_members(members)["physics"].nunique()
+
     return physics
 
 # For the forcing
-def get_forcing(model, base_path, experiment, variable):
-    # form the path
-    if "badc/cmip6/data/CMIP6/" in base_path:
-        path = base_path + "/*/" + model + "/" + experiment + "/*r*i*p*f*"
-
-        # find the directories which match the path
-        dirs = glob.glob(path)
-
-        # #print the directories which match the path
-        #print("Directories: ", dirs)
-
-        # get the final element of each directory path
-        final_dirs = [d.split("/")[-1] for d in dirs]
-
-        # #print the final directories
-        #print("Final directories: ", final_dirs)
-
-        # extract the number of unique forcing scenarios
-        # as the substring after the character 'f'
-        forcing = len(set([fd.split("f")[-1] for fd in final_dirs]))
-
-        # #print the number of forcing scenarios
-        #print("Number of forcing scenarios: ", forcing)
-    elif "/gws/nopw/j04/canari/" in base_path:
-        path = base_path + "/" + experiment + "/" + "data/" + variable + "/" + model + "/*r*i*p*f*"
-
-        # find the directories which match the path
-        dirs = glob.glob(path)
+@profiled
+def get_forcing(model, base_path, experiment, variable, index=None, members=None):
+    if members is None:
+        members = get_member_labels(model, base_path, experiment, variable, index=index)
+    if members is None:
+        return None
 
-        # Check that the list of directories is not empty
-        if len(dirs) == 0:
-            print("No files available")
-            return None
-        
-        # get the final element of each directory path
-        final_dirs = [d.split("/")[-1] for d in dirs]
+    # Check that the list of members is not empty
+    if "/gws/nopw/j04/canari/" in base_path and len(members) == 0:
+        print("No files available")
+        return None
 
-        # split the final_dirs on the character '_'
-        # then take the 5th element
-        split_final_dirs = [fd.split("_")[4] for fd in final_dirs]
+    # count the number of unique forcing scenarios (f)
+    forcing = parse_members(members)["forcing"].nunique()
 
-        # extract the number of unique forcing scenarios
-        # as the substring after the character 'f'
-        forcing = len(set([sfd.split("f")[-1] for sfd in split_final_dirs]))
-    else:
-        print("Base path not recognized")
-        return None
-    
     return forcing
 
 # Define a function to get the total number of ensemble members
-# this is the total number of directories which match the path
-def get_total_ensemble_members(model, base_path, experiment, variable):
-    
-    if "badc/cmip6/data/CMIP6/" in base_path:
-        # form the path
-        path = base_path + "/*/" + model + "/" + experiment + "/*r*i*p*f*"
-
-        # find the directories which match the path
-        dirs = glob.glob(path)
-
-        # #print the directories which match the path
-        #print("Directories: ", dirs)
-
-        # get the final element of each directory path
-        final_dirs = [d.split("/")[-1] for d in dirs]
-
-        # #print the final directories
-        #print("Final directories: ", final_dirs)
-
-        # extract the number of ensemble members
-        ensemble_members = len(final_dirs)
-
-        # #print the number of ensemble members
-        #print("Number of ensemble members: ", ensemble_members)
-    elif "/gws/nopw/j04/canari/" in base_path:
-        # form the path
-        path = base_path + "/" + experiment + "/" + "data/" + variable + "/" + model + "/*r*i*p*f*"
-
-        # find the directories which match the path
-        dirs = glob.glob(path)
-
-        # Check that the list of directories is not empty
-        if len(dirs) == 0:
-            print("No files available")
-            return None
-
-        # #print the directories which match the path
-        #print("Directories: ", dirs)
-
-        # get the final element of each directory path
-        final_dirs = [d.split("/")[-1] for d in dirs]
-
-        # split the final_dirs on the character '_'
-        # then take the 5th element
-        split_final_dirs = [fd.split("_")[4] for fd in final_dirs]
+# this is the total number of member directories (badc)
+# or the number of unique r*i*p*f* combinations (canari)
+@profiled
+def get_total_ensemble_members(model, base_path, experiment, variable, index=None, members=None):
+    if members is None:
+        members = get_member_labels(model, base_path, experiment, variable, index=index)
+    if members is None:
+        return None
 
-        # Count the number of unique r*i*p*f* combinations
-        ensemble_members = len(set(split_final_dirs))
-    else:
-        print("Base path not recognized")
+    # Check that the list of members is not empty
+    if "/gws/nopw/j04/canari/" in base_path and len(members) == 0:
+        print("No files available")
         return None
 
+    labels = parse_members(members)["member"]
+    ensemble_members = labels.nunique() if "/gws/nopw/j04/canari/" in base_path else len(labels)
+
     return ensemble_members
 
 # Define a function to get the table_id
 # such as Amon, Omon, SImon, day, fx, etc.
-# check that the table_id is the same for all ensemble members
 # function takes the model name and the base path and table_id = "Amon"
 # and returns the table_id
-def get_table_id(model, base_path, experiment, table_id, variable):
-    
-    if "badc/cmip6/data/CMIP6/" in base_path:
-        # Form the path
-        # # /badc/cmip6/data/CMIP6/CMIP/NCC/NorCPM1/historical/r1i1p1f1/Amon/psl/gn/files/d20190914
-        path = base_path + "/*/" + model + "/" + experiment + "/*r*i*p*f*/" + table_id
-
-        # find the directories which match the path
-        dirs = glob.glob(path)
+@profiled
+def get_table_id(model, base_path, experiment, table_id, variable, index=None):
 
-        # #print the first directory which matches the path
-        #print("First directory: ", dirs)
-        #print("no of directories: ", len(dirs))
+    if "badc/cmip6/data/CMIP6/" in base_path:
+        if index is None:
+            index = build_drs_index(base_path, models=[model], experiments=[experiment], table_ids=[table_id], max_level="table_id")
 
-        # if the dirs list is empty
-        # then the variable is not available
-        if len(dirs) == 0:
+        # if no members have the table_id
+        # then the table_id is not available
+        if len(get_index_members(index, model, experiment, table_id=table_id)) == 0:
             print("Table_id not available for model: ", model + " and experiment: ", experiment)
             first_table_id = table_id + " not available"
             return first_table_id
 
-        # Get the table_id from the path
-        first_table_id = dirs[0].split("/")[-1]
-
-        # #print the first table_id
-        #print("First table_id: ", first_table_id)
-
-        # Check that the table_id is the same for all ensemble members
-        for d in dirs:
-            if d.split("/")[-1] != first_table_id:
-                #print("Table_id is not the same for all ensemble members")
-                raise ValueError("Table_id is not the same for all ensemble members")
-                return None
-            
-        # #print the table_id
-        #print("Table_id: ", first_table_id)
+        first_table_id = table_id
 
     elif "/gws/nopw/j04/canari/" in base_path:
-        # Form the path
-        path = base_path + "/" + experiment + "/" + "data/" + variable + "/" + model + "/*" + table_id + "*r*i*p*f*"
+        if index is None:
+            index = build_drs_index(base_path, models=[model], experiments=[experiment], variables=[variable], stat_files=False)
 
-        # find the directories which match the path
-        dirs = glob.glob(path)
-
-        # if the dirs list is empty
-        # then the variable is not available
-        if len(dirs) == 0:
+        # if no files have the table_id
+        # then the table_id is not available
+        if len(get_index_members(index, model, experiment, table_id=table_id)) == 0:
             print("Table_id not available for model: ", model + " and experiment: ", experiment)
-            first_table_id = table_id + " not available"
 
         # Set the first table_id to the table_id
-        # as if the dirs list is not empty
-        # then the table_id is available
         first_table_id = table_id
     else:
         print("Base path not recognized")
@@ -418,41 +1004,403 @@ def get_table_id(model, base_path, experiment, table_id, variable):
 
     return first_table_id
 
+# Define a function to get the start and end years from a list of filenames
+# e.g. 185001-201412 (Amon), 19750101-19991231 (day)
+# or 185001010000-201412312100 (6hr)
+def get_filename_years(filenames):
+    parsed = parse_filenames(filenames)
+    years = pd.concat([parsed["start_year"], parsed["end_year"]]).dropna()
+
+    return [int(year) for year in years]
+
+# Define a function to read the header of a NetCDF file
+# and the first and last values of its time coordinate
+# without reading any of the data
+# returns a dictionary with the dims, the data variable's dtype and chunking,
+# and the calendar, number of times and first/last timestamps
+# error is set (and the rest missing) if the file cannot be read
+def read_netcdf_header(path):
+    header = { "path": path, "error": None }
+    try:
+        with netCDF4.Dataset(path) as ds:
+            header["dims"] = {name: len(dim) for name, dim in ds.dimensions.items()}
+
+            # the data variable is the one in the filename
+            # or else the one with the most dimensions
+            name = os.path.basename(path).split("_")[0]
+            if name not in ds.variables:
+                name = max(ds.variables, key=lambda v: len(ds.variables[v].dimensions))
+            variable = ds.variables[name]
+            header["variable"] = name
+            header["dtype"] = str(variable.dtype)
+            chunking = variable.chunking()
+            # None for the classic formats, which are not chunked
+            header["chunking"] = chunking if chunking is None or chunking == "contiguous" else [int(chunk) for chunk in chunking]
+
+            # only the first and last times are read
+            if "time" in ds.variables and ds.variables["time"].size > 0:
+                time = ds.variables["time"]
+                calendar = getattr(time, "calendar", "standard")
+                dates = netCDF4.num2date([time[0], time[-1]], time.units, calendar=calendar)
+                header["calendar"] = calendar
+                header["n_times"] = int(time.size)
+                header["time_first"] = dates[0].isoformat()
+                header["time_last"] = dates[1].isoformat()
+    except Exception as e:
+        header["error"] = type(e).__name__ + ": " + str(e)
+
+    return header
+
+# Define a function to stat a file
+# returns the error (rather than raising it) for a file which is missing
+# so that it is not retried as an unreachable file
+def stat_file(path):
+    try:
+        count_filesystem_call("stat")
+        return os.stat(path)
+    except (FileNotFoundError, NotADirectoryError, PermissionError) as e:
+        return e
+
+# Define a function to run a function over a list of files
+# returns a dictionary of path -> result (a dictionary which can be saved as JSON)
+# if a catalog is given the results are cached in its table keyed by
+# (path, size, mtime), so unchanged files are never reopened
+# the files which are not cached are read by a pool of max_workers processes
+# (processes, as the HDF5 library is not thread safe, see read_files_in_pool)
+# the files which cannot be stat'd get { "path": path, "error": ... }
+# with timeouts (see call_with_retries) the stats and the reads are given at most timeout seconds
+# and the files which do not answer get { "path": path, "error": ..., "unreachable": True }
+# and are recorded as unreachable, so a hung file does not hang the survey
+def map_files_cached(function, paths, table, catalog=None, max_workers=None, timeouts=None, mount_limits=None):
+    if catalog is not None:
+        with catalog_lock:
+            catalog.execute("CREATE TABLE IF NOT EXISTS " + table + " (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, result TEXT)")
+
+    results = {}
+    to_read = []
+    for path in paths:
+        if timeouts is None:
+            stat = stat_file(path)
+        else:
+            reached, stat = call_with_retries(stat_file, path, timeouts, mount_limits)
+            if not reached:
+                results[path] = { "path": path, "error": "Unreachable: " + stat, "unreachable": True }
+                continue
+        if isinstance(stat, OSError):
+            results[path] = { "path": path, "error": type(stat).__name__ + ": " + str(stat) }
+            continue
+
+        if catalog is not None:
+            with catalog_lock:
+                row = catalog.execute("SELECT * FROM " + table + " WHERE path = ? AND size = ? AND mtime_ns = ?", (path, stat.st_size, stat.st_mtime_ns)).fetchone()
+            if row is not None:
+                results[path] = json.loads(row[3])
+                continue
+
+        to_read.append((path, stat))
+
+    # read the files which are not cached
+    count_filesystem_call("open", len(to_read))
+    if max_workers is None or max_workers <= 1 or len(to_read) <= 1:
+        if timeouts is None:
+            read = [function(path) for path, stat in to_read]
+        else:
+            read = [call_with_retries(function, path, timeouts, mount_limits) for path, stat in to_read]
+            read = [result if reached else { "path": path, "error": "Unreachable: " + result, "unreachable": True } for (path, stat), (reached, result) in zip(to_read, read)]
+    else:
+        read = read_files_in_pool(function, [path for path, stat in to_read], max_workers, timeouts, mount_limits)
+
+    for (path, stat), result in zip(to_read, read):
+        results[path] = result
+        # the files which did not answer are read again next time
+        if result.get("unreachable"):
+            continue
+        if catalog is not None:
+            with catalog_lock:
+                catalog.execute("INSERT OR REPLACE INTO " + table + " VALUES (?, ?, ?, ?)", (path, stat.st_size, stat.st_mtime_ns, json.dumps(result)))
+
+    if catalog is not None:
+        with catalog_lock:
+            catalog.commit()
+
+    return results
+
+# Define a function to get the process id of a pool worker, after a short wait
+# so that each of the workers of a new pool gets one (see start_pool_workers)
+def get_worker_pid(delay):
+    time.sleep(delay)
+    return os.getpid()
+
+# Define a function to wait for the processes of a new pool to start
+# spawned processes import this module, which takes a few seconds
+# so that the start up is not counted in the timeouts of the files
+def start_pool_workers(pool, max_workers):
+    pids = set()
+    for attempt in range(10):
+        pids.update(pool.map(get_worker_pid, [0.05] * max_workers))
+        if len(pids) >= max_workers:
+            return
+
+# Define a function to run a function over a list of files in a pool of max_workers processes
+# with timeouts each result is waited for at most timeout seconds once the ones before it are done
+# (so a file is given at least that long), and the files which do not answer are recorded
+# as unreachable, and the processes stuck on them are stopped, rather than waited for
+# the processes are spawned, as a fork would copy the locks held by the listing threads
+# (and the threads left behind by call_with_timeout) and could deadlock
+# so scripts calling it need an if __name__ == "__main__" guard
+# returns the results in the same order as the paths
+def read_files_in_pool(function, paths, max_workers, timeouts=None, mount_limits=None):
+    max_workers = min(max_workers, len(paths))
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+    stuck = False
+    try:
+        if timeouts is None:
+            return list(pool.map(function, paths, chunksize=16))
+
+        start_pool_workers(pool, max_workers)
+        futures = [pool.submit(function, path) for path in paths]
+        timeout = dict(default_timeouts, **timeouts)["timeout"]
+        read = []
+        for path, future in zip(paths, futures):
+            try:
+                read.append(future.result(timeout=timeout))
+            except (TimeoutError, concurrent.futures.process.BrokenProcessPool):
+                stuck = True
+                record_unreachable(path, "timeout", get_mount(path, mount_limits), timeout, timeouts=1)
+                read.append({ "path": path, "error": "Unreachable: timeout", "unreachable": True })
+        return read
+    finally:
+        if stuck:
+            # a process blocked on a hung file cannot finish, so it is not waited for
+            for process in list(pool._processes.values()):
+                process.terminate()
+        pool.shutdown(wait=not stuck, cancel_futures=True)
+
+# Define a function to get the headers of a list of NetCDF files
+# returns a dictionary of path -> header (see read_netcdf_header)
+# cached in the catalog and read by a pool of max_workers processes (see map_files_cached)
+def get_file_headers(paths, catalog=None, max_workers=None, timeouts=None, mount_limits=None):
+    return map_files_cached(read_netcdf_header, paths, "file_headers", catalog=catalog, max_workers=max_workers, timeouts=timeouts, mount_limits=mount_limits)
+
+# The magic bytes at the start of the NetCDF classic formats
+# CDF1 (classic), CDF2 (64-bit offset) and CDF5 (64-bit data)
+netcdf_magic = [ b"CDF\x01", b"CDF\x02", b"CDF\x05" ]
+
+# The signature of the HDF5 superblock, for NetCDF4 files
+hdf5_magic = b"\x89HDF\r\n\x1a\n"
+
+# The sizes in bytes of the NetCDF classic types, by their nc_type number
+classic_type_sizes = { 1: 1, 2: 1, 3: 2, 4: 4, 5: 4, 6: 8, 7: 1, 8: 2, 9: 4, 10: 8, 11: 8 }
+
+# Define a function to get the size which a NetCDF classic file should have
+# from its header (after the magic bytes), i.e. the end of the last variable's data
+# version is the last magic byte: 1 (32 bit offsets), 2 (64 bit offsets) or 5 (CDF-5)
+# returns None if the number of records is not known (a file being written)
+# raises a struct.error if the header is cut short
+def get_classic_netcdf_size(f, version):
+    count_format = ">Q" if version == 5 else ">I"
+    offset_format = ">I" if version == 1 else ">Q"
+
+    def read(fmt):
+        return struct.unpack(fmt, f.read(struct.calcsize(fmt)))[0]
+
+    def skip_name():
+        length = read(count_format)
+        f.seek((length + 3) // 4 * 4, os.SEEK_CUR)
+
+    def skip_attributes():
+        tag, n = read(">I"), read(count_format)
+        for i in range(n):
+            skip_name()
+            nc_type, length = read(">I"), read(count_format)
+            f.seek((length * classic_type_sizes[nc_type] + 3) // 4 * 4, os.SEEK_CUR)
+
+    n_records = read(count_format)
+    if n_records == 2 ** (8 * struct.calcsize(count_format)) - 1:
+        return None
+
+    # the dimension lengths (0 for the record dimension)
+    tag, n = read(">I"), read(count_format)
+    lengths = []
+    for i in range(n):
+        skip_name()
+        lengths.append(read(count_format))
+
+    skip_attributes()
+
+    # the start and size (per record, for the record variables) of each variable
+    tag, n = read(">I"), read(count_format)
+    variables = []
+    for i in range(n):
+        skip_name()
+        dims = [read(count_format) for j in range(read(count_format))]
+        skip_attributes()
+        nc_type = read(">I")
+        read(count_format)
+        begin = read(offset_format)
+        is_record = len(dims) > 0 and lengths[dims[0]] == 0
+        shape = [lengths[dim] for dim in (dims[1:] if is_record else dims)]
+        variables.append((begin, int(np.prod(shape, dtype=np.int64)) * classic_type_sizes[nc_type], is_record))
+
+    # the records hold each record variable in turn, padded to 4 bytes
+    # unless there is only one record variable
+    record_sizes = [size for begin, size, is_record in variables if is_record]
+    record_size = record_sizes[0] if len(record_sizes) == 1 else sum((size + 3) // 4 * 4 for size in record_sizes)
+
+    ends = [begin + ((n_records - 1) * record_size + size if is_record else size) for begin, size, is_record in variables if not is_record or n_records > 0]
+    return max(ends, default=0)
+
+# Define a function to check the magic bytes of a NetCDF file
+# and that the file is as long as its HDF5 superblock (NetCDF4)
+# or its header (the classic formats) says
+# returns "ok", "bad_magic" or "truncated"
+def check_netcdf_magic(path, size):
+    with open(path, "rb") as f:
+        magic = f.read(4)
+        if magic in netcdf_magic:
+            try:
+                expected_size = get_classic_netcdf_size(f, magic[3])
+            except (struct.error, KeyError, IndexError):
+                return "truncated"
+            return "truncated" if expected_size is not None and expected_size > size else "ok"
+
+        # the HDF5 superblock is at 0, or after a user block of 512, 1024, 2048... bytes
+        offset = 0
+        while offset + 8 <= size:
+            f.seek(offset)
+            if f.read(8) == hdf5_magic:
+                break
+            offset = 512 if offset == 0 else offset * 2
+        else:
+            return "bad_magic"
+
+        # the base and end of file addresses in the superblock
+        # after 24 (version 0), 28 (version 1) or 12 (versions 2 and 3) bytes
+        header = f.read(8)
+        if len(header) < 8:
+            return "truncated"
+        version = header[0]
+        if version in (0, 1):
+            size_of_offsets = header[5]
+            f.seek(offset + (24 if version == 0 else 28))
+        else:
+            size_of_offsets = header[1]
+            f.seek(offset + 12)
+        addresses = f.read(3 * size_of_offsets)
+        if len(addresses) < 3 * size_of_offsets:
+            return "truncated"
+
+        base_address = int.from_bytes(addresses[:size_of_offsets], "little")
+        end_of_file = int.from_bytes(addresses[2 * size_of_offsets:], "little")
+        if base_address + end_of_file > size:
+            return "truncated"
+
+    return "ok"
+
+# Define a function to check that a NetCDF file can be used
+# the status is "empty", "bad_magic", "truncated" (see check_netcdf_magic),
+# "unreadable" if the header cannot be read, and with check_time
+# "bad_time" if the time coordinate cannot be read or is not increasing
+# returns a dictionary with the path, size, status and error
+def validate_netcdf_file(path, check_time=False):
+    result = { "path": path, "size": None, "status": "ok", "error": None }
+    try:
+        result["size"] = os.path.getsize(path)
+        if result["size"] == 0:
+            result["status"] = "empty"
+            return result
+
+        result["status"] = check_netcdf_magic(path, result["size"])
+        if result["status"] != "ok":
+            return result
+
+        with netCDF4.Dataset(path) as ds:
+            if check_time and "time" in ds.variables:
+                try:
+                    time = ds.variables["time"]
+                    values = np.ma.getdata(time[:]).ravel()
+                    if np.ma.is_masked(time[:]) or np.any(np.diff(values) <= 0):
+                        result["status"] = "bad_time"
+                        result["error"] = "time is missing or not increasing"
+                    elif values.size > 0:
+                        netCDF4.num2date(values[[0, -1]], time.units, calendar=getattr(time, "calendar", "standard"))
+                except Exception as e:
+                    result["status"] = "bad_time"
+                    result["error"] = type(e).__name__ + ": " + str(e)
+    except Exception as e:
+        result["status"] = "unreadable"
+        result["error"] = type(e).__name__ + ": " + str(e)
+
+    return result
+
+# Define a function to check that a NetCDF file can be used, with check_time
+# (a function, rather than a lambda, so that it can be sent to the process pool)
+def validate_netcdf_file_time(path):
+    return validate_netcdf_file(path, check_time=True)
+
+# Define a function to check a list of NetCDF files
+# returns a dictionary of path -> result (see validate_netcdf_file)
+# cached in the catalog and checked by a pool of max_workers processes (see map_files_cached)
+# check_time also reads the time coordinates, which is slower
+# with timeouts (see map_files_cached) the files which do not answer are "unreachable"
+def validate_files(paths, catalog=None, max_workers=None, check_time=False, timeouts=None, mount_limits=None):
+    if check_time:
+        results = map_files_cached(validate_netcdf_file_time, paths, "file_checks_time", catalog=catalog, max_workers=max_workers, timeouts=timeouts, mount_limits=mount_limits)
+    else:
+        results = map_files_cached(validate_netcdf_file, paths, "file_checks", catalog=catalog, max_workers=max_workers, timeouts=timeouts, mount_limits=mount_limits)
+
+    # the files which could not be stat'd (or did not answer)
+    for result in results.values():
+        result.setdefault("status", "unreachable" if result.get("unreachable") else "missing")
+
+    return results
+
+# Define a function to get the start and end years of the files
+# for a given model, experiment, table_id and variable from their headers
+# the files without a header which could be read use the time range in their filename
+# returns an empty list if there are no headers (or no index)
+def get_header_years(index, base_path, model, experiment, table_id, variable, headers):
+    if headers is None or index is None:
+        return []
+
+    years = []
+    for path in get_index_file_paths(index, base_path, model, experiment, table_id, variable):
+        header = headers.get(path)
+        if header is not None and header.get("time_first") is not None:
+            years.extend([int(header["time_first"][:4]), int(header["time_last"][:4])])
+        else:
+            years.extend(get_filename_years([os.path.basename(path)]))
+
+    return years
+
 # define a function to extract the years
 # using different methods for different experiments
-def get_years(model, base_path, experiment, table_id, variable):
-    
+# files_list can be given to reuse the output of get_files
+# headers from get_file_headers can be given to use the time coordinates
+# in the files instead of the time ranges in the filenames
+@profiled
+def get_years(model, base_path, experiment, table_id, variable, index=None, files_list=None, headers=None):
+
     if "badc/cmip6/data/CMIP6/" in base_path:
         print("Looking for data on JASMIN badc path")
         if experiment == 'dcppA-hindcast':
-            
-            # set up the path
-            path = base_path + "/*/" + model + "/" + experiment + "/s????-r*i*p*f*/" + table_id + "/" + variable + "/" + "g?" + "/" + "files" + "/" + "d*" + "/"
+            if index is None:
+                index = build_drs_index(base_path, models=[model], experiments=[experiment], table_ids=[table_id], variables=[variable], stat_files=False)
 
-            # find the directories which match the path
-            dirs = glob.glob(path)
+            # find the version directories for the variable
+            versions = get_index_versions(index, model, experiment, table_id, variable)
 
             # Check that the list of directories is not empty
-            if len(dirs) == 0:
+            if len(versions) == 0:
                 print("No files available")
                 return None
-            
-            # extract the min and max years from the directory paths
-            years_init_dirs = [d.split("/")[-7] for d in dirs]
-            # print("years_init_dirs: ", years_init_dirs)
-
-            # extract the min and max years from the years_init_dirs
-            # as the substring between the characters 's' and 'r'
-            years = [yid.split("s")[1].split("r")[0] for yid in years_init_dirs]
-            # ensure that each element in the years list is an integer
-            # currently 1960-
-            # get rid of the -
-            years = [y.split("-")[0] for y in years] 
-            # print("years: ", years)
+
+            # extract the init years from the s????-r*i*p*f* members
+            years = parse_members([member for member, grid, version, files in versions])["init_year"].dropna()
 
             # find the min and max years
-            min_year = min(years)
-            max_year = max(years)
+            min_year = str(years.min())
+            max_year = str(years.max())
 
             # form the range of years
             # e.g 1960-1970
@@ -460,43 +1408,19 @@ def get_years(model, base_path, experiment, table_id, variable):
 
         elif experiment == 'historical':
             # get the list of files in the final directory
-            files_list = get_files(model, base_path, experiment, table_id, variable)
+            if files_list is None:
+                files_list = get_files(model, base_path, experiment, table_id, variable, index=index)
             # Check that the list of files is not empty
             if len(files_list) == 0:
                 print("No files available")
                 years_range = "No files"
                 return years_range
-            
-            # extract the years from the filenames
-            # initialize the years list
-            years = []
-            if table_id == "Amon":
-                for file in files_list:
-                    year_str = re.findall(r'\d{4}', file)
-                    if len(year_str) == 2:
-                        years.append(year_str)
-            elif table_id == "day":
-                # format 19750101-19991231
-                for file in files_list:
-                    year_str = re.findall(r'\d{8}', file)
-                    if len(year_str) == 2:
-                        years.extend([year_str[0][:4], year_str[1][:4]])
-            elif table_id == "6hr":
-                # format 185001010000-201412312100
-                for file in files_list:
-                    year_str = re.findall(r'\d{12}', file)
-                    if len(year_str) == 2:
-                        years.extend([year_str[0][:4], year_str[1][:4]])
-
-            # flatten the list of year strings
-            years = [year for sublist in years for year in sublist]
-            
-            # convert the list of strings to a list of integers
-            years = list(map(int, years))
-
-            # print("years: ", years)
-            # print("len(years): ", len(years))
-            # print("type(years): ", type(years))
+
+            # extract the years from the file headers, or the filenames
+            # (of each file without a header, or of all the files without headers)
+            years = get_header_years(index, base_path, model, experiment, table_id, variable, headers)
+            if len(years) == 0:
+                years = get_filename_years(files_list)
 
             # find the min and max years
             min_year = min(years)
@@ -511,41 +1435,22 @@ def get_years(model, base_path, experiment, table_id, variable):
     elif "/gws/nopw/j04/canari/" in base_path:
         print("Looking for data in canari GWS path")
 
-        # form the path
-        path = base_path + "/" + experiment + "/" + "data/" + variable + "/" + model + "/*" + table_id + "*r*i*p*f*"
+        # get the list of files for the table_id and variable
+        if files_list is None:
+            files_list = get_files(model, base_path, experiment, table_id, variable, index=index)
 
-        # find the directories which match the path
-        dirs = glob.glob(path)
-
-        # Check that the list of directories is not empty
-        if len(dirs) == 0:
+        # Check that the list of files is not empty
+        if len(files_list) == 0:
             print("No files available")
             years_range = "No files"
             return years_range
-        
-        # get the final element of the directory path
-        final_dirs = [d.split("/")[-1] for d in dirs]
 
-        # split the final_dirs on the character '_' and take the 4th element
+        # extract the years from the file headers, or the time ranges in the filenames
+        # (of each file without a header, or of all the files without headers)
         # e.g. psl_Amon_BCC-CSM2-MR_historical_r1i1p1f1_gn_185001-201412.nc
-        # then take the 7th element
-        split_final_dirs = [fd.split("_")[6] for fd in final_dirs]
-
-        # extract the min and max years from the split_final_dirs
-        years = []
-        for fd in split_final_dirs:
-            if table_id == "Amon":
-                year_str = re.findall(r'\d{4}', fd)
-                if len(year_str) == 2:
-                    years.extend(year_str)
-            elif table_id == "day":
-                year_str = re.findall(r'\d{8}', fd)
-                if len(year_str) == 2:
-                    years.extend([year_str[0][:4], year_str[1][:4]])
-            elif table_id == "6hr":
-                year_str = re.findall(r'\d{12}', fd)
-                if len(year_str) == 2:
-                    years.extend([year_str[0][:4], year_str[1][:4]])
+        years = get_header_years(index, base_path, model, experiment, table_id, variable, headers)
+        if len(years) == 0:
+            years = get_filename_years(files_list)
 
         # find the min and max years
         min_year = min(years)
@@ -553,19 +1458,20 @@ def get_years(model, base_path, experiment, table_id, variable):
 
         # form the range of years
         # e.g 1850-2014
-        years_range = min_year + "-" + max_year
+        years_range = str(min_year) + "-" + str(max_year)
     else:
         print("Base path not recognized")
         return None
 
     # return the list of years
-    return years_range    
+    return years_range
 
 
 # Write a new function which gets the datasource
 # from the path
+@profiled
 def get_datasource(base_path):
-    
+
     if "badc/cmip6/data/CMIP6/" in base_path:
         datasource = "badc"
     elif "/gws/nopw/j04/canari/" in base_path:
@@ -573,386 +1479,1850 @@ def get_datasource(base_path):
     else:
         print("Base path not recognized")
         return None
-    
+
     return datasource
 
 # Define a function to get the variable name
 # such as psl, tas, tos, rsds, sfcWind, etc.
-# check that the variable is the same for all ensemble members
 # function takes the model name and the base path and the experiment name and table_id and variable name
-# and returns the variable name
-def get_variable(model, base_path, experiment, table_id, variable):
-    
-    if "badc/cmip6/data/CMIP6/" in base_path:
-        # Form the path
-        # based on /badc/cmip6/data/CMIP6/CMIP/NCC/NorCPM1/historical/r1i1p1f1/Amon/psl/gn/files/d20190914
-        path = base_path + "/*/" + model + "/" + experiment + "/*r*i*p*f*/" + table_id + "/" + variable
-
-        # path for the runs directory
-        path_runs_dir = base_path + "/*/" + model + "/" + experiment + "/r*i*p*f*"
+# and returns the variable name, the number of members and the list of members
+@profiled
+def get_variable(model, base_path, experiment, table_id, variable, index=None):
 
-        # find the directories which match the path
-        dirs = glob.glob(path)
-
-        # if the dirs list is empty
-        # then the variable is not available
-        if len(dirs) == 0:
-            #print("Variable not available")
-
-            # Set up output for variable not available
-            first_variable = variable
-            no_members = 0
-            members_list = []
-            return first_variable, no_members, members_list
-
-        # find the directories which match the path for the runs directory
-        dirs_runs_dir = glob.glob(path_runs_dir)
-
-        # #print the directories which match the path
-        #print("Directories: ", dirs)
-
-        # set the number of members available
-        # i.e. the number of directories which match the path
-        no_members = len(dirs)
-        #print("Number of members: ", no_members)
+    if "badc/cmip6/data/CMIP6/" in base_path:
+        if index is None:
+            index = build_drs_index(base_path, models=[model], experiments=[experiment], table_ids=[table_id], variables=[variable], max_level="variable")
 
-        # extract the r*i*p*f* directory from the path
-        # which is the third from last element
+        # the r*i*p*f* directories which have the variable
         # e.g. r1i1p1f1
-        members_list = [dirs.split("/")[-3] for dirs in dirs]
-        #print("Members list: ", members_list)
-
-        # Get the variable name from the first directory
-        first_variable = dirs[0].split("/")[-1]
+        members_list = get_index_members(index, model, experiment, table_id=table_id, variable=variable)
 
-        # #print the first variable
-        #print("First variable: ", first_variable)
+        # set the number of members available
+        no_members = len(members_list)
 
-        # Check whether the lens of the dirs for the runs directory is the same as the lens of the dirs for the variable
-        if len(dirs_runs_dir) != len(dirs):
+        # Check whether all the runs have the variable
+        no_runs = len(get_index_members(index, model, experiment))
+        if no_members != 0 and no_runs != no_members:
             print("Not all runs are available for the variable")
-            print("Number of runs available for the runs directory: ", len(dirs_runs_dir))
-            print("Number of runs available for the variable: ", len(dirs))
+            print("Number of runs available for the runs directory: ", no_runs)
+            print("Number of runs available for the variable: ", no_members)
 
-        # #print the variable
-        #print("Variable: ", first_variable)
     elif "/gws/nopw/j04/canari/" in base_path:
-        # form the path
-        path = base_path + "/" + experiment + "/" + "data/" + variable + "/" + model + "/" + variable + "_" + table_id + "*r*i*p*f*"
-
-        # find the directories which match the path
-        dirs = glob.glob(path)
-
-        # if the dirs list is empty
-        # then the variable is not available
-        if len(dirs) == 0:
-
-            # Set up output for variable not available
-            first_variable = variable
-            no_members = 0
-            members_list = []
-            return first_variable, no_members, members_list
-        
-        # get the number of members available
-        # i.e. the number of directories which match the path with unique r*i*p*f* combinations
-        # e.g. psl_Amon_BCC-CSM2-MR_historical_r1i1p1f1_gn_185001-201412.nc
-        # first split the dirs and take the final element
-        final_dirs = [dirs.split("/")[-1] for dirs in dirs]
+        if index is None:
+            index = build_drs_index(base_path, models=[model], experiments=[experiment], variables=[variable], stat_files=False)
 
-        members_list = [final_dirs.split("_")[4] for final_dirs in final_dirs]
-
-        # split the final_dirs on the character '_'
-        # then take the 4th element
-        split_final_dirs = [fd.split("_")[4] for fd in final_dirs]
+        # get the members from the files for the table_id and variable
+        # one entry per file
+        # e.g. psl_Amon_BCC-CSM2-MR_historical_r1i1p1f1_gn_185001-201412.nc
+        versions = get_index_versions(index, model, experiment, table_id, variable)
+        members_list = [member for member, grid, version, files in versions for f in sorted(files)]
 
         # Count the number of unique r*i*p*f* combinations
-        no_members = len(set(split_final_dirs))
-
-        # Get the variable name from the first directory
-        first_variable = variable
+        no_members = len(set(members_list))
 
     else:
         print("Base path not recognized")
         return None
 
-    return first_variable, no_members, members_list
+    return variable, no_members, members_list
 
 # Define a function to get the list of files for a given model, experiment, table_id, variable
 # in the final directory
-def get_files(model, base_path, experiment, table_id, variable):
-    
-    if "badc/cmip6/data/CMIP6/" in base_path:
-        # Form the path
-        path = base_path + "/*/" + model + "/" + experiment + "/*r*i*p*f*/" + table_id + "/" + variable + "/" + "g?" + "/" + "files" + "/" + "d*" + "/"
-        # print("Path: ", path)
+# scan_options are passed on to build_drs_index, e.g. use_asyncio=True
+@profiled
+def get_files(model, base_path, experiment, table_id, variable, index=None, **scan_options):
+
+    if get_datasource(base_path) is None:
+        return None
 
-        # find the directories which match the path
-        dirs = glob.glob(path)
+    if index is None:
+        index = build_drs_index(base_path, models=[model], experiments=[experiment], table_ids=[table_id], variables=[variable], stat_files=False, **scan_options)
 
-        # Check that the list of directories is not empty
-        if len(dirs) == 0:
-            print("No files available")
-            files_list = []
-            return files_list
-        
-        # # print the directories which match the path
-        # print("Directories: ", dirs)
-
-        # get a list of the files in the final directory
-        files_list = []
-        for d in dirs:
-            files_list.extend(glob.glob(os.path.join(d, "*")))
-
-        # # print the files in the final directory
-        # print("Files list: ", files_list)
-
-        # extract the final element following the last "/"
-        # from each file in the files_list
-        files_list = [f.split("/")[-1] for f in files_list]
-
-        # # print the files in the final directory
-        # print("Files list final dir: ", files_list)
-    
-    elif "/gws/nopw/j04/canari/" in base_path:
+    # get the files in the version directories
+    # for canari these are the files for the variable and table_id
+    versions = get_index_versions(index, model, experiment, table_id, variable)
+    files_list = [f for member, grid, version, files in versions for f in sorted(files)]
 
-        # # print the inputs to the function
-        # print("Model: ", model)
-        # print("Experiment: ", experiment)
-        # print("Table_id: ", table_id)
-        # print("Variable: ", variable)
+    # Check that the list of files is not empty
+    if len(files_list) == 0:
+        print("No files available")
 
-        # form the path
-        path = base_path + "/" + experiment + "/" + "data/" + variable + "/" + model + "/" + variable + "_" + table_id + "*r*i*p*f*"
+    return files_list
 
-        # find the directories which match the path
-        dirs = glob.glob(path)
+# Define a new function which will count how many empty files there are
+# in the final directory
+# scan_options are passed on to build_drs_index, e.g. use_asyncio=True
+@profiled
+def get_empty_files(model, base_path, experiment, table_id, variable, index=None, **scan_options):
 
-        # print the directories which match the path
-        # print("Directories: ", dirs)
+    if "badc/cmip6/data/CMIP6/" in base_path:
+        if index is None:
+            index = build_drs_index(base_path, models=[model], experiments=[experiment], table_ids=[table_id], variables=[variable], **scan_options)
 
-        # Check that the list of directories is not empty
-        if len(dirs) == 0:
-            print("No files available")
-            files_list = []
-            return files_list
-        
-        # get a list of the files in the final directory
-        files_list = []
-        for d in dirs:
-            # print("d: ", d)
-            files_list =[d.split("/")[-1] for d in dirs]
+        # the version directories for the variable
+        versions = get_index_versions(index, model, experiment, table_id, variable)
 
-        # print("Files list: ", files_list)
+    elif "/gws/nopw/j04/canari/" in base_path:
+        if index is None:
+            index = build_drs_index(base_path, models=[model], experiments=[experiment], variables=[variable], **scan_options)
+
+        # all the files for the variable, whatever the table_id
+        tables = set()
+        for node in get_index_experiments(index, model, experiment):
+            for member in node:
+                tables.update(node[member])
 
-        # # extract the final element following the last "/"
-        # # from each file in the files_list
-        # files_list = [f.split("/")[-1] for f in files_list]
+        versions = []
+        for table in sorted(tables):
+            versions.extend(get_index_versions(index, model, experiment, table, variable))
 
     else:
         print("Base path not recognized")
         return None
 
-    return files_list
-
-# Define a new function which will count how many empty files there are
-# in the final directory
-def get_empty_files(model, base_path, experiment, table_id, variable):
+    # Check that the list of directories is not empty
+    if len(versions) == 0:
+        #print("No files available")
+        return None
 
-    # if the data is available on JASMIN
-    if "badc/cmip6/data/CMIP6/" in base_path:
-        # Form the path
-        path = base_path + "/*/" + model + "/" + experiment + "/*r*i*p*f*/" + table_id + "/" + variable + "/" + "g?" + "/" + "files" + "/" + "d*" + "/"
+    # check how many files are empty in the final directory
+    empty_files = 0
+    for member, grid, version, files in versions:
+        empty_files += sum(1 for size in files.values() if size == 0)
 
-        # find the directories which match the path
-        dirs = [d for d in glob.glob(path) if os.path.isdir(d)]
+    print("Number of empty files: ", empty_files)
 
-        # Check that the list of directories is not empty
-        if len(dirs) == 0:
-            #print("No files available")
-            return None
+    return empty_files
 
-        # check how many files are empty in the final directory
-        empty_files = 0
-        for directory in dirs:
-            files = os.listdir(directory)
-            for file in files:
-                file_path = os.path.join(directory, file)
-                if os.path.isfile(file_path) and os.path.getsize(file_path) == 0:
-                    empty_files += 1
-    
-        print("Number of empty files: ", empty_files)
+# Define a function to get the superseded versions
+# for a given model, experiment, table_id and variable
+# i.e. the badc version directories which were not listed as there is a later (or pinned) version
+# returns a list of "member/grid/version" strings, empty for canari
+@profiled
+def get_superseded_versions(model, base_path, experiment, table_id, variable, index=None, **scan_options):
+    if "badc/cmip6/data/CMIP6/" in base_path:
+        if index is None:
+            index = build_drs_index(base_path, models=[model], experiments=[experiment], table_ids=[table_id], variables=[variable], stat_files=False, **scan_options)
 
+        versions = get_index_versions(index, model, experiment, table_id, variable, superseded=True)
+        return [member + "/" + grid + "/" + version for member, grid, version, files in versions]
     elif "/gws/nopw/j04/canari/" in base_path:
+        return []
+    else:
+        print("Base path not recognized")
+        return None
 
-        # form the path
-        path = base_path + "/" + experiment + "/" + "data/" + variable + "/" + model + "/"
+# The time step of the sub-daily tables in minutes
+# used to find the end of the last time step in a file
+# e.g. a 6hr file ending 201412311800 covers up to 201501010000
+table_steps = { "6hr": 360, "6hrLev": 360, "6hrPlev": 360, "6hrPlevPt": 360, "3hr": 180, "E3hr": 180, "1hr": 60, "E1hr": 60 }
+
+# The calendars which numpy's datetimes follow
+standard_calendars = [ "standard", "gregorian", "proleptic_gregorian" ]
+
+# Define a function to guess the calendar of the files from the end dates in their filenames
+# for the files without headers, e.g. the HadGEM3 daily files end on 18501230
+# returns "360_day" if a daily end date is on the 30th of a 31 day month
+# (or on 30 February) and none are on a 31st, else "standard"
+def guess_filename_calendar(ends):
+    days = [(int(date[4:6]), int(date[6:8])) for date in ends if isinstance(date, str) and len(date) >= 8 and date[:8].isdigit()]
+    if any(day == 31 for month, day in days):
+        return "standard"
+    if any(day == 30 and month in (1, 2, 3, 5, 7, 8, 10, 12) for month, day in days):
+        return "360_day"
+    return "standard"
+
+# Define a function to move a date in a filename on by a number of minutes in a calendar
+# e.g. 18501230 on by a day is 18510101 in a 360_day calendar
+# returns the date as YYYYMMDDhhmm, or None if it is not a date in the calendar
+def add_calendar_minutes(date, minutes, calendar):
+    try:
+        moved = cftime.datetime(int(date[0:4]), int(date[4:6] or 1), int(date[6:8] or 1), int(date[8:10] or 0), int(date[10:12] or 0), calendar=calendar) + datetime.timedelta(minutes=minutes)
+    except ValueError:
+        return None
 
-        # find the directories which match the path
-        dirs = [d for d in glob.glob(path) if os.path.isdir(d)]
+    return "%04d%02d%02d%02d%02d" % (moved.year, moved.month, moved.day, moved.hour, moved.minute)
+
+# Define a function to get the time span of each file from its filename
+# returns the members and the starts and ends of the files as numpy arrays
+# the end is the end of the last time step, so a file ending 201412
+# covers up to 201501 and the next file should start there
+# calendar is the calendar of the files (e.g. from their headers)
+# and is guessed from the filenames if it is not given (see guess_filename_calendar)
+# the ends of the daily and sub-daily files are moved on in that calendar
+# so e.g. a 360_day file ending 18501230 is followed by one starting 18510101
+# files without a time range (or with dates which cannot be parsed) have NaT
+def get_file_intervals(filenames, table_id=None, calendar=None):
+    matches = [filename_regex.match(filename) for filename in filenames]
+    members = np.array([match.group("member") if match is not None else None for match in matches], dtype=object)
+    starts = [match.group("start") if match is not None else None for match in matches]
+    ends = [match.group("end") if match is not None else None for match in matches]
+
+    start = parse_filename_dates(starts)
+    end = parse_filename_dates(ends)
+
+    # move the ends on by the precision of the dates in the filenames
+    lengths = np.array([len(date) if date is not None else 0 for date in ends], dtype=int)
+    years, months, days, times = lengths == 4, lengths == 6, lengths == 8, lengths >= 10
+    end[years] = (end[years].astype("datetime64[Y]") + 1).astype("datetime64[m]")
+    end[months] = (end[months].astype("datetime64[M]") + 1).astype("datetime64[m]")
+
+    if calendar is None:
+        calendar = guess_filename_calendar(ends)
+    if calendar in standard_calendars:
+        end[days] = end[days] + np.timedelta64(1, "D")
+        end[times] = end[times] + np.timedelta64(table_steps.get(table_id, 60), "m")
+    else:
+        # the last day (or time step) of a month depends on the calendar
+        moved = np.flatnonzero(days | times)
+        steps = np.where(days[moved], 1440, table_steps.get(table_id, 60))
+        end[moved] = parse_filename_dates([add_calendar_minutes(ends[i], int(step), calendar) for i, step in zip(moved, steps)])
+
+    return members, start, end
+
+# Define a function to find the time coverage of each member
+# from the time spans of its files, for all the members at once
+# returns a dataframe with a row per member with the number of files,
+# the start and end of the files, the gaps between them
+# (as "start/end" strings, the end being the start of the next file),
+# the number of files which overlap or duplicate (the same span) an earlier file
+# and the fraction of the ensemble's span which is covered
+# for dcpp the ensemble is the members with the same init year
+# files without a time range (e.g. fx or clim files) are left out
+# calendar is passed on to get_file_intervals
+def get_member_coverage(filenames, table_id=None, calendar=None):
+    members, start, end = get_file_intervals(filenames, table_id, calendar)
+    dated = ~(np.isnat(start) | np.isnat(end)) & (members != None)
+    labels, codes = np.unique(members[dated].astype(str), return_inverse=True)
+    start = start[dated].astype(np.int64)
+    end = end[dated].astype(np.int64)
+
+    # sort the files by member, then by start and end
+    order = np.lexsort((end, start, codes))
+    codes, start, end = codes[order], start[order], end[order]
+    first = np.ones(len(codes), dtype=bool)
+    first[1:] = codes[1:] != codes[:-1]
+
+    # the latest end of the files up to each file in the same member
+    # the members are offset (by more than the range of the minutes)
+    # so that one accumulate covers all of the members
+    offset = codes.astype(np.int64) * 2**40
+    latest_end = np.maximum.accumulate(end + offset) - offset
+    previous_end = np.roll(latest_end, 1)
+    previous_start = np.roll(start, 1)
+    previous_file_end = np.roll(end, 1)
+
+    gap = ~first & (start > previous_end)
+    duplicate = ~first & (start == previous_start) & (end == previous_file_end)
+    overlap = ~first & (start < previous_end) & ~duplicate
+
+    # the totals for each member
+    n = len(labels)
+    first_index = np.flatnonzero(first)
+    last_index = np.append(first_index[1:], len(codes))[:n] - 1
+    member_start = start[first_index]
+    member_end = latest_end[last_index]
+    gap_minutes = np.bincount(codes, weights=np.where(gap, start - previous_end, 0), minlength=n)
+
+    # the gaps as strings, in days unless the files have times
+    gap_starts = previous_end[gap].astype("datetime64[m]")
+    gap_ends = start[gap].astype("datetime64[m]")
+    unit = "D" if np.all(np.concatenate([previous_end[gap], start[gap]]) % 1440 == 0) else "m"
+    gap_strings = np.char.add(np.char.add(np.datetime_as_string(gap_starts, unit=unit), "/"), np.datetime_as_string(gap_ends, unit=unit))
+    gaps = [list(g) for g in np.split(gap_strings, np.searchsorted(codes[gap], np.arange(1, n)))] if n > 0 else []
+
+    coverage = pd.DataFrame({
+        "member": labels.astype(object),
+        "n_files": np.bincount(codes, minlength=n),
+        "start": member_start.astype("datetime64[m]"),
+        "end": member_end.astype("datetime64[m]"),
+        "n_gaps": np.bincount(codes, weights=gap, minlength=n).astype(int),
+        "gaps": pd.Series(gaps, dtype=object),
+        "n_overlaps": np.bincount(codes, weights=overlap, minlength=n).astype(int),
+        "n_duplicates": np.bincount(codes, weights=duplicate, minlength=n).astype(int),
+    })
+
+    # the fraction of the ensemble's span covered by each member
+    # the ensembles are found with numpy, as the rows are small and many
+    matches = [member_regex.match(member) for member in labels]
+    init_years = np.array([match.group("init_year") or "" if match is not None else "" for match in matches], dtype=str)
+    ensembles, ensemble_codes = np.unique(init_years, return_inverse=True)
+    ensemble_start = np.full(len(ensembles), np.iinfo(np.int64).max)
+    ensemble_end = np.full(len(ensembles), np.iinfo(np.int64).min)
+    np.minimum.at(ensemble_start, ensemble_codes, member_start)
+    np.maximum.at(ensemble_end, ensemble_codes, member_end)
+    span = ensemble_end[ensemble_codes] - ensemble_start[ensemble_codes]
+    covered = member_end - member_start - gap_minutes
+    coverage["coverage"] = np.divide(covered, span, out=np.ones(n), where=span > 0)
+
+    return coverage
+
+# Define a function to get the calendar of the files
+# for a given model, experiment, table_id and variable from their headers
+# returns None if there are no headers with a calendar
+def get_header_calendar(index, base_path, model, experiment, table_id, variable, headers):
+    if headers is None or index is None:
+        return None
 
-        # Check that the list of directories is not empty
-        if len(dirs) == 0:
-            #print("No files available")
-            return None
-        
-        # check how many files are empty in the final directory
-        empty_files = 0
-        for directory in dirs:
-            files = os.listdir(directory)
-            for file in files:
-                file_path = os.path.join(directory, file)
-                if os.path.isfile(file_path) and os.path.getsize(file_path) == 0:
-                    empty_files += 1
-
-        print("Number of empty files: ", empty_files)
+    for path in get_index_file_paths(index, base_path, model, experiment, table_id, variable):
+        header = headers.get(path)
+        if header is not None and header.get("calendar") is not None:
+            return header["calendar"]
+
+    return None
+
+# Define a function to get the time coverage of the members
+# for a given model, experiment, table_id and variable
+# files_list can be given to reuse the output of get_files
+# headers from get_file_headers give the calendar of the files
+# which is otherwise guessed from the filenames
+# returns a dataframe with a row per member (see get_member_coverage)
+@profiled
+def get_coverage(model, base_path, experiment, table_id, variable, index=None, files_list=None, headers=None):
+    if files_list is None:
+        files_list = get_files(model, base_path, experiment=experiment, table_id=table_id, variable=variable, index=index)
+
+    if files_list is None:
+        return None
 
-    else:
-        print("Base path not recognized")
+    calendar = get_header_calendar(index, base_path, model, experiment, table_id, variable, headers)
+    return get_member_coverage(files_list, table_id, calendar)
+
+# Define a function to get the survey columns for the time coverage
+# the number of members which cover the ensemble's span without gaps,
+# the members with gaps, the gaps as "member start/end" strings
+# and the number of overlapping and duplicate files
+def get_coverage_columns(coverage):
+    if coverage is None:
+        return { "complete_members": None, "members_with_gaps": None, "coverage_gaps": None, "no_overlapping_files": None, "no_duplicate_files": None }
+
+    n_gaps = coverage["n_gaps"].to_numpy()
+    with_gaps = [(member, gaps) for member, gaps, n in zip(coverage["member"].tolist(), coverage["gaps"].tolist(), n_gaps) if n > 0]
+    return {
+        "complete_members": int(((n_gaps == 0) & (coverage["coverage"].to_numpy() >= 1)).sum()),
+        "members_with_gaps": [member for member, gaps in with_gaps],
+        "coverage_gaps": [member + " " + gap for member, gaps in with_gaps for gap in gaps],
+        "no_overlapping_files": int(coverage["n_overlaps"].to_numpy().sum()),
+        "no_duplicate_files": int(coverage["n_duplicates"].to_numpy().sum()),
+    }
+
+# Define a function to check the files
+# for a given model, experiment, table_id and variable
+# checks from validate_files can be given to reuse them
+# returns a dictionary of path -> result (see validate_netcdf_file)
+@profiled
+def get_validation(model, base_path, experiment, table_id, variable, index=None, checks=None, check_time=False, **scan_options):
+    if get_datasource(base_path) is None:
         return None
 
-    return empty_files
-        
+    if index is None:
+        index = build_drs_index(base_path, models=[model], experiments=[experiment], table_ids=[table_id], variables=[variable], stat_files=False, **scan_options)
+
+    paths = get_index_file_paths(index, base_path, model, experiment, table_id, variable)
+    if checks is None:
+        checks = validate_files(paths, check_time=check_time)
+
+    return {path: checks[path] for path in paths if path in checks}
+
+# Define a function to get the survey columns for the checks of the files
+# the number of files which are not ok, the files as "filename status" strings,
+# the number of members with all of their files ok and the members which are not
+def get_validation_columns(results):
+    if results is None:
+        return { "no_invalid_files": None, "invalid_files": None, "valid_members": None, "members_with_invalid_files": None }
+
+    member_ok = {}
+    invalid_files = []
+    for path, result in results.items():
+        filename = os.path.basename(path)
+        match = filename_regex.match(filename)
+        member = match.group("member") if match is not None else "-"
+        ok = result["status"] == "ok"
+        member_ok[member] = member_ok.get(member, True) and ok
+        if not ok:
+            invalid_files.append(filename + " " + result["status"])
+
+    return {
+        "no_invalid_files": len(invalid_files),
+        "invalid_files": invalid_files,
+        "valid_members": sum(member_ok.values()),
+        "members_with_invalid_files": sorted(member for member, ok in member_ok.items() if not ok),
+    }
 
-# Define a function to fill in the dataframe
-def fill_dataframe(base_paths, models, variables, columns, experiments, table_ids):
-    # create an empty dataframe with the desired columns
-    df = pd.DataFrame(columns=columns)
+# Define a function to evaluate the survey columns for one row
+# the member labels, the members with the variable and the files
+# are each found once and shared between the columns which need them
+# headers from get_file_headers are used for the years_range
+# and checks from validate_files for the validation_columns
+# returns a dictionary of the values for the columns
+def evaluate_row(base_path, table_id, experiment, model, variable, columns, index=None, headers=None, checks=None, unreachable=None):
+    # build the index for the row if one is not given
+    # the canari members are taken from the files for all the table_ids
+    if index is None:
+        index_table_ids = [table_id] if "badc/cmip6/data/CMIP6/" in base_path else None
+        index = build_drs_index(base_path, models=[model], experiments=[experiment], table_ids=index_table_ids, variables=[variable])
+
+    # the results which are shared between the columns
+    # each is computed the first time a column needs it
+    shared = {}
+    def get_shared(name, function):
+        if name not in shared:
+            shared[name] = function()
+        return shared[name]
+
+    member_labels = lambda: get_shared("member_labels", lambda: get_member_labels(model, base_path, experiment, variable, index=index))
+    members = lambda: get_shared("members", lambda: None if member_labels() is None else parse_members(member_labels()))
+    variable_members = lambda: get_shared("variable", lambda: get_variable(model, base_path, experiment=experiment, table_id=table_id, variable=variable, index=index))
+    files_list = lambda: get_shared("files_list", lambda: get_files(model, base_path, experiment=experiment, table_id=table_id, variable=variable, index=index))
+    validation = lambda: get_shared("validation", lambda: get_validation_columns(get_validation(model, base_path, experiment=experiment, table_id=table_id, variable=variable, index=index, checks=checks)))
+    coverage = lambda: get_shared("coverage", lambda: get_coverage_columns(get_coverage(model, base_path, experiment=experiment, table_id=table_id, variable=variable, index=index, files_list=files_list(), headers=headers)))
 
     # create a dictionary to map column names to functions
     column_functions = {
-        "data_source": lambda base_path, table_id, experiment, model, variable: get_datasource(base_path),
-        "institution": lambda base_path, table_id, experiment, model, variable: get_institution(model, base_path, variable),
-        "source": lambda base_path, table_id, experiment, model, variable: model,
-        "experiment": lambda base_path, table_id, experiment, model, variable: experiment,
-        "table_id": lambda base_path, table_id, experiment, model, variable: get_table_id(model, base_path, experiment=experiment, table_id=table_id, variable=variable),
-        "runs": lambda base_path, table_id, experiment, model, variable: get_runs(model, base_path, experiment=experiment, variable=variable),
-        "inits": lambda base_path, table_id, experiment, model, variable: get_inits(model, base_path, experiment=experiment, variable=variable),
-        "physics": lambda base_path, table_id, experiment, model, variable: get_physics(model, base_path, experiment=experiment, variable=variable),
-        "forcing": lambda base_path, table_id, experiment, model, variable: get_forcing(model, base_path, experiment=experiment, variable=variable),
-        "total ensemble members": lambda base_path, table_id, experiment, model, variable: get_total_ensemble_members(model, base_path, experiment=experiment, variable=variable),
-        "no_members": lambda base_path, table_id, experiment, model, variable: get_variable(model, base_path, experiment=experiment, table_id=table_id, variable=variable)[1],
-        "members_list": lambda base_path, table_id, experiment, model, variable: get_variable(model, base_path, experiment=experiment, table_id=table_id, variable=variable)[2],
-        "variable": lambda base_path, table_id, experiment, model, variable: get_variable(model, base_path, experiment=experiment, table_id=table_id, variable=variable)[0],
-        "model": lambda base_path, table_id, experiment, model, variable: model,
-        "files_list": lambda base_path, table_id, experiment, model, variable: get_files(model, base_path, experiment=experiment, table_id=table_id, variable=variable),
-        "years_range": lambda base_path, table_id, experiment, model, variable: get_years(model, base_path, experiment=experiment, table_id=table_id, variable=variable),
-        "no_empty_files": lambda base_path, table_id, experiment, model, variable: get_empty_files(model, base_path, experiment=experiment, table_id=table_id, variable=variable)
+        "data_source": lambda: get_datasource(base_path),
+        "institution": lambda: get_institution(model, base_path, variable, index=index),
+        "source": lambda: model,
+        "experiment": lambda: experiment,
+        "table_id": lambda: get_table_id(model, base_path, experiment=experiment, table_id=table_id, variable=variable, index=index),
+        "runs": lambda: get_runs(model, base_path, experiment=experiment, variable=variable, index=index, members=members()),
+        "inits": lambda: get_inits(model, base_path, experiment=experiment, variable=variable, index=index, members=members()),
+        "physics": lambda: get_physics(model, base_path, experiment=experiment, variable=variable, index=index, members=members()),
+        "forcing": lambda: get_forcing(model, base_path, experiment=experiment, variable=variable, index=index, members=members()),
+        "total ensemble members": lambda: get_total_ensemble_members(model, base_path, experiment=experiment, variable=variable, index=index, members=members()),
+        "no_members": lambda: variable_members()[1],
+        "members_list": lambda: variable_members()[2],
+        "variable": lambda: variable_members()[0],
+        "model": lambda: model,
+        "files_list": files_list,
+        "years_range": lambda: get_years(model, base_path, experiment=experiment, table_id=table_id, variable=variable, index=index, files_list=files_list(), headers=headers),
+        "no_empty_files": lambda: get_empty_files(model, base_path, experiment=experiment, table_id=table_id, variable=variable, index=index),
+        "complete_members": lambda: coverage()["complete_members"],
+        "members_with_gaps": lambda: coverage()["members_with_gaps"],
+        "coverage_gaps": lambda: coverage()["coverage_gaps"],
+        "no_overlapping_files": lambda: coverage()["no_overlapping_files"],
+        "no_duplicate_files": lambda: coverage()["no_duplicate_files"],
+        "superseded_versions": lambda: get_superseded_versions(model, base_path, experiment=experiment, table_id=table_id, variable=variable, index=index),
+        "no_invalid_files": lambda: validation()["no_invalid_files"],
+        "invalid_files": lambda: validation()["invalid_files"],
+        "valid_members": lambda: validation()["valid_members"],
+        "members_with_invalid_files": lambda: validation()["members_with_invalid_files"],
+        "unreachable_directories": lambda: get_row_unreachable(base_path, table_id, experiment, model, variable, unreachable),
     }
 
+    # iterate over the columns and add the values to the dictionary
+    row_dict = {}
+    with profile_scope("base_path", "rows", base_path):
+        for column in columns:
+            with profile_scope("column", column, base_path):
+                row_dict[column] = column_functions[column]()
+
+    return row_dict
+
+# Define a function to get the unreachable directories (see list_directory)
+# which a row depends on, i.e. whose DRS levels do not rule out the row
+# unreachable is the unreachable directories under the base path
+# (all of those recorded so far by default)
+def get_row_unreachable(base_path, table_id, experiment, model, variable, unreachable=None):
+    if unreachable is None:
+        unreachable = get_unreachable_directories(base_path)
+
+    levels = badc_levels if "badc/cmip6/data/CMIP6/" in base_path else canari_levels
+    row_keys = { "source": model, "experiment": experiment, "table_id": table_id, "variable": variable }
+
+    row_unreachable = []
+    for path in unreachable:
+        parts = os.path.relpath(path, base_path).split(os.sep) if path != base_path else []
+        if all(part == row_keys[key] for (key, pattern), part in zip(levels, parts) if key in row_keys):
+            row_unreachable.append(path)
+    return row_unreachable
+
+# Define a function to get the paths of the files of each member
+# for a given model, experiment, table_id and variable from the DRS index
+# (built here if not given, e.g. with a catalog so that unchanged directories are not re-listed)
+# time_slice is (start, end), e.g. ("1960", "1970-06"), the end being inclusive
+# and only the files whose time ranges (from the filenames) overlap it are kept
+# returns a dictionary of member -> list of paths, in time order
+def get_member_paths(model, base_path, experiment, table_id, variable, index=None, time_slice=None, **scan_options):
+    if index is None:
+        index = build_drs_index(base_path, models=[model], experiments=[experiment], table_ids=[table_id], variables=[variable], stat_files=False, **scan_options)
+
+    paths = get_index_file_paths(index, base_path, model, experiment, table_id, variable)
+    members, start, end = get_file_intervals([os.path.basename(path) for path in paths], table_id)
+
+    keep = np.ones(len(paths), dtype=bool)
+    if time_slice is not None:
+        slice_start = np.datetime64(pd.Period(time_slice[0]).start_time, "m")
+        slice_end = np.datetime64(pd.Period(time_slice[1]).end_time, "m")
+        # files without a time range are kept
+        keep = np.isnat(start) | ((start <= slice_end) & (end > slice_start))
+
+    member_paths = {}
+    for i in np.argsort(start, kind="stable"):
+        if keep[i] and members[i] is not None:
+            member_paths.setdefault(members[i], []).append(paths[i])
+
+    return {member: member_paths[member] for member in sorted(member_paths)}
+
+# Define a function to concatenate datasets along a dimension
+# data_vars are the variables to concatenate, "minimal" for those which have the dimension
+# the other variables are taken from the first dataset
+# if validated is True the coordinates are also taken from the first dataset
+# (if the datasets are the same size), rather than checked against each other
+def concat_datasets(datasets, dim, validated=False, data_vars="minimal"):
+    if validated:
+        sizes = set(tuple(sorted((name, size) for name, size in ds.sizes.items() if name != dim)) for ds in datasets)
+        join = "override" if len(sizes) == 1 else "outer"
+        return xr.concat(datasets, dim=dim, data_vars=data_vars, coords="minimal", compat="override", join=join)
+
+    return xr.concat(datasets, dim=dim, data_vars=data_vars, coords="minimal", compat="override", join="outer")
+
+# Define a function to open one file lazily, chunked by chunks (one chunk per file by default)
+def open_lazy_dataset(path, chunks=None):
+    return xr.open_dataset(path, chunks=chunks if chunks is not None else {})
+
+# Define a function to open the files of each member lazily
+# member_paths is member -> list of paths (see get_member_paths)
+# the files are opened one at a time, as xarray holds a lock while the NetCDF/HDF5 library
+# reads so threads would only take turns, and a pool of processes is slower
+# (each process imports this module, and the files are opened again to read the data)
+# chunked by chunks (one chunk per file by default)
+# returns a dictionary of member -> dataset with the member's files along time
+def open_member_datasets(member_paths, chunks=None, validated=False, time_slice=None):
+    paths = [path for member in member_paths for path in member_paths[member]]
+    count_filesystem_call("open", len(paths))
+    opened = {path: open_lazy_dataset(path, chunks) for path in paths}
+
+    datasets = {}
+    for member, member_files in member_paths.items():
+        ds = concat_datasets([opened[path] for path in member_files], "time", validated) if len(member_files) > 1 else opened[member_files[0]]
+        if time_slice is not None:
+            ds = ds.sel(time=slice(time_slice[0], time_slice[1]))
+        datasets[member] = ds
+
+    return datasets
+
+# Define a function to combine the datasets of the members into one dataset
+# with a member dimension, and for the dcpp hindcasts
+# an init dimension and a lead dimension (the time steps from the start of the hindcast)
+# with time as a (init, lead) coordinate
+def combine_members(datasets, variable, validated=False):
+    parsed = parse_members(list(datasets))
+    if not parsed["init_year"].notna().all():
+        return concat_datasets(list(datasets.values()), "member", validated, data_vars=[variable]).assign_coords(member=list(datasets))
+
+    # the dcpp members are put on the lead times from the start of each hindcast
+    inits = {}
+    times = {}
+    for member, init_year in zip(datasets, parsed["init_year"]):
+        ds = datasets[member]
+        times.setdefault(int(init_year), ds["time"].values)
+        ds = ds.assign_coords(lead=("time", np.arange(ds.sizes["time"]))).swap_dims({"time": "lead"}).drop_vars("time")
+        inits.setdefault(int(init_year), {})[member.split("-", 1)[1]] = ds
+
+    by_init = [concat_datasets(list(init_members.values()), "member", validated, data_vars=[variable]).assign_coords(member=list(init_members)) for init_members in inits.values()]
+    ensemble = xr.concat(by_init, dim="init", data_vars=[variable], coords="minimal", compat="override", join="outer").assign_coords(init=list(inits))
+
+    # the valid times of each hindcast, padded to the longest
+    first = next(iter(times.values()))
+    time = np.full((len(inits), ensemble.sizes["lead"]), np.datetime64("NaT") if first.dtype.kind == "M" else None, dtype=first.dtype)
+    for i, init_time in enumerate(times.values()):
+        time[i, :len(init_time)] = init_time
+
+    return ensemble.assign_coords(time=(("init", "lead"), time))
+
+# Define a function to leave out the files which are not ok in checks (from validate_files)
+# and the members with no files left
+def filter_checked_paths(member_paths, checks=None):
+    if checks is None:
+        return member_paths
+
+    member_paths = {member: [path for path in paths if checks.get(path, {}).get("status") == "ok"] for member, paths in member_paths.items()}
+    return {member: paths for member, paths in member_paths.items() if len(paths) > 0}
+
+# Define a function to find where to read an ensemble from
+# the members (all of those on disk by default) are found from the DRS index
+# and the Zarr mirror in the catalog (see write_zarr_mirror) is used if it has all of them
+# and checks (if given) leave out none of their files
+# or else the files of the members (filtered by checks, see filter_checked_paths)
+# so a mirror written before members were added (or files found bad) is not used
+# the catalog in scan_options is the path of the catalog (opened and closed here)
+# or an open connection to it, and the other scan_options are passed on to build_drs_index
+# returns the mirror (with the members to read from it) or None, and the files of each member
+def get_ensemble_source(model, base_path, experiment, table_id, variable, index=None, members=None, time_slice=None, checks=None, **scan_options):
+    catalog = scan_options.get("catalog")
+    catalog_connection = open_catalog(catalog) if isinstance(catalog, (str, os.PathLike)) else catalog
+    try:
+        mirror = get_zarr_mirror(catalog_connection, base_path, model, experiment, table_id, variable)
+        scan_options["catalog"] = catalog_connection
+        member_paths = get_member_paths(model, base_path, experiment, table_id, variable, index=index, time_slice=time_slice, **scan_options)
+    finally:
+        if catalog_connection is not None and catalog_connection is not catalog:
+            catalog_connection.close()
+
+    if members is not None:
+        member_paths = {member: member_paths[member] for member in members if member in member_paths}
+    checked_paths = filter_checked_paths(member_paths, checks)
+
+    if mirror is not None and len(member_paths) > 0 and all(member in mirror["members"] for member in member_paths) and checked_paths == member_paths:
+        return dict(mirror, members=list(member_paths)), checked_paths
+
+    if mirror is not None and len(member_paths) > 0:
+        print("Zarr mirror does not have all of the members (or has bad files), reading the files")
+    return None, checked_paths
+
+# Define a function to load an ensemble as one lazy xarray dataset
+# for a given model, experiment, table_id and variable, from the DRS index
+# (e.g. a survey selection, with members from query_members or get_consistent_ensemble)
+# without globbing (max_workers directories are listed at once, see build_drs_index)
+# the files are opened (see open_member_datasets) and the data is only read when it is used (chunked by chunks, one chunk per file by default)
+# the dataset has a member dimension (and init and lead for dcpp, see combine_members)
+# time_slice (start, end) only opens the files which overlap it (see get_member_paths)
+# checks from validate_files leave out the files which are not ok
+# and then the coordinates of the files are not checked against each other
+# if the catalog in scan_options (its path, or a connection) has a Zarr mirror
+# with the members (see get_ensemble_source) it is read from instead of the NetCDF files
+def load_ensemble(model, base_path, experiment, table_id, variable, index=None, members=None, time_slice=None, checks=None, chunks=None, max_workers=None, **scan_options):
+    mirror, member_paths = get_ensemble_source(model, base_path, experiment, table_id, variable, index=index, members=members, time_slice=time_slice, checks=checks, max_workers=max_workers, **scan_options)
+    if mirror is not None:
+        return open_zarr_mirror(mirror["store"], variable, members=mirror["members"], time_slice=time_slice)
+
+    if len(member_paths) == 0:
+        print("No files available")
+        return None
+
+    datasets = open_member_datasets(member_paths, chunks=chunks, validated=checks is not None, time_slice=time_slice)
+
+    return combine_members(datasets, variable, validated=checks is not None)
+
+# Define a function to get the Zarr mirror of an ensemble from the catalog
+# returns a dictionary with the store and the members in it
+# or None if there is no catalog or no mirror
+def get_zarr_mirror(catalog, base_path, model, experiment, table_id, variable):
+    if catalog is None:
+        return None
+
+    with catalog_lock:
+        catalog.execute("CREATE TABLE IF NOT EXISTS zarr_mirrors (base_path TEXT, model TEXT, experiment TEXT, table_id TEXT, variable TEXT, store TEXT, members TEXT, PRIMARY KEY (base_path, model, experiment, table_id, variable))")
+        row = catalog.execute("SELECT store, members FROM zarr_mirrors WHERE base_path = ? AND model = ? AND experiment = ? AND table_id = ? AND variable = ?", (base_path, model, experiment, table_id, variable)).fetchone()
+
+    if row is None:
+        return None
+
+    return { "store": row[0], "members": json.loads(row[1]) }
+
+# Define a function to get the members which have been fully written to a Zarr mirror
+# each member is a group in the store, marked complete once all of its data is written
+def get_zarr_members(store):
+    if not os.path.exists(store):
+        return []
+
+    # the consolidated metadata of the root is not updated when members are added
+    root = zarr.open_group(store, mode="r", use_consolidated=False)
+    return sorted(name for name, group in root.groups() if group.attrs.get("complete", False))
+
+# Define a function to write one member to a Zarr mirror
+# rechunked for reading time series, i.e. all of the times in each chunk
+# and space_chunk points along lat and lon (1 along any other dimension)
+# the data is read and written in bands of lat with at most max_memory bytes at once
+# so the whole member is never in memory
+def write_zarr_member(store, member, ds, variable, space_chunk=16, max_memory=2**30):
+    ds = ds[[variable]]
+    for name in ds.variables:
+        ds[name].encoding = {}
+
+    # the chunks of the store, and the dimension the bands are along
+    dims = ds[variable].dims
+    target = {dim: -1 if dim == "time" else min(space_chunk, ds.sizes[dim]) if dim in ("lat", "lon") else 1 for dim in dims}
+    band_dim = "lat" if "lat" in dims else [dim for dim in dims if dim != "time"][0]
+
+    # write the coordinates and the (empty) array first
+    template = ds.chunk(target)
+    template.to_zarr(store, group=member, mode="w", compute=False, zarr_format=2, encoding={variable: {"chunks": tuple(ds.sizes[dim] if target[dim] == -1 else target[dim] for dim in dims)}})
+
+    # the number of chunks along the band dimension in each band
+    band_bytes = ds[variable].dtype.itemsize * int(np.prod([ds.sizes[dim] for dim in dims if dim != band_dim])) * target[band_dim]
+    band = target[band_dim] * max(1, int(max_memory // max(band_bytes, 1)))
+
+    for start in range(0, ds.sizes[band_dim], band):
+        region = slice(start, min(start + band, ds.sizes[band_dim]))
+        part = ds.isel({band_dim: region}).load()
+        part = part.drop_vars([name for name in part.variables if band_dim not in part[name].dims])
+        part.to_zarr(store, group=member, region={band_dim: region})
+
+    # mark the member as complete, so an interrupted write is redone
+    zarr.open_group(store, path=member, mode="a").attrs["complete"] = True
+
+# Define a function to write a Zarr mirror of an ensemble
+# for a given model, experiment, table_id and variable, on local disk at store
+# one group per member, rechunked for reading time series (see write_zarr_member)
+# only the members which are not already in the store are written
+# so it can be run again to add new members
+# members are all of the members by default, e.g. from query_members
+# catalog is the path of the catalog, where the location of the mirror is recorded
+# for load_ensemble, max_workers and scan_options are passed on to build_drs_index
+def write_zarr_mirror(store, model, base_path, experiment, table_id, variable, members=None, index=None, catalog=None, space_chunk=16, max_memory=2**30, max_workers=None, **scan_options):
+    catalog_connection = open_catalog(catalog) if catalog is not None else None
+    try:
+        member_paths = get_member_paths(model, base_path, experiment, table_id, variable, index=index, catalog=catalog_connection, max_workers=max_workers, **scan_options)
+        if members is not None:
+            member_paths = {member: member_paths[member] for member in members if member in member_paths}
+        if len(member_paths) == 0:
+            print("No files available")
+            return []
+
+        done = get_zarr_members(store)
+        to_write = {member: paths for member, paths in member_paths.items() if member not in done}
+        print("Members already in the mirror: ", len(done), "to write: ", len(to_write))
+
+        for member, paths in to_write.items():
+            print("Writing member: ", member)
+            datasets = open_member_datasets({member: paths})
+            write_zarr_member(store, member, datasets[member], variable, space_chunk=space_chunk, max_memory=max_memory)
+
+        # record the mirror in the catalog
+        members_written = get_zarr_members(store)
+        if catalog_connection is not None:
+            # (get_zarr_mirror creates the table if needed)
+            get_zarr_mirror(catalog_connection, base_path, model, experiment, table_id, variable)
+            with catalog_lock:
+                catalog_connection.execute("INSERT OR REPLACE INTO zarr_mirrors VALUES (?, ?, ?, ?, ?, ?, ?)", (base_path, model, experiment, table_id, variable, os.path.abspath(store), json.dumps(members_written)))
+                catalog_connection.commit()
+    finally:
+        if catalog_connection is not None:
+            catalog_connection.close()
+
+    return members_written
+
+# Define a function to open a Zarr mirror as one lazy xarray dataset
+# with the same dimensions as load_ensemble
+# members are all the members in the mirror by default
+def open_zarr_mirror(store, variable, members=None, time_slice=None):
+    if members is None:
+        members = get_zarr_members(store)
+
+    datasets = {}
+    for member in members:
+        ds = xr.open_zarr(store, group=member)
+        ds.attrs.pop("complete", None)
+        if time_slice is not None:
+            ds = ds.sel(time=slice(time_slice[0], time_slice[1]))
+        datasets[member] = ds
+
+    return combine_members(datasets, variable, validated=True)
+
+# Define a function to update a running mean and variance (Welford's algorithm)
+# with the values of one more member
+# state is a dictionary of count, mean and m2 (the sum of squared differences from the mean)
+# arrays of the same shape as values, updated in place
+# missing (NaN) values are not counted
+def update_welford(state, values):
+    valid = np.isfinite(values)
+    state["count"] += valid
+    delta = np.where(valid, values - state["mean"], 0.0)
+    state["mean"] += np.divide(delta, state["count"], out=np.zeros_like(delta), where=state["count"] > 0)
+    state["m2"] += np.where(valid, delta * (values - state["mean"]), 0.0)
+
+# Define a function to get the ensemble mean, spread (standard deviation)
+# and count of a block of an ensemble
+# reading one member at a time, so only the block of one member
+# and the running statistics are in memory
+def get_block_stats(ensemble, variable, block):
+    data = ensemble[variable].isel(block)
+    shape = tuple(size for dim, size in zip(data.dims, data.shape) if dim != "member")
+    state = { "count": np.zeros(shape, dtype=np.int32), "mean": np.zeros(shape), "m2": np.zeros(shape) }
+
+    for i in range(data.sizes["member"]):
+        update_welford(state, data.isel(member=i).values.astype(np.float64))
+
+    spread = np.divide(state["m2"], state["count"] - 1, out=np.full(shape, np.nan), where=state["count"] > 1)
+    mean = np.where(state["count"] > 0, state["mean"], np.nan)
+
+    return mean, np.sqrt(spread), state["count"]
+
+# Define a function to open the ensemble for the statistics
+# from the files of each member, or from a Zarr mirror (see write_zarr_mirror)
+def open_stats_source(source, variable):
+    if "store" in source:
+        return open_zarr_mirror(source["store"], variable, members=source["members"], time_slice=source["time_slice"])
+
+    datasets = open_member_datasets(source["member_paths"], validated=source["validated"], time_slice=source["time_slice"])
+    return combine_members(datasets, variable, validated=source["validated"])
+
+# Define a function to write the ensemble statistics of some blocks to a Zarr store
+# run in each process of the pool, which open the ensemble themselves
+# the blocks are whole chunks of the store, so the processes do not write to the same chunks
+def write_stats_blocks(store, group, source, variable, block_dim, blocks):
+    ensemble = open_stats_source(source, variable)
+    for start, end in blocks:
+        block = {block_dim: slice(start, end)}
+        mean, spread, count = get_block_stats(ensemble, variable, block)
+
+        dims = [dim for dim in ensemble[variable].dims if dim != "member"]
+        stats = xr.Dataset({ variable + "_mean": (dims, mean), variable + "_spread": (dims, spread), variable + "_count": (dims, count) })
+        stats.to_zarr(store, group=group, region=block)
+
+    return len(blocks)
+
+# Define a function to write the ensemble mean, spread (standard deviation) and count of a model
+# for a given experiment, table_id and variable, to a Zarr store (in the group of the model)
+# the members are read one at a time, in blocks along time (along init for dcpp)
+# of at most max_memory bytes of running statistics
+# so the memory used does not depend on the number of members
+# members are all of the members by default, e.g. from query_members
+# time_slice (start, end) and checks are used as in load_ensemble
+# with max_workers the blocks are shared out to a pool of processes
+# which are spawned (zarr does not work in forked processes)
+# so scripts calling it need an if __name__ == "__main__" guard
+# the Zarr mirror of the ensemble is used if the catalog in scan_options (its path, or a connection) has one
+def write_ensemble_stats(store, model, base_path, experiment, table_id, variable, members=None, index=None, time_slice=None, checks=None, max_memory=2**28, max_workers=None, **scan_options):
+    mirror, member_paths = get_ensemble_source(model, base_path, experiment, table_id, variable, index=index, members=members, time_slice=time_slice, checks=checks, **scan_options)
+    if mirror is not None:
+        source = { "store": mirror["store"], "members": mirror["members"], "time_slice": time_slice }
+        member_names = source["members"]
+    else:
+        source = { "member_paths": member_paths, "validated": checks is not None, "time_slice": time_slice }
+        member_names = list(member_paths)
+
+    if len(member_names) == 0:
+        print("No files available")
+        return None
+
+    # the ensemble is only opened (lazily) here for its shape and coordinates
+    ensemble = open_stats_source(source, variable)
+    template = ensemble[variable].isel(member=0, drop=True)
+    block_dim = template.dims[0]
+
+    # the number of steps along the block dimension in each block
+    # the running statistics are 3 arrays of at most 8 bytes, plus the values of one member
+    step_bytes = 32 * int(np.prod(template.shape[1:]))
+    block_size = max(1, int(max_memory // step_bytes))
+    blocks = [(start, min(start + block_size, template.shape[0])) for start in range(0, template.shape[0], block_size)]
+    print("Members: ", len(member_names), "blocks of ", block_size, block_dim, ": ", len(blocks))
+
+    # write the coordinates and the (empty) arrays first
+    chunks = {dim: block_size if dim == block_dim else -1 for dim in template.dims}
+    stats = xr.Dataset({ variable + "_mean": template.astype(np.float64), variable + "_spread": template.astype(np.float64), variable + "_count": template.astype(np.int32) })
+    stats = stats.drop_vars([name for name in stats.coords if "member" in stats[name].dims])
+    for name in stats.variables:
+        stats[name].encoding = {}
+    stats.attrs.update({ "model": model, "experiment": experiment, "table_id": table_id, "variable": variable, "members": ",".join(member_names) })
+    stats.chunk(chunks).to_zarr(store, group=model, mode="w", compute=False, zarr_format=2)
+    ensemble.close()
+
+    if max_workers is None or max_workers <= 1 or len(blocks) <= 1:
+        write_stats_blocks(store, model, source, variable, block_dim, blocks)
+    else:
+        # contiguous runs of blocks, so each process opens the ensemble once
+        shares = [share.tolist() for share in np.array_split(np.array(blocks), min(max_workers, len(blocks))) if len(share) > 0]
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            list(pool.map(write_stats_blocks, *zip(*[(store, model, source, variable, block_dim, share) for share in shares])))
+
+    return xr.open_zarr(store, group=model)
+
+# The survey columns which hold lists
+# these are stored as JSON strings in the catalog
+list_columns = [ "members_list", "files_list", "members_with_gaps", "coverage_gaps", "superseded_versions", "invalid_files", "members_with_invalid_files", "unreachable_directories" ]
+
+# The survey columns which hold counts
+# these may be missing (None) so use the nullable integer type
+integer_columns = [ "runs", "inits", "physics", "forcing", "total ensemble members", "no_members", "no_empty_files", "complete_members", "no_overlapping_files", "no_duplicate_files", "no_invalid_files", "valid_members" ]
+
+# The survey columns for the checks of the files (see validate_files)
+# these open every file, so are not in dic.columns
+# e.g. fill_dataframe(..., dic.columns + fnc.validation_columns, ..., check_time=True)
+validation_columns = [ "no_invalid_files", "invalid_files", "valid_members", "members_with_invalid_files" ]
+
+# The survey columns which only take a few values
+categorical_columns = [ "data_source", "experiment", "table_id", "variable", "model" ]
+
+# Define a function to build the survey dataframe from its columns
+# data maps each column name to the list of values for the rows
+# this is done once at the end, rather than appending each row
+def build_survey_dataframe(data, columns):
+    df = pd.DataFrame({column: pd.Series(data[column], dtype=object) for column in columns}, columns=columns)
+
+    return set_survey_dtypes(df)
+
+# Define a function to set the dtypes of the survey columns
+# integer counts and categoricals for the repeated labels
+def set_survey_dtypes(df):
+    for column in integer_columns:
+        if column in df.columns:
+            df[column] = df[column].astype("Int64")
+    for column in categorical_columns:
+        if column in df.columns:
+            df[column] = df[column].astype("category")
+
+    return df
+
+# Define a function to save the survey dataframe to the catalog
+# replacing any survey which was saved before
+def save_survey(catalog, df):
+    df = df.copy()
+    for column in list_columns:
+        if column in df.columns:
+            df[column] = [json.dumps(value) for value in df[column]]
+
+    df.to_sql("survey", catalog, if_exists="replace", index=False)
+    catalog.commit()
+
+# Define a function to load the survey saved in the catalog
+# returns a dataframe with the same columns as the survey
+# e.g. load_catalog("model_charac.sqlite") for dic.columns
+def load_catalog(catalog_path):
+    catalog = open_catalog(catalog_path)
+    try:
+        df = pd.read_sql("SELECT * FROM survey", catalog)
+    finally:
+        catalog.close()
+
+    return decode_survey(df)
+
+# Define a function to decode the survey columns read from a catalog
+# the lists from JSON, and the dtypes as in the survey
+def decode_survey(df):
+    for column in df.columns:
+        if column in list_columns:
+            df[column] = [json.loads(value) if value is not None else None for value in df[column]]
+        elif column not in integer_columns and column not in categorical_columns:
+            # the other text columns are kept as objects, as in the survey
+            df[column] = df[column].astype(object).where(df[column].notna(), None)
+
+    return set_survey_dtypes(df)
+
+# The survey columns which the survey index is keyed on
+survey_index_keys = [ "data_source", "experiment", "table_id", "model", "variable" ]
+
+# Define a function to build an index over the survey dataframe
+# (from fill_dataframe, load_catalog or read_survey_sink)
+# so that it can be queried without scanning all of the rows
+# the index is a dictionary with
+# "df": the survey dataframe
+# "rows": for each combination of the keys, values -> row positions
+# e.g. index["rows"][("experiment", "variable")][("historical", "psl")]
+# "members": for each row, the set of members with the variable
+# "member_files": for each row, member -> list of files
+def build_survey_index(df):
+    values = {key: df[key].tolist() for key in survey_index_keys}
+
+    rows = {}
+    for n in range(1, len(survey_index_keys) + 1):
+        for keys in itertools.combinations(survey_index_keys, n):
+            groups = {}
+            for position, key_values in enumerate(zip(*[values[key] for key in keys])):
+                groups.setdefault(key_values, []).append(position)
+            rows[keys] = groups
+
+    # the files of each member, from the member in the filenames
+    member_files = []
+    files_lists = df["files_list"].tolist() if "files_list" in df.columns else [None] * len(df)
+    for files_list in files_lists:
+        files = {}
+        for filename in files_list or []:
+            match = filename_regex.match(filename)
+            if match is not None:
+                files.setdefault(match.group("member"), []).append(filename)
+        member_files.append(files)
+
+    if "members_list" in df.columns:
+        members = [set(members_list or []) for members_list in df["members_list"]]
+    else:
+        members = [set(files) for files in member_files]
+
+    return { "df": df, "rows": rows, "members": members, "member_files": member_files }
+
+# Define a function to get the positions of the rows in the survey index
+# which match the given keys (None matches any value)
+# and which have the member, if one is given
+def query_survey_rows(survey_index, data_source=None, experiment=None, table_id=None, model=None, variable=None, member=None):
+    given = { "data_source": data_source, "experiment": experiment, "table_id": table_id, "model": model, "variable": variable }
+    keys = tuple(key for key in survey_index_keys if given[key] is not None)
+    if len(keys) > 0:
+        positions = survey_index["rows"][keys].get(tuple(given[key] for key in keys), [])
+    else:
+        positions = range(len(survey_index["df"]))
+
+    if member is not None:
+        positions = [position for position in positions if member in survey_index["members"][position]]
+
+    return list(positions)
+
+# Define a function to get the rows of the survey which match the given keys
+# e.g. query_survey(survey_index, data_source="canari", experiment="dcppA-hindcast", table_id="Amon", variable="tas")
+def query_survey(survey_index, **keys):
+    return survey_index["df"].iloc[query_survey_rows(survey_index, **keys)]
+
+# Define a function to get the members with the variable
+# for the rows which match the given keys
+def query_members(survey_index, **keys):
+    members = set()
+    for position in query_survey_rows(survey_index, **keys):
+        members.update(survey_index["members"][position])
+    return sorted(members)
+
+# Define a function to get the files for the rows which match the given keys
+# only the files of the member if one is given
+def query_files(survey_index, member=None, **keys):
+    files = []
+    for position in query_survey_rows(survey_index, member=member, **keys):
+        if member is None:
+            files.extend(f for member_files in survey_index["member_files"][position].values() for f in member_files)
+        else:
+            files.extend(survey_index["member_files"][position].get(member, []))
+    return files
+
+# Define a function to check whether any of the rows which match the given keys
+# have members with the variable (or the member, if one is given)
+def query_available(survey_index, **keys):
+    return any(len(survey_index["members"][position]) > 0 for position in query_survey_rows(survey_index, **keys))
+
+# Define a function to build the member bitsets of the survey
+# each row's members with the variable become a boolean array
+# over all of the members in the survey, so that the members
+# with several variables can be found with numpy ands and ors
+# returns a dictionary with
+# "members": the member labels (the columns of the arrays)
+# "rows": (data_source, experiment, table_id, model, variable) -> row of "available"
+# "available": a (rows x members) boolean array
+def build_member_bitsets(df):
+    members_lists = [members_list or [] for members_list in df["members_list"]]
+    members = np.array(sorted(set(member for members_list in members_lists for member in members_list)), dtype=object)
+    positions = {member: i for i, member in enumerate(members)}
+
+    available = np.zeros((len(df), len(members)), dtype=bool)
+    row_positions = np.repeat(np.arange(len(df)), [len(members_list) for members_list in members_lists])
+    member_positions = np.array([positions[member] for members_list in members_lists for member in members_list], dtype=int)
+    available[row_positions, member_positions] = True
+
+    keys = zip(*[df[key].tolist() for key in survey_index_keys])
+    rows = {key: position for position, key in enumerate(keys)}
+
+    return { "members": members, "rows": rows, "available": available }
+
+# Define a function to get the member bitsets for a list of variables
+# returns a (variables x members) boolean array
+# with no members for the variables which are not in the survey
+def get_variable_bitsets(bitsets, data_source, experiment, table_id, model, variables):
+    rows = [bitsets["rows"].get((data_source, experiment, table_id, model, variable)) for variable in variables]
+    available = np.zeros((len(variables), len(bitsets["members"])), dtype=bool)
+    for i, row in enumerate(rows):
+        if row is not None:
+            available[i] = bitsets["available"][row]
+    return available
+
+# Define a function to find the members which have all of the variables
+# for a given model, experiment and table_id
+# returns a dictionary of data_source -> list of members
+# and "any" for the members which have each variable in at least one of the data sources
+# e.g. get_coavailable_members(bitsets, "CanESM5", "dcppA-hindcast", "Amon", dic.variables)
+def get_coavailable_members(bitsets, model, experiment, table_id, variables, data_sources=("canari", "badc")):
+    coavailable = {}
+    any_source = np.zeros((len(variables), len(bitsets["members"])), dtype=bool)
+    for data_source in data_sources:
+        available = get_variable_bitsets(bitsets, data_source, experiment, table_id, model, variables)
+        any_source |= available
+        coavailable[data_source] = list(bitsets["members"][available.all(axis=0)])
+    coavailable["any"] = list(bitsets["members"][any_source.all(axis=0)])
+
+    return coavailable
+
+# Define a function to get the availability matrix of the models
+# and the combinations of the variables for a given experiment and table_id
+# the values are the number of members (or init years, if count is "inits")
+# which have all of the variables in the combination
+# the rows are (data_source, model), with "any" for the members which have
+# each variable in at least one of the data sources
+# the columns are the combinations, e.g. "psl+tas", all of them by default
+def get_availability_matrix(bitsets, models, experiment, table_id, variables, combinations=None, count="members", data_sources=("canari", "badc")):
+    if combinations is None:
+        combinations = [combination for n in range(1, len(variables) + 1) for combination in itertools.combinations(variables, n)]
+
+    # which variables are in each combination, (combinations x variables)
+    in_combination = np.array([[variable in combination for variable in variables] for combination in combinations], dtype=bool).reshape(len(combinations), len(variables))
+
+    # the availability of the variables for each model, (sources x models x variables x members)
+    available = np.array([[get_variable_bitsets(bitsets, data_source, experiment, table_id, model, variables) for model in models] for data_source in data_sources], dtype=bool).reshape(len(data_sources), len(models), len(variables), len(bitsets["members"]))
+    available = np.concatenate([available, available.any(axis=0, keepdims=True)])
+
+    # a member has all of the variables in a combination
+    # if none of the variables in the combination are missing
+    missing = np.einsum("cv,smvk->smck", in_combination.astype(int), (~available).astype(int))
+    coavailable = missing == 0
+
+    if count == "inits":
+        # the number of distinct init years of the members, (members x init years)
+        init_years = parse_members(list(bitsets["members"]))["init_year"]
+        codes, uniques = pd.factorize(init_years)
+        init_members = np.zeros((len(bitsets["members"]), len(uniques)), dtype=int)
+        init_members[np.flatnonzero(codes >= 0), codes[codes >= 0]] = 1
+        counts = ((coavailable.astype(int) @ init_members) > 0).sum(axis=-1)
+    else:
+        counts = coavailable.sum(axis=-1)
+
+    index = pd.MultiIndex.from_product([list(data_sources) + ["any"], models], names=["data_source", "model"])
+    columns = ["+".join(combination) for combination in combinations]
+    return pd.DataFrame(counts.reshape(len(index), len(columns)), index=index, columns=columns)
+
+# Define a function to build the availability cube of the dcpp hindcasts
+# a boolean xarray DataArray over (model, variable, init_year, member)
+# where member is the r*i*p*f* part of the s????-r*i*p*f* labels
+# from one walk of the base path (to the badc variable directories, or the canari filenames)
+# the init years are every year from the first to the last, so missing years are all False
+# e.g. build_dcpp_cube(dic.base_JASMIN_dir_dcpp, models=dic.models, variables=dic.variables)
+def build_dcpp_cube(base_path, models=None, variables=None, table_id="Amon", experiment="dcppA-hindcast", index=None, **scan_options):
+    if index is None:
+        index = build_drs_index(base_path, models=models, experiments=[experiment], table_ids=[table_id], variables=variables, max_level="variable", stat_files=False, **scan_options)
+
+    # the (model, variable, member label) of each member directory (or file) with the variable
+    found = []
+    for institution, sources in index.items():
+        for source, experiment_nodes in sources.items():
+            for member, tables in experiment_nodes.get(experiment, {}).items():
+                for variable in tables.get(table_id, {}):
+                    found.append((source, variable, member))
+
+    members = parse_members([member for source, variable, member in found])
+    dated = members["init_year"].notna().to_numpy()
+    found = [key for key, has_init_year in zip(found, dated) if has_init_year]
+    init_years = members["init_year"].to_numpy()[dated].astype(int)
+    ripf = [member.split("-", 1)[1] for source, variable, member in found]
+
+    # the coordinates, in the order of the lists if they are given
+    model_coords = list(models) if models is not None else sorted(set(key[0] for key in found))
+    variable_coords = list(variables) if variables is not None else sorted(set(key[1] for key in found))
+    year_coords = np.arange(init_years.min(), init_years.max() + 1) if len(init_years) > 0 else np.array([], dtype=int)
+    member_coords = sorted(set(ripf), key=lambda label: [int(n) for n in re.findall(r"\d+", label)])
+
+    cube = np.zeros((len(model_coords), len(variable_coords), len(year_coords), len(member_coords)), dtype=bool)
+    if len(found) > 0:
+        model_codes = pd.Index(model_coords).get_indexer([key[0] for key in found])
+        variable_codes = pd.Index(variable_coords).get_indexer([key[1] for key in found])
+        member_codes = pd.Index(member_coords).get_indexer(ripf)
+        keep = (model_codes >= 0) & (variable_codes >= 0)
+        cube[model_codes[keep], variable_codes[keep], init_years[keep] - year_coords[0], member_codes[keep]] = True
+
+    return xr.DataArray(cube, dims=("model", "variable", "init_year", "member"), coords={ "model": model_coords, "variable": variable_coords, "init_year": year_coords, "member": member_coords }, name="available")
+
+# Define a function to get the members with all of the variables (all in the cube by default)
+# for each model and init year from the dcpp cube
+# returns a boolean DataArray over (model, init_year, member)
+def get_dcpp_complete(cube, variables=None):
+    if variables is not None:
+        cube = cube.sel(variable=list(variables))
+    return cube.all("variable")
+
+# Define a function to get the init years which are missing for each model
+# i.e. with no members which have all of the variables
+# init_years are the years which are expected (all the years in the cube by default)
+# returns a dictionary of model -> list of init years
+def get_missing_init_years(cube, variables=None, init_years=None):
+    complete = get_dcpp_complete(cube, variables).any("member")
+    if init_years is not None:
+        complete = complete.reindex(init_year=list(init_years), fill_value=False)
+
+    missing = {}
+    years = complete["init_year"].values
+    for model, row in zip(complete["model"].values, complete.values):
+        missing[str(model)] = [int(year) for year in years[~row]]
+    return missing
+
+# Define a function to get the largest complete ensemble for each start date
+# i.e. the members with all of the variables for each model and init year
+# returns a dataframe indexed by (model, init_year) with the n_members and the members
+def get_complete_ensembles(cube, variables=None):
+    complete = get_dcpp_complete(cube, variables)
+    member_labels = np.array(complete["member"].values, dtype=object)
+
+    records = []
+    for i, model in enumerate(complete["model"].values):
+        for j, init_year in enumerate(complete["init_year"].values):
+            have = complete.values[i, j]
+            records.append((str(model), int(init_year), int(have.sum()), [str(member) for member in member_labels[have]]))
+
+    return pd.DataFrame(records, columns=["model", "init_year", "n_members", "members"]).set_index(["model", "init_year"])
+
+# Define a function to get the members which have all of the variables
+# for every one of the init years (all the years in the cube by default) for a model
+# i.e. the ensemble which can be used for the whole hindcast set
+def get_consistent_ensemble(cube, model, variables=None, init_years=None):
+    complete = get_dcpp_complete(cube, variables).sel(model=model)
+    if init_years is not None:
+        complete = complete.reindex(init_year=list(init_years), fill_value=False)
+
+    return [str(member) for member in complete["member"].values[complete.all("init_year").values]]
+
+# Define a function to get the experiments surveyed for a base path
+# all the experiments for canari, historical for badc CMIP
+# and dcppA-hindcast for badc DCPP
+# returns None if the base path is not recognized
+# and an empty list for canari if experiments is None
+def get_survey_experiments(base_path, experiments):
+    if "/gws/nopw/j04/canari/" in base_path:
+        # none given, for a discovery survey of all the experiments
+        if experiments is None:
+            return []
+        return list(experiments)
+    elif "badc/cmip6/data/CMIP6/" in base_path:
+        if base_path.endswith("/CMIP"):
+            return ["historical"]
+        elif base_path.endswith("/DCPP"):
+            return ["dcppA-hindcast"]
+        print("End of base path not recognized")
+        return None
+
+    print("Base path not recognized")
+    return None
+
+# The directory listings which each survey column depends on
+# as (the deepest level which is listed, whether the files are stat'd)
+# None is for the columns which need no listings
+# and "files" for the files in the (badc version) directories
+# for canari anything below "experiment" lists the files,
+# as the members are only known from the filenames
+column_listings = {
+    "data_source": (None, False),
+    "source": (None, False),
+    "experiment": (None, False),
+    "model": (None, False),
+    "institution": ("source", False),
+    "runs": ("member", False),
+    "inits": ("member", False),
+    "physics": ("member", False),
+    "forcing": ("member", False),
+    "total ensemble members": ("member", False),
+    "table_id": ("table_id", False),
+    "variable": ("variable", False),
+    "no_members": ("variable", False),
+    "members_list": ("variable", False),
+    "files_list": ("files", False),
+    "years_range": ("files", False),
+    "complete_members": ("files", False),
+    "members_with_gaps": ("files", False),
+    "coverage_gaps": ("files", False),
+    "no_overlapping_files": ("files", False),
+    "no_duplicate_files": ("files", False),
+    "superseded_versions": ("files", False),
+    "no_empty_files": ("files", True),
+    "no_invalid_files": ("files", False),
+    "invalid_files": ("files", False),
+    "valid_members": ("files", False),
+    "members_with_invalid_files": ("files", False),
+    "unreachable_directories": (None, False),
+}
+
+# The levels in column_listings, from the shallowest
+listing_levels = [ None, "institution", "source", "experiment", "member", "table_id", "variable", "files" ]
+
+# Define a function to get the listings which a list of columns depends on
+# returns the deepest level which is needed (see column_listings)
+# and whether the files need to be stat'd
+# e.g. ("member", False) for the runs, inits, physics and forcing
+def get_column_listings(columns):
+    levels = [column_listings[column][0] for column in columns]
+    level = max(levels, key=listing_levels.index) if len(levels) > 0 else None
+    stat_files = any(column_listings[column][1] for column in columns)
+
+    return level, stat_files
+
+# Define a function to find the combinations which are on disk
+# from the DRS index of a base path (walked at least to the variable level)
+# returns a set of (base_path, table_id, experiment, model, variable) keys
+def get_discovered_keys(index, base_path):
+    keys = set()
+    for institution, sources in index.items():
+        for source, experiment_nodes in sources.items():
+            for experiment, members in experiment_nodes.items():
+                for member, tables in members.items():
+                    for table_id, variable_nodes in tables.items():
+                        for variable in variable_nodes:
+                            keys.add((base_path, table_id, experiment, source, variable))
+    return keys
+
+# Define a function to get an explicit zero row
+# for a combination which is not on disk, without any listings
+# the counts are 0, the lists are empty and the years_range is "No files"
+def get_zero_row(base_path, table_id, experiment, model, variable, columns):
+    values = { "data_source": get_datasource(base_path), "source": model, "model": model, "experiment": experiment, "table_id": table_id, "variable": variable, "years_range": "No files" }
+
+    row_dict = {}
+    for column in columns:
+        if column in integer_columns:
+            row_dict[column] = 0
+        elif column in list_columns:
+            row_dict[column] = []
+        else:
+            row_dict[column] = values.get(column)
+    return row_dict
+
+# Define a generator which computes the survey rows one at a time
+# in the same order as fill_dataframe
+# yields (key, row_dict) where key is (base_path, table_id, experiment, model, variable)
+# the keys in done_keys are skipped, and a base path is not walked
+# at all if all of its keys are done
+# only the listings which the columns depend on are done (see column_listings)
+# e.g. a survey of the member counts does not list below the member directories
+# scan_options are passed on to build_drs_index (e.g. an open catalog and max_workers)
+# if read_headers is True the NetCDF headers of all the files are read
+# (cached in the catalog) and their time coordinates give the years_range
+# if discover is True the rows are only for the combinations which are on disk
+# rather than for every combination of the lists, which then only filter the walk
+# (any of models, variables, experiments and table_ids can be None for all)
+# and zero_rows adds explicit zero rows (see get_zero_row) for the other combinations
+# the files are checked (cached in the catalog) for the validation_columns
+# and check_time also reads their time coordinates
+# with timeouts in scan_options (see list_directory) a stalled directory does not hang the survey
+# and the rows which depend on it have it in their unreachable_directories
+# shard (shard_index, n_shards) only yields the rows in that shard (see get_survey_shard)
+# and only walks the models and table_ids which have rows in it
+def iterate_survey(base_paths, models, variables, columns, experiments, table_ids, done_keys=None, read_headers=False, discover=False, zero_rows=False, check_time=False, shard=None, **scan_options):
+    # the listings which the columns need
+    # discovery needs the variable directories
+    level, stat_files = get_column_listings(columns)
+    if read_headers:
+        level = "files"
+    if discover and listing_levels.index(level) < listing_levels.index("variable"):
+        level = "variable"
 
     # loop over the list of base paths
     # to look into both canari and badc paths
     for base_path in base_paths:
+        survey_experiments = get_survey_experiments(base_path, experiments)
+        if survey_experiments is None:
+            return
+
+        # all of the canari experiments are discovered if none are given
+        experiment_filter = survey_experiments
+        if discover and experiments is None and "/gws/nopw/j04/canari/" in base_path:
+            experiment_filter = None
+
+        # the rows still to do for this base path
+        # only known after the walk for a discovery survey
+        if not discover:
+            if len(survey_experiments) == 0:
+                print("No experiments given for: ", base_path, "(use discover=True to find them)")
+                continue
+            keys = [(base_path, table_id, experiment, model, variable) for table_id in table_ids for experiment in survey_experiments for model in models for variable in variables]
+            if done_keys:
+                keys = [key for key in keys if key not in done_keys]
+            if shard is not None:
+                keys = [key for key in keys if get_survey_shard(key, shard[1]) == shard[0]]
+            if len(keys) == 0:
+                print("Base path already done: ", base_path)
+                continue
+
         print("Base path: ", base_path)
 
-        # iterate over the list of table ids
-        for table_id in table_ids:
-            # Print the table_id which is being processed
-            print("Table_id: ", table_id)
-
-            # if the base path is the canari path
-            if "/gws/nopw/j04/canari/" in base_path:
-                # iterate over the experiments and variables
-                print("Looping over experiments and variables for canari path")
-                # iterate over the experiments and variables
-                for experiment in experiments:
-                    # Print the experiment which is being processed
-                    print("Experiment: ", experiment)
-                    
-                    # iterate over the models and variables
-                    for model in models:
-
-                        # Print the model which is being processed
-                        print("Model: ", model)
-
-                        for variable in variables:
-
-                            # Print the variable which is being processed
-                            print("Variable: ", variable)
-                            # create a dictionary to hold the values for this combination of model and variable
-                            row_dict = {}
-
-                            # iterate over the columns and add the values to the dictionary
-                            for column in columns:
-                                # get the function corresponding to the column name
-                                column_function = column_functions[column]
-
-                                # call the function to get the value for the current model, variable, and column and experiment
-                                value = column_function(base_path, table_id, experiment, model, variable)
-
-                                # add the column value to the dictionary
-                                row_dict[column] = value
-
-                            # append the row dictionary to the dataframe as a new row
-                            df = df.append(row_dict, ignore_index=True)
-            elif "badc/cmip6/data/CMIP6/" in base_path:
-                # if the base path ends in CMIP
-                # then the experiment is "historical"
-                if base_path.endswith("/CMIP"):
-                    # set the experiment to "historical"
-                    experiment = "historical"
-                    print("Experiment: ", experiment)
-
-                    # iterate over the models and variables
-                    for model in models:
-                            
-                        # Print the model which is being processed
-                        print("Model: ", model)
-
-                        for variable in variables:
-
-                            # Print the variable which is being processed
-                            print("Variable: ", variable)
-                            # create a dictionary to hold the values for this combination of model and variable
-                            row_dict = {}
-
-                            # iterate over the columns and add the values to the dictionary
-                            for column in columns:
-                                # get the function corresponding to the column name
-                                column_function = column_functions[column]
-
-                                # call the function to get the value for the current model, variable, and column and experiment
-                                value = column_function(base_path, table_id, experiment, model, variable)
-
-                                # add the column value to the dictionary
-                                row_dict[column] = value
-
-                            # append the row dictionary to the dataframe as a new row
-                            df = df.append(row_dict, ignore_index=True)
-                elif base_path.endswith("/DCPP"):
-                    # set the experiment to "dcppA-hindcast"
-                    experiment = "dcppA-hindcast"
-
-                    # iterate over the models and variables
-                    for model in models:
-                            
-                        # Print the model which is being processed
-                        print("Model: ", model)
-
-                        for variable in variables:
-
-                            # Print the variable which is being processed
-                            print("Variable: ", variable)
-                            # create a dictionary to hold the values for this combination of model and variable
-                            row_dict = {}
-
-                            # iterate over the columns and add the values to the dictionary
-                            for column in columns:
-                                # get the function corresponding to the column name
-                                column_function = column_functions[column]
-
-                                # call the function to get the value for the current model, variable, and column and experiment
-                                value = column_function(base_path, table_id, experiment, model, variable)
-
-                                # add the column value to the dictionary
-                                row_dict[column] = value
-
-                            # append the row dictionary to the dataframe as a new row
-                            df = df.append(row_dict, ignore_index=True)
-                else:
-                    print("End of base path not recognized")
-                    return None
+        # walk the base path once (as deep as the columns need)
+        # to build the DRS index which all of the columns are then answered from
+        # the index is left empty if the columns need no listings
+        # for a shard, only the models and table_ids with rows in it are walked
+        walk_models, walk_table_ids = models, table_ids
+        if shard is not None and not discover:
+            walk_models = [model for model in models if any(key[3] == model for key in keys)]
+            walk_table_ids = [table_id for table_id in table_ids if any(key[1] == table_id for key in keys)]
+        index = {}
+        if level is not None:
+            with profile_scope("base_path", "index", base_path):
+                max_level = None if level == "files" else level
+                index = build_drs_index(base_path, models=walk_models, experiments=experiment_filter, table_ids=walk_table_ids, variables=variables, max_level=max_level, stat_files=stat_files, **scan_options)
+
+        # save the listings for this base path
+        if scan_options.get("catalog") is not None:
+            with catalog_lock:
+                scan_options["catalog"].commit()
+
+        # read the headers of all the files at once
+        headers = None
+        if read_headers:
+            with profile_scope("base_path", "headers", base_path):
+                headers = get_file_headers(get_index_file_paths(index, base_path), catalog=scan_options.get("catalog"), max_workers=scan_options.get("max_workers"), timeouts=scan_options.get("timeouts"), mount_limits=scan_options.get("mount_limits"))
+
+        # check all of the files at once
+        checks = None
+        if any(column in validation_columns for column in columns):
+            with profile_scope("base_path", "validation", base_path):
+                checks = validate_files(get_index_file_paths(index, base_path), catalog=scan_options.get("catalog"), max_workers=scan_options.get("max_workers"), check_time=check_time, timeouts=scan_options.get("timeouts"), mount_limits=scan_options.get("mount_limits"))
+
+        # the directories (and files) which timed out (with timeouts in scan_options)
+        unreachable = get_unreachable_directories(base_path)
+        if len(unreachable) > 0:
+            print("Unreachable directories: ", len(unreachable))
+
+        # the rows for the combinations which were found
+        # in the order of the lists (or sorted, if a list is not given)
+        # with the other combinations of the lists too for zero_rows
+        if discover:
+            present = get_discovered_keys(index, base_path)
+            orders = [table_ids, experiment_filter, models, variables]
+            orders = [order if order is not None else sorted(set(key[i + 1] for key in present)) for i, order in enumerate(orders)]
+            keys = [(base_path,) + combination for combination in itertools.product(*orders)]
+            if not zero_rows:
+                keys = [key for key in keys if key in present]
+            if done_keys:
+                keys = [key for key in keys if key not in done_keys]
+            if shard is not None:
+                keys = [key for key in keys if get_survey_shard(key, shard[1]) == shard[0]]
+            print("Rows found: ", sum(1 for key in keys if key in present), "of", len(keys))
+
+        previous_key = (base_path, None, None, None, None)
+        for key in keys:
+            base_path, table_id, experiment, model, variable = key
+
+            # Print the table_id, experiment and model when they change
+            for name, value, previous_value in zip(["Table_id: ", "Experiment: ", "Model: "], key[1:4], previous_key[1:4]):
+                if value != previous_value:
+                    print(name, value)
+            print("Variable: ", variable)
+            previous_key = key
+
+            # get the values for this combination of model and variable
+            if discover and key not in present:
+                yield key, get_zero_row(base_path, table_id, experiment, model, variable, columns)
             else:
-                print("Base path not recognized")
-                return None
-    return df
\ No newline at end of file
+                yield key, evaluate_row(base_path, table_id, experiment, model, variable, columns, index=index, headers=headers, checks=checks, unreachable=unreachable)
+
+# Define a function to fill in the dataframe
+# if catalog is the path of an on-disk catalog then only the directories
+# which have changed since the last survey are re-listed
+# and the survey is saved to the catalog
+# max_workers is the number of directories to list at once
+# e.g. 16-32 on the JASMIN sci nodes, the rows are in the same order as for a serial survey
+# scan_options are passed on to build_drs_index, e.g. use_asyncio=True and mount_limits
+# and read_headers=True to take the years_range from the NetCDF headers
+# or discover=True (and zero_rows) for the rows which are on disk (see iterate_survey)
+# if profile is True the survey is profiled (see stop_profile)
+# and (df, profile) is returned
+# see stream_survey to write the rows out as they are computed
+def fill_dataframe(base_paths, models, variables, columns, experiments, table_ids, catalog=None, max_workers=None, profile=False, **scan_options):
+    if profile:
+        start_profile()
+        try:
+            df = fill_dataframe(base_paths, models, variables, columns, experiments, table_ids, catalog=catalog, max_workers=max_workers, **scan_options)
+        finally:
+            survey_profile = stop_profile()
+        return df, survey_profile
+
+    # check that all the base paths are recognized
+    for base_path in base_paths:
+        if get_survey_experiments(base_path, experiments) is None:
+            return None
+
+    # the health of the mounts for this survey only
+    reset_mount_health()
+
+    # create a dictionary to hold the values for each column
+    # the dataframe is built from these at the end
+    data = {column: [] for column in columns}
+
+    # open the catalog of directory listings
+    catalog_connection = open_catalog(catalog) if catalog is not None else None
+
+    for key, row_dict in iterate_survey(base_paths, models, variables, columns, experiments, table_ids, catalog=catalog_connection, max_workers=max_workers, **scan_options):
+        # append the row values to the columns
+        for column in columns:
+            data[column].append(row_dict[column])
+
+    # build the dataframe from the columns
+    df = build_survey_dataframe(data, columns)
+
+    # save the survey and the health of the mounts to the catalog
+    if catalog_connection is not None:
+        save_survey(catalog_connection, df)
+        save_mount_health(catalog_connection)
+        catalog_connection.close()
+
+    return df
+
+# The columns which hold the key of each row in a survey sink
+survey_key_columns = [ "key_base_path", "key_table_id", "key_experiment", "key_model", "key_variable" ]
+
+# Define a function to get the format of a survey sink from its extension
+# .jsonl, .csv, or .parquet (a directory of parquet files, one per batch)
+def get_sink_format(sink):
+    for sink_format in ["jsonl", "csv", "parquet"]:
+        if sink.endswith("." + sink_format):
+            return sink_format
+    raise ValueError("Sink must end in .jsonl, .csv or .parquet: " + sink)
+
+# Define a function to convert a value to JSON
+# for the numpy integers in the rows
+def json_default(value):
+    if hasattr(value, "item"):
+        return value.item()
+    return str(value)
+
+# Define a function to write a batch of sink records to a survey sink
+# each record holds the key columns and then the survey columns
+def write_sink_batch(sink, records, columns):
+    sink_format = get_sink_format(sink)
+    if sink_format == "jsonl":
+        with open(sink, "a") as f:
+            for record in records:
+                f.write(json.dumps(record, default=json_default) + "\n")
+        return
+
+    # the same column types in every batch
+    # the lists as JSON, the counts as integers and the rest as strings
+    df = pd.DataFrame(records, columns=survey_key_columns + columns)
+    for column in df.columns:
+        if column in list_columns:
+            df[column] = [json.dumps(value, default=json_default) if value is not None else None for value in df[column]]
+            df[column] = df[column].astype("string")
+        elif column in integer_columns:
+            df[column] = df[column].astype("Int64")
+        else:
+            df[column] = df[column].astype("string")
+
+    if sink_format == "csv":
+        df.to_csv(sink, mode="a", header=not os.path.exists(sink), index=False)
+    else:
+        os.makedirs(sink, exist_ok=True)
+        part = len([name for name in os.listdir(sink) if name.endswith(".parquet")])
+        df.to_parquet(os.path.join(sink, "part-" + str(part).zfill(5) + ".parquet"), index=False)
+
+# Define a function to read the records in a survey sink
+# returns a dataframe with the key columns and the survey columns
+def read_sink_records(sink):
+    sink_format = get_sink_format(sink)
+    if sink_format == "jsonl":
+        with open(sink) as f:
+            records = [json.loads(line) for line in f if line.strip()]
+
+        # object columns, so the missing values stay None (not NaN) as in the rows
+        columns = list(records[0]) if len(records) > 0 else []
+        return pd.DataFrame({column: pd.Series([record.get(column) for record in records], dtype=object) for column in columns}, columns=columns)
+
+    if sink_format == "csv":
+        df = pd.read_csv(sink, dtype=str, keep_default_na=False, na_values=[""])
+    else:
+        df = pd.read_parquet(sink)
+
+    # back to the values in the rows
+    for column in df.columns:
+        values = df[column].astype(object).where(df[column].notna(), None)
+        if column in list_columns:
+            values = [json.loads(value) if value is not None else None for value in values]
+        df[column] = pd.Series(values, dtype=object, index=df.index)
+
+    return df
+
+# Define a function to read a survey sink into a dataframe
+# with the same columns and dtypes as fill_dataframe
+def read_survey_sink(sink):
+    df = read_sink_records(sink)
+    columns = [column for column in df.columns if column not in survey_key_columns]
+
+    return build_survey_dataframe({column: df[column].tolist() for column in columns}, columns)
+
+# Define a generator which streams the survey rows as they are computed
+# yields the row dictionaries in the same order as fill_dataframe
+# if sink is given (a .jsonl, .csv or .parquet path) the rows are written to it
+# in batches of batch_size, and any rows not yet written are written if the survey fails
+# if resume is True the rows already in the sink are skipped
+# so a failed survey can be carried on from where it stopped
+# e.g. for row in stream_survey(..., sink="survey.jsonl", resume=True): pass
+# then read_survey_sink("survey.jsonl")
+def stream_survey(base_paths, models, variables, columns, experiments, table_ids, sink=None, batch_size=100, resume=False, catalog=None, max_workers=None, **scan_options):
+    # the rows which are already in the sink
+    done_keys = set()
+    if sink is not None and os.path.exists(sink):
+        if not resume:
+            raise FileExistsError("Sink already exists, use resume=True to carry on: " + sink)
+        records = read_sink_records(sink)
+        if len(records) > 0:
+            done_keys = set(records[survey_key_columns].itertuples(index=False, name=None))
+        print("Rows already done: ", len(done_keys))
+
+    # the health of the mounts for this survey only
+    reset_mount_health()
+
+    # open the catalog of directory listings
+    catalog_connection = open_catalog(catalog) if catalog is not None else None
+
+    batch = []
+    try:
+        for key, row_dict in iterate_survey(base_paths, models, variables, columns, experiments, table_ids, done_keys=done_keys, catalog=catalog_connection, max_workers=max_workers, **scan_options):
+            if sink is not None:
+                batch.append(dict(zip(survey_key_columns, key), **row_dict))
+                if len(batch) >= batch_size:
+                    write_sink_batch(sink, batch, columns)
+                    batch = []
+
+            yield row_dict
+    finally:
+        # write the last rows, even if the survey failed
+        if sink is not None and len(batch) > 0:
+            write_sink_batch(sink, batch, columns)
+
+        if catalog_connection is not None:
+            save_mount_health(catalog_connection)
+            catalog_connection.close()
+
+# Define a function to get the shard of a survey row
+# from its (base_path, model, experiment, table_id), so all of the variables
+# of a model's table are in the same shard and the shards of a survey are walked separately
+# the hash is the same on every node and python process (unlike hash())
+# key is (base_path, table_id, experiment, model, variable) as in iterate_survey
+def get_survey_shard(key, n_shards):
+    base_path, table_id, experiment, model, variable = key
+    digest = hashlib.sha1("\0".join([base_path, model, experiment, table_id]).encode()).digest()
+    return int.from_bytes(digest[:8], "big") % n_shards
+
+# The scan options which change the rows of a survey
+# and so must be the same for all of the shards
+survey_shard_options = [ "read_headers", "discover", "zero_rows", "check_time", "version" ]
+
+# Define a function to get the path of the partial catalog of a shard
+def get_shard_catalog(partial_dir, shard_index, n_shards):
+    return os.path.join(partial_dir, "shard-" + str(shard_index).zfill(5) + "-of-" + str(n_shards).zfill(5) + ".sqlite")
+
+# Define a function to run one shard of a survey into its partial catalog in partial_dir
+# which holds the directory listings of the shard and its rows (with their keys)
+# shard_index and n_shards default to those of a SLURM array task
+# e.g. for sbatch --array=0-15:
+# python -c "import functions as fnc, dictionaries as dic; fnc.run_survey_shard('partials', dic.base_paths, dic.models, dic.variables, dic.columns, dic.experiments, dic.table_ids)"
+# then merge_survey_shards("partials", "model_charac.sqlite")
+# a shard which has already finished is not run again
+def run_survey_shard(partial_dir, base_paths, models, variables, columns, experiments, table_ids, shard_index=None, n_shards=None, max_workers=None, **scan_options):
+    if shard_index is None:
+        shard_index = int(os.environ["SLURM_ARRAY_TASK_ID"]) - int(os.environ.get("SLURM_ARRAY_TASK_MIN", 0))
+    if n_shards is None:
+        n_shards = int(os.environ["SLURM_ARRAY_TASK_COUNT"])
+
+    # what the survey is, for checking that the shards go together
+    survey = { "base_paths": list(base_paths), "models": models, "variables": variables, "columns": list(columns), "experiments": experiments, "table_ids": table_ids }
+    survey.update({option: scan_options[option] for option in survey_shard_options if option in scan_options})
+
+    os.makedirs(partial_dir, exist_ok=True)
+    partial = get_shard_catalog(partial_dir, shard_index, n_shards)
+    catalog_connection = open_catalog(partial)
+    try:
+        catalog_connection.execute("CREATE TABLE IF NOT EXISTS survey_shard (shard_index INTEGER, n_shards INTEGER, survey TEXT, n_rows INTEGER)")
+        if catalog_connection.execute("SELECT * FROM survey_shard").fetchone() is not None:
+            print("Shard already done: ", partial)
+            return partial
+
+        print("Shard: ", shard_index, "of", n_shards)
+        # the health of the mounts for this shard only
+        reset_mount_health()
+        records = []
+        for key, row_dict in iterate_survey(base_paths, models, variables, columns, experiments, table_ids, shard=(shard_index, n_shards), catalog=catalog_connection, max_workers=max_workers, **scan_options):
+            records.append(dict(zip(survey_key_columns, key), **row_dict))
+
+        # the rows with their keys, and then the shard as done
+        save_survey(catalog_connection, pd.DataFrame(records, columns=survey_key_columns + list(columns)))
+        save_mount_health(catalog_connection)
+        catalog_connection.execute("INSERT INTO survey_shard VALUES (?, ?, ?, ?)", (shard_index, n_shards, json.dumps(survey), len(records)))
+        catalog_connection.commit()
+    finally:
+        catalog_connection.close()
+
+    return partial
+
+# Define a function to run all of the shards of a survey as local processes
+# (e.g. for testing, or on a single large node)
+# max_processes shards are run at once, the processes are spawned
+# so scripts calling it need an if __name__ == "__main__" guard
+# returns the list of partial catalogs
+def run_survey_shards(partial_dir, n_shards, base_paths, models, variables, columns, experiments, table_ids, max_processes=None, **scan_options):
+    arguments = [(partial_dir, base_paths, models, variables, columns, experiments, table_ids, shard_index, n_shards) for shard_index in range(n_shards)]
+    if max_processes is None or max_processes <= 1:
+        return [run_survey_shard(*shard_arguments, **scan_options) for shard_arguments in arguments]
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_processes, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = [pool.submit(run_survey_shard, *shard_arguments, **scan_options) for shard_arguments in arguments]
+        return [future.result() for future in futures]
+
+# Define a function to get the position of a survey value in its list
+# so the merged rows are in the same order as fill_dataframe
+# the values are sorted if the list is None (as for a discovery survey)
+def get_survey_order(values, order):
+    if order is None:
+        return list(values)
+    positions = {value: position for position, value in enumerate(order)}
+    return [positions.get(value, len(positions)) for value in values]
+
+# Define a function to merge the partial catalogs of the shards of a survey into one catalog
+# partials is a list of partial catalogs or the directory they are in
+# raises a ValueError if the shards are not all of the same survey, if any are missing (or not finished)
+# or if a row is in more than one shard with different values
+# the merged survey (without the keys) and the cached listings, headers and checks
+# of all the shards are saved to catalog, which can then be used by fill_dataframe and load_catalog
+# with the health of the mounts added up over the shards (see merge_mount_health)
+# returns the merged survey dataframe
+def merge_survey_shards(partials, catalog):
+    if isinstance(partials, str):
+        partials = sorted(glob.glob(os.path.join(partials, "shard-*-of-*.sqlite")))
+
+    # the shard of each partial, and its rows (as stored, with the lists as JSON)
+    shards = {}
+    surveys = set()
+    frames = []
+    for partial in partials:
+        connection = sqlite3.connect(partial)
+        try:
+            shard = connection.execute("SELECT * FROM survey_shard").fetchone() if connection.execute("SELECT name FROM sqlite_master WHERE name = 'survey_shard'").fetchone() is not None else None
+            if shard is None:
+                raise ValueError("Shard not finished: " + partial)
+            shard_index, n_shards, survey, n_rows = shard
+            if (shard_index, n_shards) in shards:
+                raise ValueError("Shard " + str(shard_index) + " of " + str(n_shards) + " in both " + shards[(shard_index, n_shards)] + " and " + partial)
+            shards[(shard_index, n_shards)] = partial
+            surveys.add(survey)
+            frames.append(pd.read_sql("SELECT * FROM survey", connection))
+        finally:
+            connection.close()
+
+    if len(surveys) != 1:
+        raise ValueError("Partial catalogs are not all from the same survey")
+    n_shards = set(key[1] for key in shards)
+    if len(n_shards) != 1:
+        raise ValueError("Partial catalogs have different numbers of shards: " + str(sorted(n_shards)))
+    n_shards = n_shards.pop()
+    missing = sorted(set(range(n_shards)) - set(key[0] for key in shards))
+    if len(missing) > 0:
+        raise ValueError("Missing shards: " + str(missing))
+    survey = json.loads(surveys.pop())
+
+    # the rows which are in more than one shard must be the same
+    df = pd.concat(frames, ignore_index=True)
+    duplicated = df.duplicated(survey_key_columns, keep=False)
+    if duplicated.any():
+        distinct = df[duplicated].astype(object).where(df[duplicated].notna(), None).astype(str).drop_duplicates()
+        conflicts = distinct[distinct.duplicated(survey_key_columns, keep=False)]
+        if len(conflicts) > 0:
+            raise ValueError("Conflicting rows in the shards: " + str(sorted(set(conflicts[survey_key_columns].itertuples(index=False, name=None)))[:10]))
+        df = df.drop_duplicates(survey_key_columns).reset_index(drop=True)
+
+    # in the same order as fill_dataframe
+    order = pd.DataFrame({
+        "base_path": get_survey_order(df["key_base_path"], survey["base_paths"]),
+        "table_id": get_survey_order(df["key_table_id"], survey["table_ids"]),
+        "experiment": get_survey_order(df["key_experiment"], survey["experiments"]),
+        "model": get_survey_order(df["key_model"], survey["models"]),
+        "variable": get_survey_order(df["key_variable"], survey["variables"]),
+    })
+    df = df.loc[order.sort_values(list(order.columns), kind="stable").index].reset_index(drop=True)
+    df = decode_survey(df.drop(columns=survey_key_columns))
+
+    # the merged catalog, with the cached tables of all the shards
+    catalog_connection = open_catalog(catalog)
+    try:
+        health = []
+        for partial in partials:
+            catalog_connection.execute("ATTACH DATABASE ? AS partial", (partial,))
+            tables = catalog_connection.execute("SELECT name, sql FROM partial.sqlite_master WHERE type = 'table' AND name NOT IN ('survey', 'survey_shard')").fetchall()
+            for name, sql in tables:
+                # the mount_health table has no key, so it is added up below
+                if name == "mount_health":
+                    health.append(pd.read_sql("SELECT * FROM partial.mount_health", catalog_connection))
+                    continue
+                catalog_connection.execute(sql.replace("CREATE TABLE", "CREATE TABLE IF NOT EXISTS", 1))
+                catalog_connection.execute("INSERT OR REPLACE INTO " + name + " SELECT * FROM partial." + name)
+            catalog_connection.commit()
+            catalog_connection.execute("DETACH DATABASE partial")
+
+        merge_mount_health(health).to_sql("mount_health", catalog_connection, if_exists="replace", index=False)
+        save_survey(catalog_connection, df)
+    finally:
+        catalog_connection.close()
+
+    print("Merged ", len(partials), "shards: ", len(df), "rows")
+    return df
+
+# The columns which identify a file in both the badc and canari layouts
+# the time range is from the filename, e.g. "185001-201412"
+sync_key_columns = [ "source", "experiment", "member", "table_id", "variable", "grid", "time_range" ]
+
+# Define a function to get the inventory of the files in a DRS index
+# returns a dataframe with a row per file with the DRS keys,
+# the time range ("" for files without one), the size and the path
+# only the latest version of each file is kept
+def get_file_inventory(index, base_path):
+    records = []
+    for keys, filename, size in iterate_index_files(index):
+        match = filename_regex.match(filename)
+        time_range = match.group("start") + "-" + match.group("end") if match is not None and match.group("start") is not None else ""
+        records.append(keys[1:] + (time_range, filename, size, get_index_file_path(base_path, keys, filename)))
+
+    inventory = pd.DataFrame(records, columns=["source", "experiment", "member", "table_id", "variable", "grid", "version", "time_range", "filename", "size", "path"])
+    inventory = inventory.sort_values("version", kind="stable").drop_duplicates(sync_key_columns, keep="last")
+
+    return inventory.reset_index(drop=True)
+
+# Define a function to hash the keys of the files in an inventory
+# returns a numpy array with a 64 bit hash per file
+def hash_inventory_keys(inventory):
+    return pd.util.hash_pandas_object(inventory[sync_key_columns], index=False).to_numpy()
+
+# Define a function to plan the copying of the badc files to canari
+# the inventories (from get_file_inventory) are joined on the hashed keys
+# returns a dictionary with the dataframes of the files which are
+# "missing" from canari, "extra" in canari (not in badc),
+# "size_mismatch" (a different size in canari), "zero_length" (empty in canari)
+# and "empty_source" (empty in badc, so not worth copying)
+# "transfer" is the files to copy, with the path and destination
+# and "bytes_to_transfer" is the sum of their sizes
+def plan_sync(badc_inventory, canari_inventory, canari_base_path):
+    badc_keys = hash_inventory_keys(badc_inventory)
+    canari_keys = hash_inventory_keys(canari_inventory)
+
+    # the position of each badc file in the canari inventory, -1 if missing
+    # and the other way around
+    canari_positions = pd.Index(canari_keys).get_indexer(badc_keys)
+    badc_positions = pd.Index(badc_keys).get_indexer(canari_keys)
+
+    badc_sizes = badc_inventory["size"].to_numpy(dtype=float)
+    canari_sizes = np.full(len(badc_inventory), np.nan)
+    matched = canari_positions >= 0
+    canari_sizes[matched] = canari_inventory["size"].to_numpy(dtype=float)[canari_positions[matched]]
+
+    empty_source = badc_sizes == 0
+    missing = ~matched & ~empty_source
+    zero_length = matched & (canari_sizes == 0) & ~empty_source
+    size_mismatch = matched & (canari_sizes != badc_sizes) & (canari_sizes != 0) & ~empty_source
+
+    badc = badc_inventory.assign(canari_size=pd.array(np.where(matched, canari_sizes, np.nan), dtype="Int64"))
+
+    # the destination of each file to copy in the canari layout
+    to_copy = missing | zero_length | size_mismatch
+    transfer = badc[to_copy]
+    transfer = transfer.assign(destination=[os.path.join(canari_base_path, experiment, "data", variable, source, filename) for experiment, variable, source, filename in zip(transfer["experiment"].tolist(), transfer["variable"].tolist(), transfer["source"].tolist(), transfer["filename"].tolist())])
+
+    plan = {
+        "missing": transfer[missing[to_copy]].reset_index(drop=True),
+        "extra": canari_inventory[badc_positions < 0].reset_index(drop=True),
+        "size_mismatch": transfer[size_mismatch[to_copy]].reset_index(drop=True),
+        "zero_length": transfer[zero_length[to_copy]].reset_index(drop=True),
+        "empty_source": badc[empty_source].reset_index(drop=True),
+        "transfer": transfer[["path", "destination", "size"]].reset_index(drop=True),
+        "bytes_to_transfer": int(transfer["size"].fillna(0).sum()),
+    }
+
+    return plan
+
+# Define a function to get the sync plan from the badc base paths
+# (e.g. the CMIP and DCPP directories) to the canari base path
+# the walks are pruned by the models, experiments, table_ids and variables lists
+# (and the canari files by their table_id, as it is not a directory in that layout)
+# scan_options are passed on to build_drs_index, e.g. catalog and max_workers
+# see plan_sync for the plan
+def get_sync_plan(badc_base_paths, canari_base_path, models=None, experiments=None, table_ids=None, variables=None, **scan_options):
+    inventories = []
+    for base_path in badc_base_paths:
+        index = build_drs_index(base_path, models=models, experiments=experiments, table_ids=table_ids, variables=variables, stat_files=True, **scan_options)
+        inventories.append(get_file_inventory(index, base_path))
+    badc_inventory = pd.concat(inventories, ignore_index=True).sort_values("version", kind="stable").drop_duplicates(sync_key_columns, keep="last")
+
+    index = build_drs_index(canari_base_path, models=models, experiments=experiments, table_ids=table_ids, variables=variables, stat_files=True, **scan_options)
+    canari_inventory = get_file_inventory(index, canari_base_path)
+    # the canari directories hold all of the table_ids, which are only in the filenames
+    if table_ids is not None:
+        canari_inventory = canari_inventory[canari_inventory["table_id"].isin(table_ids)].reset_index(drop=True)
+
+    plan = plan_sync(badc_inventory.reset_index(drop=True), canari_inventory, canari_base_path)
+
+    print("Files to transfer: ", len(plan["transfer"]), "(", plan["bytes_to_transfer"], "bytes )")
+    print("Missing: ", len(plan["missing"]), "Size mismatch: ", len(plan["size_mismatch"]), "Zero length: ", len(plan["zero_length"]), "Extra: ", len(plan["extra"]))
+
+    return plan
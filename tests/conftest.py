@@ -0,0 +1,37 @@
+# Shared fixtures for the tests
+# the tests import the modules from the top of the repository
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark
+
+# The small synthetic tree the survey tests run on
+tree_models = 2
+tree_members = 2
+tree_init_years = range(1960, 1962)
+tree_table_ids = [ "Amon", "day" ]
+tree_variables = [ "psl", "tas" ]
+
+# Define a fixture which builds the synthetic badc and canari tree once
+# returns the base paths (canari, badc CMIP, badc DCPP) and the models
+@pytest.fixture(scope="session")
+def synthetic_tree(tmp_path_factory):
+    root = str(tmp_path_factory.mktemp("synthetic"))
+    base_paths, models = benchmark.make_synthetic_tree(root, n_models=tree_models, n_members=tree_members, init_years=tree_init_years, table_ids=tree_table_ids, variables=tree_variables, empty_every=7)
+    return { "base_paths": base_paths, "models": models, "table_ids": tree_table_ids, "variables": tree_variables }
+
+# Define a fixture which makes the canari directory of a model's variable
+# i.e. <tmp_path>/gws/nopw/j04/canari/users/benhutch/<experiment>/data/<variable>/<model>
+# returns a function which returns the base path and the directory
+@pytest.fixture
+def make_canari_directory(tmp_path):
+    def make(model="MODEL", variable="tas", experiment="historical"):
+        base_path = tmp_path / "gws/nopw/j04/canari/users/benhutch"
+        directory = base_path / experiment / "data" / variable / model
+        directory.mkdir(parents=True, exist_ok=True)
+        return str(base_path), directory
+    return make
@@ -0,0 +1,107 @@
+# Tests for the time coverage of the members from their filenames
+import numpy as np
+
+import dictionaries as dic
+import functions as fnc
+
+# Define a function to get the filenames of a member
+# from (start, end) dates
+def get_filenames(ranges, member="r1i1p1f1", table_id="Amon", model="MODEL", variable="tas"):
+    return ["_".join([variable, table_id, model, "historical", member, "gn", start + "-" + end]) + ".nc" for start, end in ranges]
+
+# Define a function to create empty files in the canari layout
+# with the make_canari_directory fixture
+# returns the base path
+def make_canari_files(make_canari_directory, model, variable, filenames):
+    base_path, directory = make_canari_directory(model, variable)
+    for filename in filenames:
+        (directory / filename).write_bytes(b"\0")
+    return base_path
+
+def test_contiguous_files_are_complete():
+    filenames = get_filenames([("185001", "189912"), ("190001", "201412")])
+    coverage = fnc.get_member_coverage(filenames, "Amon")
+
+    assert coverage["n_files"].tolist() == [2]
+    assert coverage["n_gaps"].tolist() == [0]
+    assert coverage["coverage"].tolist() == [1.0]
+    assert fnc.get_coverage_columns(coverage)["complete_members"] == 1
+
+def test_gaps_overlaps_and_duplicates():
+    filenames = get_filenames([("185001", "189912"), ("191001", "201412")], member="r1i1p1f1")
+    filenames += get_filenames([("185001", "194912"), ("190001", "201412"), ("190001", "201412")], member="r2i1p1f1")
+    coverage = fnc.get_member_coverage(filenames, "Amon").set_index("member")
+
+    assert coverage.loc["r1i1p1f1", "n_gaps"] == 1
+    assert list(coverage.loc["r1i1p1f1", "gaps"]) == ["1900-01-01/1910-01-01"]
+    assert coverage.loc["r2i1p1f1", "n_gaps"] == 0
+    assert coverage.loc["r2i1p1f1", "n_overlaps"] == 1
+    assert coverage.loc["r2i1p1f1", "n_duplicates"] == 1
+
+    columns = fnc.get_coverage_columns(coverage.reset_index())
+    assert columns["complete_members"] == 1
+    assert columns["members_with_gaps"] == ["r1i1p1f1"]
+    assert columns["coverage_gaps"] == ["r1i1p1f1 1900-01-01/1910-01-01"]
+
+def test_sub_daily_ends_are_moved_on_by_the_time_step():
+    filenames = get_filenames([("185001010000", "185912311800"), ("186001010000", "186912311800")], table_id="6hr")
+    coverage = fnc.get_member_coverage(filenames, "6hr")
+
+    assert coverage["n_gaps"].tolist() == [0]
+    assert coverage["end"].tolist() == [np.datetime64("1870-01-01T00:00")]
+
+def test_360_day_files_are_contiguous():
+    # the HadGEM3 daily files end on the 30th of December
+    filenames = get_filenames([(str(year) + "0101", str(year + 9) + "1230") for year in range(1850, 1900, 10)], table_id="day", member="r1i1p1f3")
+    coverage = fnc.get_member_coverage(filenames, "day")
+
+    assert fnc.guess_filename_calendar([filename[-11:-3] for filename in filenames]) == "360_day"
+    assert coverage["n_gaps"].tolist() == [0]
+    assert coverage["coverage"].tolist() == [1.0]
+    assert fnc.get_coverage_columns(coverage)["complete_members"] == 1
+
+def test_calendar_from_the_headers(make_canari_directory):
+    model = "HadGEM3-GC31-MM"
+    filenames = get_filenames([("18500101", "18591230"), ("18600101", "18691230")], table_id="day", model=model, member="r1i1p1f3")
+    base_path = make_canari_files(make_canari_directory, model, "tas", filenames)
+    index = fnc.build_drs_index(base_path, models=[model], experiments=["historical"], variables=["tas"])
+    paths = fnc.get_index_file_paths(index, base_path)
+
+    # the calendar in the headers is used rather than the guess from the filenames
+    for calendar, n_gaps in [("360_day", 0), ("standard", 1)]:
+        headers = {path: { "path": path, "error": None, "calendar": calendar } for path in paths}
+        coverage = fnc.get_coverage(model, base_path, "historical", "day", "tas", index=index, headers=headers)
+        assert coverage["n_gaps"].tolist() == [n_gaps]
+
+def test_noleap_files_are_contiguous():
+    filenames = get_filenames([("19000101", "19040228"), ("19040301", "19091231")], table_id="day")
+
+    assert fnc.get_member_coverage(filenames, "day", calendar="noleap")["n_gaps"].tolist() == [0]
+    assert fnc.get_member_coverage(filenames, "day", calendar="standard")["n_gaps"].tolist() == [1]
+
+def test_dates_not_in_the_standard_calendar_are_nat():
+    dates = fnc.parse_filename_dates(["18500230", "18500101", None, "18501301"])
+
+    assert np.isnat(dates).tolist() == [True, False, True, True]
+    assert fnc.parse_filenames(get_filenames([("18500230", "18510230")], table_id="day"))["start_year"].tolist() == [1850]
+
+def test_dcpp_coverage_is_per_init_year():
+    filenames = get_filenames([("196011", "197012")], member="s1960-r1i1p1f1")
+    filenames += get_filenames([("196011", "196512")], member="s1960-r2i1p1f1")
+    filenames += get_filenames([("196111", "197112")], member="s1961-r1i1p1f1")
+    coverage = fnc.get_member_coverage(filenames, "Amon").set_index("member")
+
+    assert coverage.loc["s1960-r1i1p1f1", "coverage"] == 1.0
+    assert coverage.loc["s1960-r2i1p1f1", "coverage"] < 1.0
+    assert coverage.loc["s1961-r1i1p1f1", "coverage"] == 1.0
+
+def test_360_day_row_does_not_fail(make_canari_directory):
+    model = "HadGEM3-GC31-MM"
+    filenames = get_filenames([("18500101", "18591230"), ("18600101", "18690230")], table_id="day", model=model, member="r1i1p1f3")
+    base_path = make_canari_files(make_canari_directory, model, "tas", filenames)
+
+    row = fnc.evaluate_row(base_path, "day", "historical", model, "tas", dic.columns)
+
+    assert row["years_range"] == "1850-1869"
+    assert row["complete_members"] == 1
+    assert row["coverage_gaps"] == []
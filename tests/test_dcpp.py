@@ -0,0 +1,67 @@
+# Tests for the availability cube of the dcpp hindcasts
+import os
+
+import pytest
+
+import functions as fnc
+
+# The init years of the tree, with 1962 missing
+init_years = [ 1960, 1961, 1963 ]
+members = [ "r1i1p1f1", "r2i1p1f1" ]
+variables = [ "psl", "tas" ]
+
+# Define a function to build a small dcpp tree in the badc or canari layout
+# with every member of every init year except r2i1p1f1 of 1961 for psl
+# returns the base path
+def make_dcpp_tree(root, layout):
+    if layout == "badc":
+        base_path = str(root / "badc/cmip6/data/CMIP6/DCPP")
+    else:
+        base_path = str(root / "gws/nopw/j04/canari/users/benhutch")
+
+    for init_year in init_years:
+        for member in members:
+            for variable in variables:
+                if (init_year, member, variable) == (1961, "r2i1p1f1", "psl"):
+                    continue
+                label = "s" + str(init_year) + "-" + member
+                filename = "_".join([variable, "Amon", "MODEL", "dcppA-hindcast", label, "gn", str(init_year) + "11-" + str(init_year + 10) + "12"]) + ".nc"
+                if layout == "badc":
+                    directory = os.path.join(base_path, "INST", "MODEL", "dcppA-hindcast", label, "Amon", variable, "gn", "files", "d20190101")
+                else:
+                    directory = os.path.join(base_path, "dcppA-hindcast", "data", variable, "MODEL")
+                os.makedirs(directory, exist_ok=True)
+                with open(os.path.join(directory, filename), "wb") as f:
+                    f.write(b"\0")
+    return base_path
+
+@pytest.fixture(params=[ "badc", "canari" ])
+def cube(request, tmp_path):
+    base_path = make_dcpp_tree(tmp_path, request.param)
+    return fnc.build_dcpp_cube(base_path, models=["MODEL"], variables=variables)
+
+def test_dcpp_cube(cube):
+    assert cube.dims == ("model", "variable", "init_year", "member")
+    assert cube["init_year"].values.tolist() == [1960, 1961, 1962, 1963]
+    assert cube["member"].values.tolist() == members
+    assert not cube.sel(init_year=1962).any()
+    assert not cube.sel(model="MODEL", variable="psl", init_year=1961, member="r2i1p1f1")
+    assert cube.sum().item() == len(init_years) * len(members) * len(variables) - 1
+
+def test_missing_init_years(cube):
+    assert fnc.get_missing_init_years(cube) == { "MODEL": [1962] }
+    assert fnc.get_missing_init_years(cube, variables=["tas"], init_years=range(1959, 1965)) == { "MODEL": [1959, 1962, 1964] }
+
+def test_complete_ensembles(cube):
+    ensembles = fnc.get_complete_ensembles(cube)
+    assert ensembles["n_members"].tolist() == [2, 1, 0, 2]
+    assert ensembles.loc[("MODEL", 1961), "members"] == ["r1i1p1f1"]
+
+    # with only tas, the member without psl is complete
+    assert fnc.get_complete_ensembles(cube, variables=["tas"])["n_members"].tolist() == [2, 2, 0, 2]
+
+def test_consistent_ensemble(cube):
+    # no member has the missing init year
+    assert fnc.get_consistent_ensemble(cube, "MODEL") == []
+    assert fnc.get_consistent_ensemble(cube, "MODEL", init_years=init_years) == ["r1i1p1f1"]
+    assert fnc.get_consistent_ensemble(cube, "MODEL", variables=["tas"], init_years=init_years) == members
@@ -0,0 +1,86 @@
+# Tests for the discovery surveys, whose rows are the combinations found on disk
+import itertools
+
+import pandas as pd
+import pytest
+
+import dictionaries as dic
+import functions as fnc
+
+# The columns of the discovery surveys
+discover_columns = [ "data_source", "experiment", "table_id", "model", "variable", "no_members", "members_list", "years_range", "files_list" ]
+
+# Define a function to get the rows of a survey as a dataframe sorted by their keys
+def sort_rows(df):
+    return df.sort_values(["data_source", "experiment", "table_id", "model", "variable"], ignore_index=True)
+
+# Define a function to get the keys of the rows of a survey
+def get_keys(df):
+    return sorted(df[["data_source", "experiment", "table_id", "model", "variable"]].itertuples(index=False, name=None))
+
+# Define a function to get the arguments of a discovery survey of the tree
+# with a model which is not on disk
+def get_discover_arguments(tree):
+    return (tree["base_paths"], tree["models"] + ["NOT-A-MODEL"], tree["variables"], discover_columns, None, tree["table_ids"])
+
+@pytest.fixture(scope="module")
+def listed(synthetic_tree):
+    return fnc.fill_dataframe(synthetic_tree["base_paths"], synthetic_tree["models"], synthetic_tree["variables"], discover_columns, dic.experiments, synthetic_tree["table_ids"])
+
+def test_discovered_rows_without_lists(synthetic_tree, listed):
+    discovered = fnc.fill_dataframe(synthetic_tree["base_paths"], None, None, discover_columns, None, None, discover=True)
+
+    # every combination in the tree is on disk
+    # and the rows are sorted as no lists were given
+    assert get_keys(discovered) == get_keys(listed)
+    canari = discovered[discovered["data_source"] == "canari"]
+    canari_keys = list(canari[["table_id", "experiment", "model", "variable"]].astype(str).itertuples(index=False, name=None))
+    assert canari_keys == sorted(canari_keys)
+    pd.testing.assert_frame_equal(sort_rows(discovered), sort_rows(listed))
+
+def test_discovered_rows_are_filtered_by_the_lists(synthetic_tree, listed):
+    discovered = fnc.fill_dataframe(*get_discover_arguments(synthetic_tree), discover=True)
+
+    # the model which is not on disk has no rows
+    assert "NOT-A-MODEL" not in discovered["model"].tolist()
+    pd.testing.assert_frame_equal(sort_rows(discovered), sort_rows(listed))
+
+def test_zero_rows(synthetic_tree, listed):
+    discovered = fnc.fill_dataframe(*get_discover_arguments(synthetic_tree), discover=True, zero_rows=True)
+
+    zero = discovered[discovered["model"] == "NOT-A-MODEL"]
+    assert len(zero) == len(listed) // len(synthetic_tree["models"])
+    assert (zero["no_members"] == 0).all()
+    assert all(value == [] for value in zero["members_list"])
+    assert all(value == [] for value in zero["files_list"])
+    assert (zero["years_range"] == "No files").all()
+
+    found = discovered[discovered["model"] != "NOT-A-MODEL"]
+    pd.testing.assert_frame_equal(sort_rows(found.astype({"model": str})), sort_rows(listed.astype({"model": str})))
+
+def test_resumed_discovery(synthetic_tree, tmp_path):
+    reference = fnc.fill_dataframe(*get_discover_arguments(synthetic_tree), discover=True, zero_rows=True)
+    sink = str(tmp_path / "survey.jsonl")
+
+    stream = fnc.stream_survey(*get_discover_arguments(synthetic_tree), sink=sink, batch_size=5, discover=True, zero_rows=True)
+    first_rows = list(itertools.islice(stream, 11))
+    stream.close()
+    rest = list(fnc.stream_survey(*get_discover_arguments(synthetic_tree), sink=sink, batch_size=5, resume=True, discover=True, zero_rows=True))
+
+    assert len(first_rows) + len(rest) == len(reference)
+    pd.testing.assert_frame_equal(fnc.read_survey_sink(sink), reference)
+
+def test_sharded_discovery(synthetic_tree, tmp_path):
+    arguments = (synthetic_tree["base_paths"], None, synthetic_tree["variables"], discover_columns, None, synthetic_tree["table_ids"])
+    reference = fnc.fill_dataframe(*arguments, discover=True)
+
+    partials = fnc.run_survey_shards(str(tmp_path / "partials"), 3, *arguments, discover=True)
+    merged = fnc.merge_survey_shards(partials, str(tmp_path / "merged.sqlite"))
+    pd.testing.assert_frame_equal(merged, reference)
+
+def test_no_experiments_without_discover(synthetic_tree, capsys):
+    canari = [base_path for base_path in synthetic_tree["base_paths"] if "/gws/nopw/j04/canari/" in base_path]
+    df = fnc.fill_dataframe(canari, synthetic_tree["models"], synthetic_tree["variables"], discover_columns, None, synthetic_tree["table_ids"])
+
+    assert len(df) == 0
+    assert "No experiments given" in capsys.readouterr().out
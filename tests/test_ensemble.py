@@ -0,0 +1,83 @@
+# Tests for loading ensembles, from the NetCDF files and from their Zarr mirror
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+import functions as fnc
+
+# Define a function to write the files of a small ensemble in the canari layout
+# with the make_canari_directory fixture
+# returns the base path
+def make_ensemble(make_canari_directory, model="MODEL", variable="tas", members=("r1i1p1f1", "r2i1p1f1")):
+    base_path, directory = make_canari_directory(model, variable)
+    for i, member in enumerate(members):
+        for start, end in [("185001", "185012"), ("185101", "185112")]:
+            times = pd.date_range(start[:4] + "-01-01", periods=12, freq="MS")
+            values = np.full((12, 3, 4), i, dtype="f4")
+            ds = xr.Dataset({variable: (("time", "lat", "lon"), values)}, coords={"time": times, "lat": np.arange(3.0), "lon": np.arange(4.0)})
+            filename = "_".join([variable, "Amon", model, "historical", member, "gn", start + "-" + end]) + ".nc"
+            ds.to_netcdf(directory / filename)
+    return base_path
+
+def test_catalog_path_reads_the_zarr_mirror(make_canari_directory, tmp_path):
+    base_path = make_ensemble(make_canari_directory)
+    catalog = str(tmp_path / "catalog.sqlite")
+    store = str(tmp_path / "mirror.zarr")
+
+    from_files = fnc.load_ensemble("MODEL", base_path, "historical", "Amon", "tas")
+    assert fnc.write_zarr_mirror(store, "MODEL", base_path, "historical", "Amon", "tas", catalog=catalog) == ["r1i1p1f1", "r2i1p1f1"]
+
+    # the path of the catalog is opened to find the mirror
+    assert fnc.get_ensemble_source("MODEL", base_path, "historical", "Amon", "tas", catalog=catalog)[0]["store"] == store
+    from_mirror = fnc.load_ensemble("MODEL", base_path, "historical", "Amon", "tas", catalog=catalog)
+    # the mirror has all of the times in one chunk, the files one chunk per file
+    assert from_mirror["tas"].chunks[1] == (24,)
+    assert from_files["tas"].chunks[1] == (12, 12)
+    xr.testing.assert_allclose(from_mirror["tas"].load(), from_files["tas"].load())
+
+    stats = fnc.write_ensemble_stats(str(tmp_path / "stats.zarr"), "MODEL", base_path, "historical", "Amon", "tas", catalog=catalog)
+    assert np.allclose(stats["tas_mean"].values, 0.5)
+    assert (stats["tas_count"].values == 2).all()
+
+def test_mirror_without_all_of_the_members(make_canari_directory, tmp_path):
+    base_path = make_ensemble(make_canari_directory)
+    catalog = str(tmp_path / "catalog.sqlite")
+    store = str(tmp_path / "mirror.zarr")
+    fnc.write_zarr_mirror(store, "MODEL", base_path, "historical", "Amon", "tas", catalog=catalog)
+
+    # a member added on disk after the mirror was written
+    make_ensemble(make_canari_directory, members=("r1i1p1f1", "r2i1p1f1", "r3i1p1f1"))
+    assert fnc.get_ensemble_source("MODEL", base_path, "historical", "Amon", "tas", catalog=catalog)[0] is None
+    ensemble = fnc.load_ensemble("MODEL", base_path, "historical", "Amon", "tas", catalog=catalog)
+    assert ensemble["member"].values.tolist() == ["r1i1p1f1", "r2i1p1f1", "r3i1p1f1"]
+    stats = fnc.write_ensemble_stats(str(tmp_path / "stats.zarr"), "MODEL", base_path, "historical", "Amon", "tas", catalog=catalog)
+    assert (stats["tas_count"].values == 3).all()
+
+    # the members in the mirror can still be read from it
+    mirror, member_paths = fnc.get_ensemble_source("MODEL", base_path, "historical", "Amon", "tas", members=["r1i1p1f1", "r2i1p1f1"], catalog=catalog)
+    assert mirror["members"] == ["r1i1p1f1", "r2i1p1f1"]
+
+    # but not if the checks leave out any of their files
+    paths = [path for member_paths in member_paths.values() for path in member_paths]
+    checks = {path: { "status": "ok" } for path in paths}
+    checks[paths[0]] = { "status": "truncated" }
+    mirror, checked_paths = fnc.get_ensemble_source("MODEL", base_path, "historical", "Amon", "tas", members=["r1i1p1f1", "r2i1p1f1"], checks=checks, catalog=catalog)
+    assert mirror is None
+    assert paths[0] not in checked_paths["r1i1p1f1"]
+
+def test_catalog_path_without_a_mirror(make_canari_directory, tmp_path):
+    base_path = make_ensemble(make_canari_directory)
+    catalog = str(tmp_path / "catalog.sqlite")
+
+    ensemble = fnc.load_ensemble("MODEL", base_path, "historical", "Amon", "tas", catalog=catalog)
+    assert ensemble.sizes["member"] == 2
+    assert ensemble.sizes["time"] == 24
+
+def test_max_workers_lists_the_directories_at_once(make_canari_directory):
+    base_path = make_ensemble(make_canari_directory)
+
+    serial = fnc.load_ensemble("MODEL", base_path, "historical", "Amon", "tas")
+    listed = fnc.load_ensemble("MODEL", base_path, "historical", "Amon", "tas", max_workers=4)
+    # still lazy, read from the files when used
+    assert listed["tas"].chunks is not None
+    xr.testing.assert_identical(listed.load(), serial.load())
@@ -0,0 +1,82 @@
+# Tests for the queries of a survey, from the survey index and the member bitsets
+import pandas as pd
+
+import functions as fnc
+
+# Define a function to get the filename of a member's file
+def get_filename(variable, experiment, member, time_range):
+    return "_".join([variable, "Amon", "MODEL", experiment, member, "gn", time_range]) + ".nc"
+
+# Define a function to get a survey row from its keys and members
+# with a file per member (two for historical)
+def get_row(data_source, experiment, variable, members):
+    if experiment == "historical":
+        files = [get_filename(variable, experiment, member, time_range) for member in members for time_range in ["185001-189912", "190001-201412"]]
+    else:
+        files = [get_filename(variable, experiment, member, member[1:5] + "11-" + member[1:5] + "12") for member in members]
+    return { "data_source": data_source, "experiment": experiment, "table_id": "Amon", "model": "MODEL", "variable": variable, "members_list": members, "files_list": files }
+
+# A small survey, with members which are in one data source or the other
+survey = pd.DataFrame([
+    get_row("canari", "dcppA-hindcast", "psl", ["s1960-r1i1p1f1", "s1960-r2i1p1f1", "s1961-r1i1p1f1"]),
+    get_row("canari", "dcppA-hindcast", "tas", ["s1960-r1i1p1f1", "s1961-r1i1p1f1"]),
+    get_row("badc", "dcppA-hindcast", "psl", ["s1960-r2i1p1f1"]),
+    get_row("badc", "dcppA-hindcast", "tas", ["s1960-r2i1p1f1", "s1960-r3i1p1f1"]),
+    get_row("canari", "historical", "tas", ["r1i1p1f1"]),
+    get_row("badc", "historical", "tas", []),
+])
+
+def test_query_members_and_files():
+    survey_index = fnc.build_survey_index(survey)
+
+    assert fnc.query_members(survey_index, data_source="canari", experiment="dcppA-hindcast", variable="psl") == ["s1960-r1i1p1f1", "s1960-r2i1p1f1", "s1961-r1i1p1f1"]
+    # the members of both data sources
+    assert fnc.query_members(survey_index, experiment="dcppA-hindcast", variable="tas") == ["s1960-r1i1p1f1", "s1960-r2i1p1f1", "s1960-r3i1p1f1", "s1961-r1i1p1f1"]
+    # the rows with the member
+    assert fnc.query_members(survey_index, variable="tas", member="s1960-r3i1p1f1") == ["s1960-r2i1p1f1", "s1960-r3i1p1f1"]
+    assert len(fnc.query_survey(survey_index, experiment="dcppA-hindcast", member="s1960-r2i1p1f1")) == 3
+
+    assert fnc.query_files(survey_index, data_source="canari", experiment="historical") == [get_filename("tas", "historical", "r1i1p1f1", "185001-189912"), get_filename("tas", "historical", "r1i1p1f1", "190001-201412")]
+    assert fnc.query_files(survey_index, member="s1960-r2i1p1f1", data_source="canari") == [get_filename("psl", "dcppA-hindcast", "s1960-r2i1p1f1", "196011-196012")]
+    assert len(fnc.query_files(survey_index, experiment="dcppA-hindcast")) == 8
+
+def test_query_available():
+    survey_index = fnc.build_survey_index(survey)
+
+    assert fnc.query_available(survey_index, data_source="canari", experiment="historical")
+    assert fnc.query_available(survey_index, variable="tas", member="s1961-r1i1p1f1")
+    # a row without members, and keys which are not in the survey
+    assert not fnc.query_available(survey_index, data_source="badc", experiment="historical")
+    assert not fnc.query_available(survey_index, model="NOT-A-MODEL")
+    assert not fnc.query_available(survey_index, variable="psl", member="s1960-r3i1p1f1")
+    assert fnc.query_members(survey_index, model="NOT-A-MODEL") == []
+
+def test_coavailable_members():
+    bitsets = fnc.build_member_bitsets(survey)
+
+    coavailable = fnc.get_coavailable_members(bitsets, "MODEL", "dcppA-hindcast", "Amon", ["psl", "tas"])
+    assert coavailable == {
+        "canari": ["s1960-r1i1p1f1", "s1961-r1i1p1f1"],
+        "badc": ["s1960-r2i1p1f1"],
+        # each variable in either data source
+        "any": ["s1960-r1i1p1f1", "s1960-r2i1p1f1", "s1961-r1i1p1f1"],
+    }
+    assert fnc.get_coavailable_members(bitsets, "NOT-A-MODEL", "dcppA-hindcast", "Amon", ["psl"]) == { "canari": [], "badc": [], "any": [] }
+
+def test_availability_matrix():
+    bitsets = fnc.build_member_bitsets(survey)
+
+    members = fnc.get_availability_matrix(bitsets, ["MODEL", "NOT-A-MODEL"], "dcppA-hindcast", "Amon", ["psl", "tas"])
+    assert list(members.columns) == ["psl", "tas", "psl+tas"]
+    assert members.loc[("canari", "MODEL")].tolist() == [3, 2, 2]
+    assert members.loc[("badc", "MODEL")].tolist() == [1, 2, 1]
+    assert members.loc[("any", "MODEL")].tolist() == [3, 4, 3]
+    assert (members.xs("NOT-A-MODEL", level="model") == 0).all().all()
+
+    inits = fnc.get_availability_matrix(bitsets, ["MODEL"], "dcppA-hindcast", "Amon", ["psl", "tas"], count="inits")
+    assert inits.loc[("canari", "MODEL")].tolist() == [2, 2, 2]
+    assert inits.loc[("badc", "MODEL")].tolist() == [1, 1, 1]
+    assert inits.loc[("any", "MODEL")].tolist() == [2, 2, 2]
+
+    # one combination
+    assert fnc.get_availability_matrix(bitsets, ["MODEL"], "dcppA-hindcast", "Amon", ["psl", "tas"], combinations=[("tas",)]).loc[("any", "MODEL")].tolist() == [4]
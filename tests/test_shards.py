@@ -0,0 +1,78 @@
+# Tests for running a survey in shards and merging their partial catalogs
+import shutil
+import sqlite3
+
+import pandas as pd
+import pytest
+
+import dictionaries as dic
+import functions as fnc
+
+# The number of shards the synthetic tree is split into
+n_shards = 3
+
+# Define a function to run the shards of the survey of the tree
+# returns the partial catalogs
+def run_tree_shards(tree, partial_dir):
+    return fnc.run_survey_shards(str(partial_dir), n_shards, tree["base_paths"], tree["models"], tree["variables"], dic.columns, dic.experiments, tree["table_ids"])
+
+# Define a fixture with the partial catalogs of the tree, in a directory of their own
+@pytest.fixture
+def partials(synthetic_tree, tmp_path):
+    return run_tree_shards(synthetic_tree, tmp_path / "partials")
+
+def test_merged_shards_match_fill_dataframe(synthetic_tree, partials, tmp_path):
+    df = fnc.fill_dataframe(synthetic_tree["base_paths"], synthetic_tree["models"], synthetic_tree["variables"], dic.columns, dic.experiments, synthetic_tree["table_ids"])
+    merged = fnc.merge_survey_shards(partials, str(tmp_path / "merged.sqlite"))
+
+    pd.testing.assert_frame_equal(merged, df)
+    pd.testing.assert_frame_equal(fnc.load_catalog(str(tmp_path / "merged.sqlite")), df)
+
+def test_mount_health_is_added_up(partials, tmp_path):
+    catalog = str(tmp_path / "merged.sqlite")
+    fnc.merge_survey_shards(partials, catalog)
+
+    shards = pd.concat([pd.read_sql("SELECT * FROM mount_health", sqlite3.connect(partial)) for partial in partials])
+    with sqlite3.connect(catalog) as connection:
+        health = pd.read_sql("SELECT * FROM mount_health", connection)
+
+    # one row per mount, with the listings of all of the shards
+    assert health["mount"].is_unique
+    assert sorted(health["mount"]) == sorted(shards["mount"].unique())
+    assert health["listings"].sum() == shards["listings"].sum()
+    assert health["max_time_s"].max() == shards["max_time_s"].max()
+
+    # merging again does not count the shards twice
+    fnc.merge_survey_shards(partials, catalog)
+    with sqlite3.connect(catalog) as connection:
+        assert pd.read_sql("SELECT * FROM mount_health", connection)["listings"].sum() == shards["listings"].sum()
+
+def test_missing_and_duplicated_shards(partials, tmp_path):
+    with pytest.raises(ValueError, match="Missing shards"):
+        fnc.merge_survey_shards(partials[1:], str(tmp_path / "merged.sqlite"))
+
+    copy = str(tmp_path / "copy.sqlite")
+    shutil.copy(partials[0], copy)
+    with pytest.raises(ValueError, match="in both"):
+        fnc.merge_survey_shards(partials + [copy], str(tmp_path / "merged.sqlite"))
+
+    # a shard which has not finished has no survey_shard row
+    with sqlite3.connect(partials[0]) as connection:
+        connection.execute("DELETE FROM survey_shard")
+    with pytest.raises(ValueError, match="not finished"):
+        fnc.merge_survey_shards(partials, str(tmp_path / "merged.sqlite"))
+
+def test_rows_in_more_than_one_shard(partials, tmp_path):
+    # a row of the first shard copied into the second one
+    with sqlite3.connect(partials[0]) as connection:
+        row = pd.read_sql("SELECT * FROM survey", connection).iloc[[0]]
+    with sqlite3.connect(partials[1]) as connection:
+        row.to_sql("survey", connection, if_exists="append", index=False)
+    merged = fnc.merge_survey_shards(partials, str(tmp_path / "merged.sqlite"))
+    assert sum(pd.read_sql("SELECT * FROM survey", sqlite3.connect(partial)).shape[0] for partial in partials) == len(merged) + 1
+
+    # with a different value
+    with sqlite3.connect(partials[1]) as connection:
+        connection.execute("UPDATE survey SET no_members = no_members + 1 WHERE key_model = ? AND key_variable = ? AND key_table_id = ? AND key_experiment = ? AND key_base_path = ?", tuple(row[["key_model", "key_variable", "key_table_id", "key_experiment", "key_base_path"]].iloc[0]))
+    with pytest.raises(ValueError, match="Conflicting rows"):
+        fnc.merge_survey_shards(partials, str(tmp_path / "merged.sqlite"))
@@ -0,0 +1,58 @@
+# Tests that the survey sinks read back the same survey as fill_dataframe
+# and that a survey which stopped part way can be resumed
+import itertools
+
+import pandas as pd
+import pytest
+
+import dictionaries as dic
+import functions as fnc
+
+# Define a function to get the values of a survey row by row
+# keeping None, NA and NaN apart (pandas' comparisons treat them as equal)
+def get_values(df):
+    values = []
+    for row in df.astype(object).itertuples(index=False, name=None):
+        values.append(["<NA>" if value is pd.NA else "nan" if isinstance(value, float) and value != value else value for value in row])
+    return values
+
+# Define a function to get the arguments of the survey of the tree
+# with a model which is not on disk, for the rows with missing values
+def get_survey_arguments(tree):
+    return (tree["base_paths"], tree["models"] + ["NOT-A-MODEL"], tree["variables"], dic.columns, dic.experiments, tree["table_ids"])
+
+@pytest.fixture(scope="module")
+def reference(synthetic_tree):
+    return fnc.fill_dataframe(*get_survey_arguments(synthetic_tree))
+
+@pytest.mark.parametrize("sink_format", [ "jsonl", "csv", "parquet" ])
+def test_sink_matches_fill_dataframe(synthetic_tree, reference, tmp_path, sink_format):
+    sink = str(tmp_path / ("survey." + sink_format))
+    rows = list(fnc.stream_survey(*get_survey_arguments(synthetic_tree), sink=sink, batch_size=7))
+    df = fnc.read_survey_sink(sink)
+
+    assert len(rows) == len(reference)
+    assert list(df.columns) == list(reference.columns)
+    assert list(df.dtypes) == list(reference.dtypes)
+    assert get_values(df) == get_values(reference)
+
+@pytest.mark.parametrize("sink_format", [ "jsonl", "csv", "parquet" ])
+def test_resumed_sink_matches_fill_dataframe(synthetic_tree, reference, tmp_path, sink_format):
+    sink = str(tmp_path / ("survey." + sink_format))
+
+    # stop the survey part way through a batch
+    # the rows computed so far are still written
+    stream = fnc.stream_survey(*get_survey_arguments(synthetic_tree), sink=sink, batch_size=5)
+    first_rows = list(itertools.islice(stream, 13))
+    stream.close()
+    assert len(fnc.read_sink_records(sink)) == len(first_rows)
+
+    # a sink is not written over without resume
+    with pytest.raises(FileExistsError):
+        next(fnc.stream_survey(*get_survey_arguments(synthetic_tree), sink=sink))
+
+    rest = list(fnc.stream_survey(*get_survey_arguments(synthetic_tree), sink=sink, batch_size=5, resume=True))
+    df = fnc.read_survey_sink(sink)
+
+    assert len(first_rows) + len(rest) == len(reference)
+    assert get_values(df) == get_values(reference)
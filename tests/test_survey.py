@@ -0,0 +1,179 @@
+# Tests that the survey rows are the same as the get_* functions
+# for every row of a small synthetic tree
+import os
+import sqlite3
+import time
+
+import pandas as pd
+import pytest
+
+import benchmark
+import dictionaries as dic
+import functions as fnc
+
+# The columns which are checked against the get_* functions
+checked_columns = [ "data_source", "institution", "source", "experiment", "table_id", "runs", "inits", "physics", "forcing", "total ensemble members", "no_members", "members_list", "variable", "model", "files_list", "years_range", "no_empty_files", "superseded_versions" ]
+
+# Define a function to compare the values of the survey with those of the get_* functions
+# pandas has NA where the functions have None
+def normalize(value):
+    if value is None or value is pd.NA or (isinstance(value, float) and value != value):
+        return None
+    if hasattr(value, "item"):
+        return value.item()
+    return value
+
+# Define a function to get the values of a row from the get_* functions, one at a time
+def get_expected_row(base_path, table_id, experiment, model, variable):
+    variable_result = fnc.get_variable(model, base_path, experiment, table_id, variable)
+    return {
+        "data_source": fnc.get_datasource(base_path),
+        "institution": fnc.get_institution(model, base_path, variable),
+        "source": model,
+        "experiment": experiment,
+        "table_id": fnc.get_table_id(model, base_path, experiment, table_id, variable),
+        "runs": fnc.get_runs(model, base_path, experiment, variable),
+        "inits": fnc.get_inits(model, base_path, experiment, variable),
+        "physics": fnc.get_physics(model, base_path, experiment, variable),
+        "forcing": fnc.get_forcing(model, base_path, experiment, variable),
+        "total ensemble members": fnc.get_total_ensemble_members(model, base_path, experiment, variable),
+        "no_members": variable_result[1],
+        "members_list": variable_result[2],
+        "variable": variable_result[0],
+        "model": model,
+        "files_list": fnc.get_files(model, base_path, experiment, table_id, variable),
+        "years_range": fnc.get_years(model, base_path, experiment, table_id, variable),
+        "no_empty_files": fnc.get_empty_files(model, base_path, experiment, table_id, variable),
+        "superseded_versions": fnc.get_superseded_versions(model, base_path, experiment, table_id, variable),
+    }
+
+# Define a function to get the row keys of the tree, in the order of fill_dataframe
+def get_row_keys(tree):
+    keys = []
+    for base_path in tree["base_paths"]:
+        for table_id in tree["table_ids"]:
+            for experiment in fnc.get_survey_experiments(base_path, dic.experiments):
+                for model in tree["models"]:
+                    for variable in tree["variables"]:
+                        keys.append((base_path, table_id, experiment, model, variable))
+    return keys
+
+# Define a function to run the survey of the tree
+def fill_tree_dataframe(tree, columns, **kwargs):
+    return fnc.fill_dataframe(tree["base_paths"], tree["models"], tree["variables"], columns, dic.experiments, tree["table_ids"], **kwargs)
+
+def test_evaluate_row_matches_get_functions(synthetic_tree):
+    for key in get_row_keys(synthetic_tree):
+        expected = get_expected_row(*key)
+        row = fnc.evaluate_row(*key, checked_columns)
+        assert {column: normalize(row[column]) for column in checked_columns} == expected, key
+
+def test_fill_dataframe_matches_get_functions(synthetic_tree):
+    keys = get_row_keys(synthetic_tree)
+    df = fill_tree_dataframe(synthetic_tree, checked_columns)
+
+    assert list(df.columns) == checked_columns
+    assert len(df) == len(keys)
+    for key, (position, row) in zip(keys, df.iterrows()):
+        expected = get_expected_row(*key)
+        assert {column: normalize(row[column]) for column in checked_columns} == expected, key
+
+@pytest.mark.parametrize("options", [ {"max_workers": 4}, {"max_workers": 4, "use_asyncio": True} ])
+def test_fill_dataframe_engines_match_serial(synthetic_tree, options):
+    serial = fill_tree_dataframe(synthetic_tree, dic.columns)
+    parallel = fill_tree_dataframe(synthetic_tree, dic.columns, **options)
+
+    pd.testing.assert_frame_equal(serial, parallel)
+
+def test_fill_dataframe_projection_matches_full_survey(synthetic_tree):
+    full = fill_tree_dataframe(synthetic_tree, dic.columns)
+    member_columns = [ "data_source", "model", "runs", "inits", "physics", "forcing", "total ensemble members" ]
+    projected = fill_tree_dataframe(synthetic_tree, member_columns)
+
+    pd.testing.assert_frame_equal(full[member_columns], projected)
+
+def test_fill_dataframe_catalog_matches_uncached(synthetic_tree, tmp_path):
+    catalog = str(tmp_path / "catalog.sqlite")
+    uncached = fill_tree_dataframe(synthetic_tree, dic.columns)
+    first = fill_tree_dataframe(synthetic_tree, dic.columns, catalog=catalog)
+    second = fill_tree_dataframe(synthetic_tree, dic.columns, catalog=catalog)
+
+    pd.testing.assert_frame_equal(uncached, first)
+    pd.testing.assert_frame_equal(uncached, second)
+    pd.testing.assert_frame_equal(uncached, fnc.load_catalog(catalog))
+
+def test_catalog_sizes_of_files_written_in_place(make_canari_directory, tmp_path):
+    base_path, directory = make_canari_directory()
+    path = directory / "tas_Amon_MODEL_historical_r1i1p1f1_gn_185001-201412.nc"
+    path.write_bytes(b"")
+
+    catalog = str(tmp_path / "catalog.sqlite")
+    survey = lambda: fnc.fill_dataframe([base_path], ["MODEL"], ["tas"], ["no_empty_files"], ["historical"], ["Amon"], catalog=catalog)
+    assert survey()["no_empty_files"].tolist() == [1]
+
+    # the file is written in place, so the mtime of the directory does not change
+    mtime_ns = directory.stat().st_mtime_ns
+    with open(path, "r+b") as f:
+        f.write(b"CDF\x01")
+    os.utime(directory, ns=(mtime_ns, mtime_ns))
+    assert survey()["no_empty_files"].tolist() == [0]
+
+def test_mount_health_of_each_survey(synthetic_tree, tmp_path):
+    columns = [ "no_members", "unreachable_directories" ]
+    fill_tree_dataframe(synthetic_tree, columns)
+    health = fnc.get_mount_health()
+
+    # a directory left unreachable by an earlier survey
+    fnc.unreachable_directories[synthetic_tree["base_paths"][0]] = "timeout"
+
+    catalog = str(tmp_path / "catalog.sqlite")
+    df = fill_tree_dataframe(synthetic_tree, columns, catalog=catalog)
+    assert fnc.get_mount_health()["listings"].sum() == health["listings"].sum()
+    assert all(len(value) == 0 for value in df["unreachable_directories"])
+
+    with sqlite3.connect(catalog) as connection:
+        saved = pd.read_sql("SELECT * FROM mount_health", connection)
+    assert saved["listings"].sum() == health["listings"].sum()
+
+    rows = list(fnc.stream_survey(synthetic_tree["base_paths"], synthetic_tree["models"], synthetic_tree["variables"], columns, dic.experiments, synthetic_tree["table_ids"]))
+    assert len(rows) == len(df)
+    assert fnc.get_mount_health()["listings"].sum() == health["listings"].sum()
+
+def test_stalled_directory_times_out(synthetic_tree):
+    canari = [base_path for base_path in synthetic_tree["base_paths"] if "/gws/nopw/j04/canari/" in base_path][0]
+    model, variable = synthetic_tree["models"][0], synthetic_tree["variables"][0]
+    stalled = os.path.join(canari, "historical", "data", variable, model)
+    # the stalled directory is a mount of its own, as if on a stalled GWS volume
+    mount_limits = { stalled: 4 }
+
+    start = time.perf_counter()
+    with benchmark.count_filesystem_calls(stalls={stalled: 30}):
+        df = fnc.fill_dataframe([canari], synthetic_tree["models"], synthetic_tree["variables"], [ "experiment", "model", "variable", "no_members", "unreachable_directories" ], dic.experiments, synthetic_tree["table_ids"], timeouts={"timeout": 0.2, "retries": 1, "backoff": 0.0}, mount_limits=mount_limits)
+    assert time.perf_counter() - start < 10
+
+    # only the rows below the stalled directory have it
+    affected = (df["experiment"] == "historical") & (df["model"] == model) & (df["variable"] == variable)
+    assert affected.sum() == len(synthetic_tree["table_ids"])
+    assert all(value == [stalled] for value in df.loc[affected, "unreachable_directories"])
+    assert all(value == [] for value in df.loc[~affected, "unreachable_directories"])
+
+    health = fnc.get_mount_health().set_index("mount")
+    assert health.loc[stalled, ["timeouts", "retries", "unreachable"]].tolist() == [2, 1, 1]
+    assert (health.drop(stalled)[["timeouts", "unreachable"]] == 0).all().all()
+    assert fnc.get_throttled_mount_limits(fnc.get_mount_health(), max_workers=32) == { stalled: 4 }
+
+def test_profiled_survey(synthetic_tree):
+    df, profile = fill_tree_dataframe(synthetic_tree, dic.columns, profile=True)
+    pd.testing.assert_frame_equal(df, fill_tree_dataframe(synthetic_tree, dic.columns))
+
+    assert list(profile.columns) == [ "scope", "name", "base_path", "calls", "wall_time_s" ] + fnc.filesystem_calls
+    assert set(profile["scope"]) == { "function", "column", "base_path" }
+    assert set(profile.loc[profile["scope"] == "column", "name"]) == set(dic.columns)
+    assert "get_files" in set(profile.loc[profile["scope"] == "function", "name"])
+
+    # the files are listed (and stat'd for no_empty_files) when the index is built
+    index = profile[(profile["scope"] == "base_path") & (profile["name"] == "index")]
+    assert sorted(index["base_path"]) == sorted(synthetic_tree["base_paths"])
+    assert (index["scandir"] > 0).all()
+    assert (index["stat"] > 0).all()
+    assert (profile["wall_time_s"] >= 0).all()
@@ -0,0 +1,72 @@
+# Tests for the plan of copying the badc files to canari
+import os
+
+import functions as fnc
+
+# Define a function to write a file of a number of bytes
+# creating the directories above it
+def write_file(path, n_bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(b"\0" * n_bytes)
+
+# Define a function to get the filename of a file
+def get_filename(time_range, table_id="Amon", member="r1i1p1f1"):
+    return "_".join(["tas", table_id, "MODEL", "historical", member, "gn", time_range]) + ".nc"
+
+# Define a function to build a small badc and canari tree
+# with a file of each kind for the plan
+# returns the badc base path and the canari base path
+def make_sync_tree(root):
+    badc = str(root / "badc/cmip6/data/CMIP6/CMIP")
+    canari = str(root / "gws/nopw/j04/canari/users/benhutch")
+    badc_dir = os.path.join(badc, "INST", "MODEL", "historical", "r1i1p1f1", "Amon", "tas", "gn", "files", "d20190101")
+    canari_dir = os.path.join(canari, "historical", "data", "tas", "MODEL")
+
+    # (time range, size in badc, size in canari), None for no file
+    files = {
+        "185001-185912": (10, None),  # missing
+        "186001-186912": (10, 10),  # the same
+        "187001-187912": (10, 5),  # size mismatch
+        "188001-188912": (10, 0),  # zero length
+        "189001-189912": (0, None),  # empty source
+        "190001-190912": (None, 7),  # extra
+    }
+    for time_range, (badc_size, canari_size) in files.items():
+        if badc_size is not None:
+            write_file(os.path.join(badc_dir, get_filename(time_range)), badc_size)
+        if canari_size is not None:
+            write_file(os.path.join(canari_dir, get_filename(time_range)), canari_size)
+
+    # a daily file, which is only in canari
+    write_file(os.path.join(canari_dir, get_filename("18500101-18591231", table_id="day")), 3)
+
+    # an older version of a file, which is not copied
+    write_file(os.path.join(badc, "INST", "MODEL", "historical", "r1i1p1f1", "Amon", "tas", "gn", "files", "d20180101", get_filename("191001-191912")), 10)
+
+    return badc, canari
+
+def test_sync_plan(tmp_path):
+    badc, canari = make_sync_tree(tmp_path)
+    plan = fnc.get_sync_plan([badc], canari, models=["MODEL"], experiments=["historical"], table_ids=["Amon"], variables=["tas"])
+
+    assert plan["missing"]["time_range"].tolist() == ["185001-185912"]
+    assert plan["size_mismatch"]["time_range"].tolist() == ["187001-187912"]
+    assert plan["size_mismatch"]["canari_size"].tolist() == [5]
+    assert plan["zero_length"]["time_range"].tolist() == ["188001-188912"]
+    assert plan["empty_source"]["time_range"].tolist() == ["189001-189912"]
+    # the daily file is not in the Amon plan
+    assert plan["extra"]["filename"].tolist() == [get_filename("190001-190912")]
+
+    # the missing, mismatched and zero length files are copied into the canari layout
+    transfer = plan["transfer"].sort_values("path")
+    assert [os.path.basename(path) for path in transfer["path"]] == [get_filename(time_range) for time_range in ["185001-185912", "187001-187912", "188001-188912"]]
+    assert transfer["destination"].tolist() == [os.path.join(canari, "historical", "data", "tas", "MODEL", os.path.basename(path)) for path in transfer["path"]]
+    assert all(path.startswith(badc) for path in transfer["path"])
+    assert plan["bytes_to_transfer"] == 30
+
+def test_sync_plan_of_all_the_table_ids(tmp_path):
+    badc, canari = make_sync_tree(tmp_path)
+    plan = fnc.get_sync_plan([badc], canari, models=["MODEL"], experiments=["historical"], variables=["tas"])
+
+    assert sorted(plan["extra"]["filename"].tolist()) == sorted([get_filename("190001-190912"), get_filename("18500101-18591231", table_id="day")])
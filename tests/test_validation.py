@@ -0,0 +1,175 @@
+# Tests for the checks of the NetCDF files
+import os
+import sqlite3
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+import benchmark
+import functions as fnc
+
+# Define a function to write a small NetCDF file
+# format is e.g. NETCDF4 (HDF5) or NETCDF3_CLASSIC
+def write_netcdf(path, format="NETCDF4", times=None):
+    if times is None:
+        times = pd.date_range("1850-01-01", periods=12, freq="MS")
+    ds = xr.Dataset({"tas": (("time", "lat"), np.zeros((len(times), 4), dtype="f4"))}, coords={"time": times, "lat": np.arange(4.0)})
+    ds.to_netcdf(path, format=format)
+    return str(path)
+
+# Define a function to write a copy of a file without its last bytes
+def write_truncated(path, source, n_bytes):
+    with open(source, "rb") as f:
+        data = f.read()
+    with open(path, "wb") as f:
+        f.write(data[:-n_bytes])
+    return str(path)
+
+def test_netcdf4_and_classic_files_are_ok(tmp_path):
+    for format in ["NETCDF4", "NETCDF4_CLASSIC", "NETCDF3_CLASSIC", "NETCDF3_64BIT"]:
+        path = write_netcdf(tmp_path / (format + ".nc"), format=format)
+        assert fnc.validate_netcdf_file(path, check_time=True)["status"] == "ok", format
+
+def test_truncated_netcdf4_file(tmp_path):
+    source = write_netcdf(tmp_path / "full.nc")
+
+    # the end of the file address in the HDF5 superblock is past the end
+    for n_bytes in [1, 1000]:
+        path = write_truncated(tmp_path / ("truncated_" + str(n_bytes) + ".nc"), source, n_bytes)
+        assert fnc.check_netcdf_magic(path, len(open(path, "rb").read())) == "truncated"
+        assert fnc.validate_netcdf_file(path)["status"] == "truncated"
+
+    # cut inside the superblock
+    with open(source, "rb") as f:
+        header = f.read(20)
+    path = tmp_path / "superblock.nc"
+    path.write_bytes(header)
+    assert fnc.validate_netcdf_file(str(path))["status"] == "truncated"
+
+def test_truncated_classic_files(tmp_path):
+    for format in ["NETCDF3_CLASSIC", "NETCDF3_64BIT"]:
+        source = write_netcdf(tmp_path / (format + ".nc"), format=format)
+
+        # the end of the last variable in the header is past the end
+        for n_bytes in [1, 40]:
+            path = write_truncated(tmp_path / (format + "_" + str(n_bytes) + ".nc"), source, n_bytes)
+            assert fnc.validate_netcdf_file(path)["status"] == "truncated", (format, n_bytes)
+
+        # cut inside the header
+        path = tmp_path / (format + "_header.nc")
+        path.write_bytes(open(source, "rb").read()[:30])
+        assert fnc.validate_netcdf_file(str(path))["status"] == "truncated", format
+
+def test_empty_bad_magic_and_unreadable_files(tmp_path):
+    empty = tmp_path / "empty.nc"
+    empty.write_bytes(b"")
+    text = tmp_path / "text.nc"
+    text.write_bytes(b"<html>not found</html>" * 50)
+    # a full length NetCDF4 file with its metadata overwritten
+    broken = write_netcdf(tmp_path / "broken.nc")
+    data = bytearray(open(broken, "rb").read())
+    data[100:2000] = bytes(1900)
+    open(broken, "wb").write(data)
+
+    assert fnc.validate_netcdf_file(str(empty))["status"] == "empty"
+    assert fnc.validate_netcdf_file(str(text))["status"] == "bad_magic"
+    # the magic bytes and the size are right, so it is only found when opened
+    result = fnc.validate_netcdf_file(broken)
+    assert result["status"] == "unreadable"
+    assert result["error"] is not None
+
+def test_bad_time(tmp_path):
+    times = pd.to_datetime(["1850-01-01", "1850-03-01", "1850-02-01"])
+    path = write_netcdf(tmp_path / "bad_time.nc", times=times)
+
+    assert fnc.validate_netcdf_file(path)["status"] == "ok"
+    assert fnc.validate_netcdf_file(path, check_time=True)["status"] == "bad_time"
+
+def test_validate_files_in_a_pool_and_cached(tmp_path):
+    good = write_netcdf(tmp_path / "good.nc")
+    truncated = write_truncated(tmp_path / "truncated.nc", good, 100)
+    missing = str(tmp_path / "missing.nc")
+    catalog = fnc.open_catalog(str(tmp_path / "catalog.sqlite"))
+
+    results = fnc.validate_files([good, truncated, missing], catalog=catalog, max_workers=2)
+    assert {path: result["status"] for path, result in results.items()} == { good: "ok", truncated: "truncated", missing: "missing" }
+
+    # the cached results are used for the unchanged files
+    cached = fnc.validate_files([good, truncated], catalog=catalog)
+    assert cached[good] == results[good]
+    assert cached[truncated] == results[truncated]
+    catalog.close()
+
+def test_benchmark_counts_the_opened_files(tmp_path):
+    paths = [write_netcdf(tmp_path / "first.nc"), write_netcdf(tmp_path / "second.nc")]
+
+    # the check reads the magic bytes, then opens the file with the NetCDF library
+    with benchmark.count_filesystem_calls() as counts:
+        fnc.validate_files(paths)
+    assert counts["open"] == 4
+
+    with benchmark.count_filesystem_calls() as counts:
+        fnc.get_file_headers(paths)
+    assert counts["open"] == 2
+    assert open is benchmark.builtins.open
+
+def test_years_from_the_headers_and_the_filenames(make_canari_directory):
+    base_path, directory = make_canari_directory()
+
+    # the header of the first file has times past its filename (1850-1852)
+    # the second file cannot be read, so its filename (1900-2014) is used
+    times = pd.date_range("1850-01-01", periods=36, freq="MS")
+    write_netcdf(directory / "tas_Amon_MODEL_historical_r1i1p1f1_gn_185001-185112.nc", times=times)
+    (directory / "tas_Amon_MODEL_historical_r1i1p1f1_gn_190001-201412.nc").write_bytes(b"\0")
+
+    index = fnc.build_drs_index(base_path, models=["MODEL"], experiments=["historical"], table_ids=["Amon"], variables=["tas"])
+    headers = fnc.get_file_headers(fnc.get_index_file_paths(index, base_path))
+
+    assert fnc.get_header_years(index, base_path, "MODEL", "historical", "Amon", "tas", headers) == [1850, 1852, 1900, 2014]
+    assert fnc.get_years("MODEL", base_path, "historical", "Amon", "tas", index=index, headers=headers) == "1850-2014"
+    assert fnc.get_years("MODEL", base_path, "historical", "Amon", "tas", index=index) == "1850-2014"
+
+# Define a function which hangs on the files with "slow" in their path
+# (at the top of the module, so it can be sent to the process pool)
+def hang_on_slow_files(path):
+    if "slow" in os.path.basename(path):
+        time.sleep(30)
+    return fnc.validate_netcdf_file(path)
+
+@pytest.mark.parametrize("max_workers", [None, 2])
+def test_hung_files_time_out(tmp_path, max_workers):
+    good = write_netcdf(tmp_path / "good.nc")
+    slow = write_netcdf(tmp_path / "slow.nc")
+    fnc.reset_mount_health()
+
+    start = time.perf_counter()
+    results = fnc.map_files_cached(hang_on_slow_files, [good, slow], "file_checks", catalog=sqlite3.connect(":memory:"), max_workers=max_workers, timeouts={"timeout": 0.5, "retries": 0})
+    assert time.perf_counter() - start < 10
+
+    assert results[good]["status"] == "ok"
+    assert results[slow]["unreachable"]
+    assert list(fnc.unreachable_directories) == [slow]
+    assert fnc.get_mount_health()["unreachable"].sum() == 1
+
+def test_hung_stats_time_out(tmp_path, monkeypatch):
+    good = write_netcdf(tmp_path / "good.nc")
+    slow = write_netcdf(tmp_path / "slow.nc")
+    missing = str(tmp_path / "missing.nc")
+    fnc.reset_mount_health()
+
+    stat_file = fnc.stat_file
+    def hang_on_slow_stats(path):
+        if "slow" in path:
+            time.sleep(30)
+        return stat_file(path)
+    monkeypatch.setattr(fnc, "stat_file", hang_on_slow_stats)
+
+    results = fnc.validate_files([good, slow, missing], timeouts={"timeout": 0.2, "retries": 1, "backoff": 0.0})
+    assert {path: result["status"] for path, result in results.items()} == { good: "ok", slow: "unreachable", missing: "missing" }
+    health = fnc.get_mount_health()
+    assert health["timeouts"].sum() == 2
+    assert health["retries"].sum() == 1
+    assert list(fnc.unreachable_directories) == [slow]
@@ -0,0 +1,72 @@
+# Tests for choosing the badc version directories
+import functions as fnc
+
+# Define a function to create a badc tree with several versions of a member
+# versions maps (model, member) to {version: [time ranges]}
+# returns the base path
+def make_versioned_tree(root, versions, variable="tas", table_id="Amon"):
+    base_path = root / "badc/cmip6/data/CMIP6/CMIP"
+    for (model, member), member_versions in versions.items():
+        for version, time_ranges in member_versions.items():
+            directory = base_path / "INST" / model / "historical" / member / table_id / variable / "gn" / "files" / version
+            directory.mkdir(parents=True)
+            for time_range in time_ranges:
+                filename = "_".join([variable, table_id, model, "historical", member, "gn", time_range]) + ".nc"
+                (directory / filename).write_bytes(b"\0")
+    return str(base_path)
+
+versions = {
+    ("MODEL-A", "r1i1p1f1"): { "d20190101": ["185001-194912"], "d20200101": ["185001-201412"] },
+    ("MODEL-A", "r2i1p1f1"): { "d20190101": ["185001-201412"] },
+    ("MODEL-B", "r1i1p1f1"): { "d20190101": ["185001-189912"], "d20210101": ["185001-202012"] },
+}
+
+# Define a function to get the files of a survey row for a version choice
+def get_row_files(base_path, model, version):
+    index = fnc.build_drs_index(base_path, models=[model], version=version)
+    return fnc.get_files(model, base_path, "historical", "Amon", "tas", index=index), fnc.get_superseded_versions(model, base_path, "historical", "Amon", "tas", index=index)
+
+def test_select_versions():
+    leaves = [("a/v1", ("I", "M", "historical", "r1", "Amon", "tas", "gn", "d20190101")),
+              ("a/v2", ("I", "M", "historical", "r1", "Amon", "tas", "gn", "d20200101")),
+              ("b/v1", ("I", "M", "historical", "r2", "Amon", "tas", "gn", "d20190101"))]
+
+    chosen, superseded = fnc.select_versions(leaves, "latest")
+    assert [path for path, keys in chosen] == ["a/v2", "b/v1"]
+    assert [path for path, keys in superseded] == ["a/v1"]
+
+    chosen, superseded = fnc.select_versions(leaves, "all")
+    assert [path for path, keys in chosen] == ["a/v1", "a/v2", "b/v1"]
+    assert superseded == []
+
+    # a pinned version which is not there falls back to the latest
+    chosen, superseded = fnc.select_versions(leaves, "d20190101")
+    assert [path for path, keys in chosen] == ["a/v1", "b/v1"]
+    chosen, superseded = fnc.select_versions(leaves, {"M": "d20180101"})
+    assert [path for path, keys in chosen] == ["a/v2", "b/v1"]
+
+def test_latest_versions_in_the_survey(tmp_path):
+    base_path = make_versioned_tree(tmp_path, versions)
+
+    files, superseded = get_row_files(base_path, "MODEL-A", "latest")
+    assert files == ["tas_Amon_MODEL-A_historical_r1i1p1f1_gn_185001-201412.nc", "tas_Amon_MODEL-A_historical_r2i1p1f1_gn_185001-201412.nc"]
+    assert superseded == ["r1i1p1f1/gn/d20190101"]
+
+    row = fnc.evaluate_row(base_path, "Amon", "historical", "MODEL-B", "tas", ["years_range", "superseded_versions", "no_duplicate_files"])
+    assert row == { "years_range": "1850-2020", "superseded_versions": ["r1i1p1f1/gn/d20190101"], "no_duplicate_files": 0 }
+
+def test_pinned_and_all_versions(tmp_path):
+    base_path = make_versioned_tree(tmp_path, versions)
+
+    files, superseded = get_row_files(base_path, "MODEL-A", {"MODEL-A": "d20190101"})
+    assert files == ["tas_Amon_MODEL-A_historical_r1i1p1f1_gn_185001-194912.nc", "tas_Amon_MODEL-A_historical_r2i1p1f1_gn_185001-201412.nc"]
+    assert superseded == ["r1i1p1f1/gn/d20200101"]
+
+    files, superseded = get_row_files(base_path, "MODEL-A", "all")
+    assert len(files) == 3
+    assert superseded == []
+
+    # the version options are passed on from the survey
+    df = fnc.fill_dataframe([base_path], ["MODEL-A", "MODEL-B"], ["tas"], ["model", "years_range", "superseded_versions"], ["historical"], ["Amon"], version="d20190101")
+    assert df["years_range"].tolist() == ["1850-2014", "1850-1899"]
+    assert df["superseded_versions"].tolist() == [["r1i1p1f1/gn/d20200101"], ["r1i1p1f1/gn/d20210101"]]